@@ -0,0 +1,132 @@
+from .expression import *
+
+
+# Ranges of all code points.
+ANY = ((0, MAX_CODE_POINT),)
+
+
+def _code(character):
+    """Return the code point of a character or integer byte value."""
+    return character if type(character) is int else ord(character)
+
+
+def set_ranges(character_set):
+    """Return the normalized ranges of the code points in
+    character_set, with negated sets complemented."""
+    if character_set.negated:
+        return complement_ranges(character_set.ranges)
+    return character_set.ranges
+
+
+def union_ranges(a, b):
+    """Return the normalized union of the normalized ranges a and b."""
+    if not a:
+        return b
+    if not b:
+        return a
+    return normalize_ranges(a + b)
+
+
+def ranges_overlap(a, b):
+    """Return whether the normalized ranges a and b share a code
+    point."""
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i][1] < b[j][0]:
+            i += 1
+        elif b[j][1] < a[i][0]:
+            j += 1
+        else:
+            return True
+    return False
+
+
+class FirstSets:
+    """Computes which characters the matches of expressions can start
+    with.
+
+    first(expression) returns a pair (ranges, nullable): the normalized
+    ranges of the code points the match of expression can start with,
+    and whether expression can match the empty string. A back reference
+    can match anything. Results are cached by expression, so asking for
+    every node of a tree takes linear time.
+
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def first(self, expression):
+        try:
+            return self._cache[id(expression)][1]
+        except KeyError:
+            pass
+        if expression._max_repetitions == 0:
+            result = ((), True)
+        else:
+            ranges, nullable = self._first_once(expression)
+            result = (ranges, nullable or expression._min_repetitions == 0)
+        # The expression is kept alive as long as its id is cached.
+        self._cache[id(expression)] = (expression, result)
+        return result
+
+    def _first_once(self, expression):
+        """first() of a single repetition of expression."""
+        if isinstance(expression, CharacterExpression):
+            code = _code(expression._char)
+            return ((code, code),), False
+        if isinstance(expression, LiteralExpression):
+            if not expression._literal:
+                return (), True
+            code = _code(expression._literal[0])
+            return ((code, code),), False
+        if isinstance(expression, CharacterRangeExpression):
+            return ((_code(expression._start), _code(expression._end)),), False
+        if isinstance(expression, CharacterClassExpression):
+            return set_ranges(expression._set), False
+        if isinstance(expression, GroupExpression):
+            ranges = []
+            for child in expression._children:
+                child_ranges, nullable = self.first(child)
+                ranges.extend(child_ranges)
+                if not nullable:
+                    return normalize_ranges(ranges), False
+            return normalize_ranges(ranges), True
+        if isinstance(expression, AnyOfOptionsExpression):
+            ranges = []
+            nullable = False
+            for child in expression._children:
+                child_ranges, child_nullable = self.first(child)
+                ranges.extend(child_ranges)
+                nullable = nullable or child_nullable
+            return normalize_ranges(ranges), nullable
+        return ANY, True
+
+
+def match_lengths(expression):
+    """Return the minimum and maximum length of the matches of
+    expression. The maximum is float("inf") if it is unbounded; a back
+    reference can match a string of any length."""
+    if expression._max_repetitions == 0:
+        return 0, 0
+    if isinstance(expression, LiteralExpression):
+        minimum = maximum = len(expression._literal)
+    elif isinstance(expression, (CharacterExpression,
+                                 CharacterRangeExpression,
+                                 CharacterClassExpression)):
+        minimum = maximum = 1
+    elif isinstance(expression, GroupExpression):
+        lengths = [match_lengths(c) for c in expression._children]
+        minimum = sum(l[0] for l in lengths)
+        maximum = sum(l[1] for l in lengths)
+    elif isinstance(expression, AnyOfOptionsExpression):
+        lengths = [match_lengths(c) for c in expression._children]
+        minimum = min((l[0] for l in lengths), default=0)
+        maximum = max((l[1] for l in lengths), default=0)
+    else:
+        return 0, float("inf")
+    if maximum == 0:
+        # Avoid 0 * inf for empty matches that repeat without limit.
+        return 0, 0
+    return (minimum * expression._min_repetitions,
+            maximum * expression._max_repetitions)
@@ -0,0 +1,107 @@
+import time
+
+
+class BudgetExceeded(Exception):
+    """Raised when matching takes more steps or more time than its
+    StepBudget allows.
+
+    steps is the number of steps taken until matching was stopped,
+    elapsed the time that passed since matching started, in seconds.
+
+    """
+
+    def __init__(self, steps, elapsed, reason):
+        super().__init__("matching was stopped after %d steps and %.3f "
+                         "seconds: %s" % (steps, elapsed, reason))
+        self.steps = steps
+        self.elapsed = elapsed
+
+
+class StepBudget:
+    """Limits the work of a single match or search.
+
+    The engines charge one step for every unit of work that may be
+    repeated many times: the expression tree for every call of
+    matches() and retry(), the BacktrackingVM whenever it resumes a
+    choice point, and the PikeVM for every thread it advances and
+    every empty transition it follows. Once more than max_steps steps
+    were charged, or the timeout (in seconds) passed, BudgetExceeded
+    is raised.
+
+    Reading the clock is much more expensive than counting, so the
+    deadline is only checked every CHECK_INTERVAL steps. The engines
+    increment steps themselves and only call check() once it reaches
+    next_check.
+
+    The class attributes default_max_steps and default_timeout apply
+    to all matches that don't set their own limits; see
+    cre.set_match_limits().
+
+    """
+
+    __slots__ = ("max_steps", "deadline", "steps", "next_check", "_started")
+
+    CHECK_INTERVAL = 1024
+
+    default_max_steps = None
+    default_timeout = None
+
+    @classmethod
+    def create(cls, max_steps=None, timeout=None):
+        """Return a StepBudget for the given limits, falling back to the
+        defaults, or None if there are no limits at all."""
+        if max_steps is None:
+            max_steps = cls.default_max_steps
+        if timeout is None:
+            timeout = cls.default_timeout
+        if max_steps is None and timeout is None:
+            return None
+        return cls(max_steps, timeout)
+
+    def __init__(self, max_steps=None, timeout=None):
+        if max_steps is not None and max_steps < 0:
+            raise ValueError("max_steps must not be negative")
+        self.max_steps = max_steps
+        self._started = time.monotonic()
+        self.deadline = None if timeout is None else self._started + timeout
+        self.steps = 0
+        self.next_check = 0
+        self._schedule()
+
+    def restart(self):
+        """Give the budget back all of its steps and time, so it can
+        limit the next match of a batch."""
+        if self.deadline is not None:
+            started = time.monotonic()
+            self.deadline += started - self._started
+            self._started = started
+        self.steps = 0
+        self._schedule()
+
+    def charge(self, steps=1):
+        """Charge steps and raise BudgetExceeded if the budget is used
+        up."""
+        self.steps += steps
+        if self.steps >= self.next_check:
+            self.check()
+
+    def check(self):
+        """Raise BudgetExceeded if the budget is used up, else schedule
+        the next check."""
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise BudgetExceeded(self.steps, self.elapsed,
+                                 "more than %d steps" % self.max_steps)
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise BudgetExceeded(self.steps, self.elapsed,
+                                 "timeout of %g seconds"
+                                 % (self.deadline - self._started))
+        self._schedule()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self._started
+
+    def _schedule(self):
+        self.next_check = self.steps + self.CHECK_INTERVAL
+        if self.max_steps is not None:
+            self.next_check = min(self.next_check, self.max_steps + 1)
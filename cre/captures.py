@@ -0,0 +1,188 @@
+from array import array
+from collections.abc import Sequence
+
+
+class Captures:
+    """The spans of all matches of all capturing groups of one match.
+
+    The spans are stored column-wise: starts[g] and ends[g] are arrays
+    of machine integers that hold the start and end offsets of every
+    match of group g, in the order in which they were committed. The
+    last item is the match that the builtin re module would report.
+    Group names are resolved by RegexObject.groupindex; this class only
+    knows group numbers.
+
+    If limit is given, only the last limit matches of each group are
+    kept. callbacks may map group numbers to functions that are called
+    with the (start, end) tuple of every match of the group as it is
+    appended; of these groups, only the last match is kept. Both only
+    apply to append() and add_matches(); the engines only append
+    captures that can't be retracted anymore.
+
+    """
+
+    def __init__(self, groups, limit=None, callbacks=None):
+        if limit is not None and limit < 1:
+            raise ValueError("capture limit must be positive")
+        self.starts = [array("q") for _ in range(groups)]
+        self.ends = [array("q") for _ in range(groups)]
+        self._limit = limit
+        self._callbacks = callbacks
+
+    @property
+    def bounded(self):
+        """Whether append() drops or emits captures."""
+        return self._limit is not None or bool(self._callbacks)
+
+    @classmethod
+    def from_matches(cls, matches, groups):
+        """Convert a dict in the format of EvaluationContext.matches;
+        only the integer keys are group numbers."""
+        captures = cls(groups)
+        for group, spans in matches.items():
+            if type(group) is int and group < groups:
+                captures.starts[group].extend(s["start"] for s in spans)
+                captures.ends[group].extend(s["end"] for s in spans)
+        return captures
+
+    def add_matches(self, matches):
+        """Append the spans of a dict in the format of
+        EvaluationContext.matches, group by group."""
+        for group in sorted(g for g in matches if type(g) is int):
+            if group < len(self.starts):
+                for span in matches[group]:
+                    self.append(group, span["start"], span["end"])
+
+    def append(self, group, start, end):
+        starts = self.starts[group]
+        ends = self.ends[group]
+        starts.append(start)
+        ends.append(end)
+        if self._limit is None and not self._callbacks:
+            return
+        limit = self._limit
+        callback = self._callbacks.get(group) if self._callbacks else None
+        if callback is not None:
+            callback((start, end))
+            limit = 1
+        # Trimming the columns only every limit appends keeps the
+        # amortized cost constant.
+        if limit is not None and len(starts) >= 2 * limit:
+            del starts[:-limit]
+            del ends[:-limit]
+
+    def staging(self):
+        """Return an empty Captures for matches that may still be
+        retracted, which keeps as many matches of each group as this
+        one. Return None if this one keeps all matches or calls
+        callbacks: then every match has to be kept until it is final.
+        """
+        if self._limit is None or self._callbacks:
+            return None
+        return Captures(len(self.starts), self._limit)
+
+    def extend(self, other):
+        """Append all matches of other, group by group."""
+        for group in range(len(other.starts)):
+            for start, end in zip(other.starts[group], other.ends[group]):
+                self.append(group, start, end)
+
+    def trim(self):
+        """Drop the matches beyond the limits that append() still
+        kept."""
+        if not self.bounded:
+            return
+        for group in range(len(self.starts)):
+            limit = self._limit
+            if self._callbacks and group in self._callbacks:
+                limit = 1
+            if limit is not None and len(self.starts[group]) > limit:
+                del self.starts[group][:-limit]
+                del self.ends[group][:-limit]
+
+    def count(self, group):
+        """Return how often group matched."""
+        if group >= len(self.starts):
+            return 0
+        return len(self.starts[group])
+
+    def last(self, group):
+        """Return the (start, end) span of the last match of group, or
+        None if the group didn't participate in the match."""
+        if not self.count(group):
+            return None
+        return self.starts[group][-1], self.ends[group][-1]
+
+    def shift(self, offset):
+        """Add offset to all spans."""
+        if not offset:
+            return
+        for column in self.starts + self.ends:
+            for i in range(len(column)):
+                column[i] += offset
+
+
+class SpanSequence(Sequence):
+    """Read-only view of the (start, end) spans of a group.
+
+    Tuples are only created when an item is accessed, so the view costs
+    the same no matter how often the group matched.
+
+    """
+
+    def __init__(self, starts, ends):
+        self._starts = starts
+        self._ends = ends
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return SpanSequence(self._starts[index], self._ends[index])
+        return self._starts[index], self._ends[index]
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "<cre.SpanSequence %r>" % (list(self),)
+
+
+class CaptureSequence(SpanSequence):
+    """Read-only view of the substrings matched by a group; like
+    SpanSequence, the substrings are only sliced on access."""
+
+    def __init__(self, string, starts, ends, offset=0):
+        super().__init__(starts, ends)
+        self._string = string
+        self._offset = offset
+
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return CaptureSequence(self._string, self._starts[index],
+                                   self._ends[index], self._offset)
+        return substring(self._string, self._starts[index] - self._offset,
+                         self._ends[index] - self._offset)
+
+    def __iter__(self):
+        for start, end in zip(self._starts, self._ends):
+            yield substring(self._string, start - self._offset,
+                            end - self._offset)
+
+    def __repr__(self):
+        return "<cre.CaptureSequence %r>" % (list(self),)
+
+
+def substring(string, start, end):
+    """Return string[start:end]. Like the builtin re module, return
+    bytes for bytes-like subjects other than bytes."""
+    value = string[start:end]
+    if not isinstance(value, (str, bytes)):
+        value = bytes(value)
+    return value
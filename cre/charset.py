@@ -0,0 +1,149 @@
+import weakref
+from bisect import bisect_right
+
+
+# Highest code point; the universe all character sets are subsets of.
+MAX_CODE_POINT = 0x10FFFF
+
+
+def normalize_ranges(ranges):
+    """Sort ranges of code points and merge overlapping or adjacent
+    ones. Return a tuple of (first, last) pairs."""
+    result = []
+    for first, last in sorted(ranges):
+        if result and first <= result[-1][1] + 1:
+            if last > result[-1][1]:
+                result[-1] = (result[-1][0], last)
+        else:
+            result.append((first, last))
+    return tuple(result)
+
+
+def complement_ranges(ranges):
+    """Return the normalized ranges of all code points not in ranges."""
+    result = []
+    next_code = 0
+    for first, last in normalize_ranges(ranges):
+        if first > next_code:
+            result.append((next_code, first - 1))
+        next_code = last + 1
+    if next_code <= MAX_CODE_POINT:
+        result.append((next_code, MAX_CODE_POINT))
+    return tuple(result)
+
+
+# Ranges of the special sequences \d, \s and \w, keyed by category and
+# ascii flag; computed on first use because the unicode tables have to
+# be scanned.
+_category_ranges = {}
+
+_category_predicates = {
+    "d": lambda c: c.isdecimal(),
+    "s": lambda c: c.isspace(),
+    "w": lambda c: c.isalnum() or c == "_",
+}
+
+# Predicates for bytes patterns; like the builtin re module, only ASCII
+# bytes belong to the categories.
+_byte_category_predicates = {
+    "d": lambda b: bytes((b,)).isdigit(),
+    "s": lambda b: bytes((b,)).isspace(),
+    "w": lambda b: bytes((b,)).isalnum() or b == ord("_"),
+}
+
+
+def category_ranges(category, ascii=False):
+    """Return the ranges of the special sequence \\<category>.
+
+    category is one of "d", "s", "w" or their upper case negations.
+    The sets match the same characters as the builtin re module does
+    for str patterns, or for bytes patterns if ascii is True.
+
+    """
+    if category.isupper():
+        return complement_ranges(category_ranges(category.lower(), ascii))
+    try:
+        return _category_ranges[category, ascii]
+    except KeyError:
+        pass
+    if ascii:
+        predicate = _byte_category_predicates[category]
+        codes = range(256)
+    else:
+        character_predicate = _category_predicates[category]
+        predicate = lambda code: character_predicate(chr(code))
+        codes = range(MAX_CODE_POINT + 1)
+    ranges = []
+    start = None
+    for code in codes:
+        if predicate(code):
+            if start is None:
+                start = code
+        elif start is not None:
+            ranges.append((start, code - 1))
+            start = None
+    if start is not None:
+        ranges.append((start, codes[-1]))
+    result = _category_ranges[category, ascii] = tuple(ranges)
+    return result
+
+
+class CharacterSet:
+    """An immutable set of characters.
+
+    Membership of ASCII characters is looked up in a 128 bit integer;
+    all other code points are found with a binary search over the
+    sorted start points of the ranges above ASCII. Members can be
+    tested as single characters or, for bytes subjects, as integer byte
+    values.
+
+    Use CharacterSet.get() instead of the constructor: equal sets are
+    interned, so all compiled patterns share a single instance of,
+    for example, \\d or [a-z].
+
+    """
+
+    _instances = weakref.WeakValueDictionary()
+
+    @classmethod
+    def get(cls, ranges, negated=False):
+        """Return the interned set of all characters in ranges, or of
+        all characters not in ranges if negated is True."""
+        ranges = normalize_ranges(ranges)
+        key = (ranges, negated)
+        instance = cls._instances.get(key)
+        if instance is None:
+            instance = cls._instances[key] = cls(ranges, negated)
+        return instance
+
+    def __init__(self, ranges, negated=False):
+        self.ranges = ranges
+        self.negated = negated
+
+        self._ascii = 0
+        self._starts = []
+        self._ends = []
+        for first, last in ranges:
+            for code in range(first, min(last, 127) + 1):
+                self._ascii |= 1 << code
+            if last > 127:
+                self._starts.append(max(first, 128))
+                self._ends.append(last)
+
+    def __reduce__(self):
+        # Unpickled sets are interned like all others.
+        return (CharacterSet.get, (self.ranges, self.negated))
+
+    def __contains__(self, character):
+        # Subjects of bytes patterns yield integer byte values.
+        code = character if type(character) is int else ord(character)
+        if code < 128:
+            found = self._ascii >> code & 1
+        else:
+            i = bisect_right(self._starts, code) - 1
+            found = i >= 0 and code <= self._ends[i]
+        return bool(found) != self.negated
+
+    def __repr__(self):
+        return "<cre.CharacterSet %s%r>" % ("^" if self.negated else "",
+                                            self.ranges)
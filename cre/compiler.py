@@ -0,0 +1,332 @@
+from .expression import *
+
+
+# Instruction opcodes. Every instruction is a tuple whose first item is
+# the opcode; the remaining items are the operands listed here.
+CHAR = 0        # (CHAR, character)
+RANGE = 1       # (RANGE, first, last)
+SPLIT = 2       # (SPLIT, preferred target, alternative target)
+JMP = 3         # (JMP, target)
+SAVE_START = 4  # (SAVE_START, slot)
+SAVE_END = 5    # (SAVE_END, slot)
+COMMIT = 6      # (COMMIT, slot)
+MATCH = 7       # (MATCH,)
+MARK = 8        # (MARK, loop)
+LOOP = 9        # (LOOP, loop, target)
+BACKREF = 10    # (BACKREF, slot)
+CLASS = 11      # (CLASS, character set)
+SWITCH = 12     # (SWITCH, {character: target})
+
+OPCODE_NAMES = ("CHAR", "RANGE", "SPLIT", "JMP", "SAVE_START", "SAVE_END",
+                "COMMIT", "MATCH", "MARK", "LOOP", "BACKREF", "CLASS",
+                "SWITCH")
+
+
+class Program:
+    """A compiled expression tree.
+
+    The instructions describe a nondeterministic automaton in the
+    style of Thompson's construction. Capturing expressions are
+    assigned a slot each; slot_names maps every slot back to the names
+    of the expression.
+
+    Optional repetitions are numbered as well. MARK notes that the
+    current repetition hasn't consumed any characters yet, and LOOP
+    continues with the next repetition only if the current one did
+    consume characters. Like in the builtin re module, a repetition
+    beyond min_repetitions that matches the empty string ends the
+    repetition.
+
+    Capturing follows the semantics of the expression tree: every
+    repetition of a named expression stores its span in the pending
+    register of its slot with SAVE_START and SAVE_END, and once the
+    expression is left, COMMIT appends the pending span (the last
+    repetition) to the results.
+
+    slot_groups maps every slot to the group number among its names,
+    or None for expressions that only have string names; group_count
+    is one more than the highest group number.
+
+    """
+
+    def __init__(self, instructions, slot_names, loop_count=0):
+        self.instructions = tuple(instructions)
+        self.slot_names = tuple(slot_names)
+        self.loop_count = loop_count
+        self.slot_groups = tuple(
+            next((n for n in names if type(n) is int), None)
+            for names in self.slot_names)
+        self.group_count = 1 + max((g for g in self.slot_groups
+                                    if g is not None), default=-1)
+
+    def dump(self):
+        """Return a human readable listing of the instructions."""
+        lines = []
+        for pc, instruction in enumerate(self.instructions):
+            lines.append("%4d %s %s" % (
+                pc, OPCODE_NAMES[instruction[0]],
+                " ".join(map(repr, instruction[1:]))))
+        return "\n".join(lines)
+
+    def __len__(self):
+        return len(self.instructions)
+
+
+class ProgramTooLarge(Exception):
+    """Raised when compiling an expression tree would unroll more than
+    ProgramCompiler.max_instructions instructions."""
+
+
+class ProgramCompiler:
+    """Translate an expression tree into a Program.
+
+    Repetitions are unrolled: an expression with min_repetitions m and
+    max_repetitions n is emitted m times, followed by n - m optional
+    copies, or by a loop if n is infinite. Unrolling multiplies across
+    nested counted repetitions, so a short pattern like
+    ((a{0,60}){0,60}){0,60} would need millions of instructions. The
+    instructions of every copy after the first are therefore counted,
+    and once more than max_instructions were unrolled, ProgramTooLarge
+    is raised. The first copy of every expression only grows with the
+    pattern and isn't limited.
+
+    The options of a LiteralAlternationExpression are emitted as a
+    trie: every node consumes the next character with a single SWITCH
+    (or CHAR, if it has only one child) that jumps to the code of the
+    child, so following the trie takes one instruction per character
+    instead of one SPLIT per option. The option that ends at a node
+    may have a lower priority than some options that pass through it
+    and a higher one than others; the node then splits between the
+    children of the options that come first, the end of its own
+    option and the children of the options that come after it, in
+    this order.
+
+    A trie grows only with the length of the options, so outside of
+    unrolled copies it doesn't count toward max_instructions: word
+    lists of tens of thousands of options still compile.
+
+    """
+
+    # The default for max_instructions; None removes the limit.
+    MAX_INSTRUCTIONS = 100000
+
+    def __init__(self, max_instructions=MAX_INSTRUCTIONS):
+        self.max_instructions = max_instructions
+        self._instructions = []
+        self._slot_names = []
+        self._slots = {}
+        self._loop_count = 0
+        # How many copies are being emitted beyond the first, and how
+        # many instructions were emitted in them.
+        self._unrolling = 0
+        self._unrolled = 0
+
+    def compile(self, expression):
+        self._instructions = []
+        self._slot_names = []
+        self._slots = {}
+        self._loop_count = 0
+        self._unrolling = 0
+        self._unrolled = 0
+        self._emit_expression(expression)
+        self._emit(MATCH)
+        self._resolve_backreferences()
+        return Program(self._instructions, self._slot_names,
+                       self._loop_count)
+
+    def _emit(self, *instruction):
+        if self._unrolling:
+            self._unrolled += 1
+            if (self.max_instructions is not None
+                    and self._unrolled > self.max_instructions):
+                raise ProgramTooLarge(
+                    "The repetitions of the pattern unroll to more than "
+                    "%d instructions." % self.max_instructions)
+        self._instructions.append(instruction)
+        return len(self._instructions) - 1
+
+    def _patch(self, pc, *instruction):
+        self._instructions[pc] = instruction
+
+    def _emit_expression(self, expression):
+        """Emit all repetitions of expression, including capturing."""
+        slot = None
+        if expression._names is not None:
+            # Unrolled repetitions of a parent emit the same expression
+            # several times; all copies share one slot.
+            slot = self._slots.get(id(expression))
+            if slot is None:
+                slot = self._slots[id(expression)] = len(self._slot_names)
+                self._slot_names.append(expression._names)
+
+        copies = 0
+
+        def __emit_repetition():
+            nonlocal copies
+            if copies:
+                self._unrolling += 1
+            if slot is not None:
+                self._emit(SAVE_START, slot)
+            self._emit_body(expression)
+            if slot is not None:
+                self._emit(SAVE_END, slot)
+            if copies:
+                self._unrolling -= 1
+            copies += 1
+
+        minimum = expression._min_repetitions
+        maximum = expression._max_repetitions
+        for _ in range(minimum):
+            __emit_repetition()
+
+        if maximum == float("inf"):
+            # L1: SPLIT L2, L3; L2: MARK n; body; LOOP n, L1; L3:
+            loop = self._loop_count
+            self._loop_count += 1
+            split = self._emit(SPLIT, None, None)
+            self._emit(MARK, loop)
+            __emit_repetition()
+            self._emit(LOOP, loop, split)
+            self._patch_split(split, expression._greedy)
+        elif maximum > minimum:
+            # SPLIT L1, end; L1: MARK n; body; LOOP n, L2; JMP end; L2: ...
+            loop = self._loop_count
+            self._loop_count += 1
+            splits, jumps = [], []
+            for _ in range(maximum - minimum):
+                splits.append(self._emit(SPLIT, None, None))
+                self._emit(MARK, loop)
+                __emit_repetition()
+                self._emit(LOOP, loop, len(self._instructions) + 2)
+                jumps.append(self._emit(JMP, None))
+            for split in splits:
+                self._patch_split(split, expression._greedy)
+            for jump in jumps:
+                self._patch(jump, JMP, len(self._instructions))
+
+        if slot is not None:
+            self._emit(COMMIT, slot)
+
+    def _resolve_backreferences(self):
+        """Replace the group names in BACKREF instructions with slots.
+
+        This is done after all expressions were emitted because a back
+        reference may precede the group it refers to.
+
+        """
+        for pc, instruction in enumerate(self._instructions):
+            if instruction[0] != BACKREF:
+                continue
+            for slot, names in enumerate(self._slot_names):
+                if instruction[1] in names:
+                    self._patch(pc, BACKREF, slot)
+                    break
+            else:
+                raise Exception("Back reference to unknown group %r."
+                                % (instruction[1],))
+
+    def _patch_split(self, split, greedy):
+        """Let split choose between the following instruction and the
+        end of the current instruction list."""
+        body, end = split + 1, len(self._instructions)
+        if greedy:
+            self._patch(split, SPLIT, body, end)
+        else:
+            self._patch(split, SPLIT, end, body)
+
+    def _emit_body(self, expression):
+        """Emit a single repetition of expression."""
+        if isinstance(expression, CharacterExpression):
+            self._emit(CHAR, expression._char)
+        elif (isinstance(expression, CharacterRunExpression)
+                and expression._char is not None):
+            self._emit(CHAR, expression._char)
+        elif isinstance(expression, LiteralExpression):
+            for character in expression._literal:
+                self._emit(CHAR, character)
+        elif isinstance(expression, CharacterRangeExpression):
+            self._emit(RANGE, expression._start, expression._end)
+        elif isinstance(expression, CharacterClassExpression):
+            self._emit(CLASS, expression._set)
+        elif isinstance(expression, GroupExpression):
+            for child in expression._children:
+                self._emit_expression(child)
+        elif isinstance(expression, LiteralAlternationExpression):
+            exits = []
+            self._emit_trie_node(_trie_options(expression), exits)
+            for jump in exits:
+                self._patch(jump, JMP, len(self._instructions))
+        elif isinstance(expression, AnyOfOptionsExpression):
+            # SPLIT L1, S2; L1: option 1; JMP end; S2: SPLIT L2, L3 ...
+            jumps = []
+            for child in expression._children[:-1]:
+                split = self._emit(SPLIT, None, None)
+                self._emit_expression(child)
+                jumps.append(self._emit(JMP, None))
+                self._patch(split, SPLIT, split + 1, len(self._instructions))
+            self._emit_expression(expression._children[-1])
+            for jump in jumps:
+                self._patch(jump, JMP, len(self._instructions))
+        elif isinstance(expression, BackReferenceExpression):
+            self._emit(BACKREF, expression._reference)
+        else:
+            raise Exception("%s can't be compiled into a program."
+                            % type(expression).__name__)
+
+    def _emit_trie_node(self, options, exits):
+        """Emit the trie node of options, a list of (index, rest)
+        pairs: the rest of the literal of every option that passes
+        through the node, sorted by index. The JMPs that leave the trie
+        are appended to exits."""
+        end = next((i for i, rest in options if not rest), None)
+        options = [(i, rest) for i, rest in options if rest]
+        branches = []
+        if end is None:
+            branches.append(options)
+        else:
+            branches.append([o for o in options if o[0] < end])
+            branches.append(None)
+            branches.append([o for o in options if o[0] > end])
+        branches = [b for b in branches if b is None or b]
+        for i, branch in enumerate(branches):
+            split = None
+            if i < len(branches) - 1:
+                split = self._emit(SPLIT, None, None)
+            if branch is None:
+                exits.append(self._emit(JMP, None))
+            else:
+                self._emit_trie_children(branch, exits)
+            if split is not None:
+                self._patch(split, SPLIT, split + 1, len(self._instructions))
+
+    def _emit_trie_children(self, options, exits):
+        """Consume the first character of the rest of options and
+        continue with the trie node of that character."""
+        children = {}
+        for index, rest in options:
+            children.setdefault(rest[0], []).append((index, rest[1:]))
+        if len(children) == 1:
+            character, child = children.popitem()
+            self._emit(CHAR, character)
+            self._emit_trie_node(child, exits)
+            return
+        table = {}
+        self._emit(SWITCH, table)
+        for character, child in children.items():
+            table[character] = len(self._instructions)
+            self._emit_trie_node(child, exits)
+
+
+def _trie_options(expression):
+    """Return the (index, literal) pairs of the options in the trie of
+    the LiteralAlternationExpression expression, sorted by index."""
+    options = []
+    stack = [((), expression._trie)]
+    while stack:
+        literal, node = stack.pop()
+        for character, child in node.items():
+            if character is expression.END:
+                options.append((child, literal))
+            else:
+                stack.append((literal + (character,), child))
+    return sorted(options)
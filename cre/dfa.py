@@ -0,0 +1,299 @@
+from .compiler import *
+
+
+class DFAState:
+    """A set of program counters the NFA can be in at once.
+
+    pcs holds the consuming instructions (CHAR, RANGE, CLASS, SWITCH,
+    BACKREF) and MATCH that are reachable without consuming another character.
+    transitions caches the following state for every character that
+    was looked up so far.
+
+    """
+
+    def __init__(self, pcs, accepting):
+        self.pcs = pcs
+        self.accepting = accepting
+        self.transitions = {}
+
+
+class LazyDFA:
+    """Answer match/no-match queries for a Program without captures.
+
+    The deterministic automaton is built lazily by subset construction:
+    a state is only created once a subject actually leads to it. Every
+    state costs memory, so the number of cached bytes is bounded by
+    max_cache_bytes. When the limit is reached, the whole cache is
+    dropped and rebuilt from the current state on. If that happens
+    before the cache paid off (see min_characters_per_state), test()
+    gives up and returns None, and the caller should use an engine
+    that doesn't need the cache.
+
+    Captures, priorities and the empty repetition rule of LOOP don't
+    change whether the program matches, so they are ignored here. A
+    back reference can't be decided without captures; BACKREF is
+    treated as if it matched any string, so for programs with back
+    references, a True result only means that a match is possible.
+
+    The cache is shared by all callers. States are never modified after
+    they were created, except for adding transitions, so concurrent
+    lookups at worst build the same state twice.
+
+    """
+
+    # Rough size estimates of the cached objects, in bytes.
+    STATE_SIZE = 400
+    PC_SIZE = 8
+    TRANSITION_SIZE = 100
+
+    def __init__(self, program, max_cache_bytes=1 << 20,
+                 min_characters_per_state=10):
+        self._program = program
+        self._max_cache_bytes = max_cache_bytes
+        self._min_characters_per_state = min_characters_per_state
+        self._states = {}
+        self._cache_bytes = 0
+        self.cache_resets = 0
+        self._start = None
+        # The program counters the automaton starts at.
+        self._entries = (0,)
+
+    def test(self, subject, pos=0, endpos=None):
+        """Return whether the program matches subject[pos:endpos] at
+        pos, or None if the state cache thrashes."""
+        state = self._start
+        if state is None:
+            state = self._start = self._state(self._closure(self._entries))
+        end = len(subject) if endpos is None else min(endpos, len(subject))
+        position = pos
+        # Position at which the cache was reset the last time, and the
+        # number of states created since then.
+        reset_position = pos
+        created = 0
+        while not state.accepting:
+            if position >= end or not state.pcs:
+                return False
+            character = subject[position]
+            following = state.transitions.get(character)
+            if following is None:
+                if self._cache_bytes >= self._max_cache_bytes:
+                    characters = position - reset_position
+                    if characters < created * self._min_characters_per_state:
+                        return None
+                    self.reset()
+                    reset_position = position
+                    created = 0
+                following = self._step(state, character)
+                created += 1
+            state = following
+            position += 1
+        return True
+
+    def reset(self):
+        """Drop all cached states."""
+        self._states = {}
+        self._cache_bytes = 0
+        self._start = None
+        self.cache_resets += 1
+
+    @property
+    def state_count(self):
+        return len(self._states)
+
+    def _step(self, state, character):
+        """Compute and cache the state that follows state on character."""
+        following = self._state(self._advance(state.pcs, character))
+        state.transitions[character] = following
+        self._cache_bytes += self.TRANSITION_SIZE
+        return following
+
+    def _advance(self, pcs, character):
+        """Return the program counters that follow pcs on character."""
+        instructions = self._program.instructions
+        targets = []
+        for pc in pcs:
+            instruction = instructions[pc]
+            if instruction[0] == CHAR:
+                if character == instruction[1]:
+                    targets.append(pc + 1)
+            elif instruction[0] == CLASS:
+                if character in instruction[1]:
+                    targets.append(pc + 1)
+            elif instruction[0] == RANGE:
+                if instruction[1] <= character <= instruction[2]:
+                    targets.append(pc + 1)
+            elif instruction[0] == SWITCH:
+                target = instruction[1].get(character)
+                if target is not None:
+                    targets.append(target)
+            elif instruction[0] == BACKREF:
+                targets.append(pc)
+        return self._closure(targets)
+
+    def _state(self, pcs):
+        """Return the cached state for pcs, creating it if necessary."""
+        state = self._states.get(pcs)
+        if state is None:
+            state = self._states[pcs] = DFAState(pcs, self._accepting(pcs))
+            self._cache_bytes += self.STATE_SIZE + self.PC_SIZE * len(pcs)
+        return state
+
+    def _accepting(self, pcs):
+        """Return whether a state with pcs accepts."""
+        instructions = self._program.instructions
+        return any(instructions[pc][0] == MATCH for pc in pcs)
+
+    def _closure(self, pcs):
+        """Follow all empty transitions from pcs.
+
+        Return the sorted tuple of reachable consuming instructions,
+        including BACKREF.
+
+        """
+        instructions = self._program.instructions
+        reached = set()
+        result = []
+        stack = list(pcs)
+        while stack:
+            pc = stack.pop()
+            if pc in reached:
+                continue
+            reached.add(pc)
+            instruction = instructions[pc]
+            opcode = instruction[0]
+            if opcode == JMP:
+                stack.append(instruction[1])
+            elif opcode == SPLIT:
+                stack.append(instruction[1])
+                stack.append(instruction[2])
+            elif opcode == LOOP:
+                stack.append(instruction[2])
+                stack.append(pc + 1)
+            elif opcode in (CHAR, RANGE, CLASS, SWITCH, MATCH):
+                result.append(pc)
+            elif opcode == BACKREF:
+                # Any string, including the empty one.
+                result.append(pc)
+                stack.append(pc + 1)
+            else:
+                # MARK and the capturing instructions
+                stack.append(pc + 1)
+        return tuple(sorted(result))
+
+
+class MultiDFA(LazyDFA):
+    """A LazyDFA over several programs at once.
+
+    The programs are concatenated into a single one, and every MATCH
+    instruction remembers the index of its program. Instead of
+    stopping at the first accepting state, matching() follows the
+    subject until no program can match anymore and collects the
+    indices of all accepting states on the way, so the subject is read
+    at most once for all programs.
+
+    If unanchored is True, the programs match anywhere in the subject
+    rather than only at its start: a new attempt of every program
+    starts at each position. The entry of all programs together is
+    large, so it isn't part of the states; a state only holds the
+    attempts that started before the current position, and the
+    program counters that follow the entry on a character are cached
+    separately and merged into the following state.
+
+    """
+
+    def __init__(self, programs, unanchored=False, max_cache_bytes=1 << 20,
+                 min_characters_per_state=10):
+        instructions = []
+        starts = []
+        owners = {}
+        for index, program in enumerate(programs):
+            offset = len(instructions)
+            starts.append(offset)
+            for instruction in program.instructions:
+                opcode = instruction[0]
+                if opcode == SPLIT:
+                    instruction = (SPLIT, instruction[1] + offset,
+                                   instruction[2] + offset)
+                elif opcode == JMP:
+                    instruction = (JMP, instruction[1] + offset)
+                elif opcode == LOOP:
+                    instruction = (LOOP, instruction[1],
+                                   instruction[2] + offset)
+                elif opcode == SWITCH:
+                    instruction = (SWITCH, {
+                        character: target + offset
+                        for character, target in instruction[1].items()})
+                elif opcode == MATCH:
+                    owners[len(instructions)] = index
+                instructions.append(instruction)
+        super().__init__(Program(instructions, ()), max_cache_bytes,
+                         min_characters_per_state)
+        self._entries = tuple(starts)
+        self._owners = owners
+        self._count = len(starts)
+        self._unanchored = unanchored
+        self._entry_pcs = self._closure(self._entries)
+        # Program counters that follow the entry, by character.
+        self._entry_follows = {}
+
+    def matching(self, subject, pos=0, endpos=None):
+        """Return the set of the indices of all programs that match
+        subject[pos:endpos] at pos, or anywhere in it if the automaton
+        is unanchored; None if the state cache thrashes."""
+        unanchored = self._unanchored
+        state = self._start
+        if state is None:
+            state = self._start = self._state(
+                () if unanchored else self._entry_pcs)
+        end = len(subject) if endpos is None else min(endpos, len(subject))
+        # Programs that match the empty string match at every position.
+        found = set(self._accepting(self._entry_pcs))
+        position = pos
+        reset_position = pos
+        created = 0
+        while ((unanchored or state.pcs) and position < end
+               and len(found) < self._count):
+            character = subject[position]
+            following = state.transitions.get(character)
+            if following is None:
+                if self._cache_bytes >= self._max_cache_bytes:
+                    characters = position - reset_position
+                    if characters < created * self._min_characters_per_state:
+                        return None
+                    self.reset()
+                    reset_position = position
+                    created = 0
+                following = self._step(state, character)
+                created += 1
+            state = following
+            position += 1
+            if state.accepting:
+                found.update(state.accepting)
+        return found
+
+    def reset(self):
+        """Drop all cached states."""
+        super().reset()
+        self._entry_follows = {}
+
+    def _advance(self, pcs, character):
+        """Return the program counters that follow pcs on character,
+        including the attempts that start before character if the
+        automaton is unanchored."""
+        following = super()._advance(pcs, character)
+        if not self._unanchored:
+            return following
+        entry_follows = self._entry_follows.get(character)
+        if entry_follows is None:
+            entry_follows = super()._advance(self._entry_pcs, character)
+            self._entry_follows[character] = entry_follows
+            self._cache_bytes += (self.TRANSITION_SIZE
+                                  + self.PC_SIZE * len(entry_follows))
+        if not following:
+            return entry_follows
+        return tuple(sorted(set(following).union(entry_follows)))
+
+    def _accepting(self, pcs):
+        """Return the indices of the programs whose MATCH is in pcs."""
+        owners = self._owners
+        return frozenset(owners[pc] for pc in pcs if pc in owners)
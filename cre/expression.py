@@ -1,65 +1,80 @@
 import unicodedata
+from .charset import *
 
-def synchronize_context(fn):
-    """Decorator function that wraps the Expression matching methods.
 
-    If the wrapped expression matches, update the context to store the
-    new match. If it doesn't match, call undo() on the expression to
-    reset both it's internal state and the stored match in the context.
+def occurs_at(subject, start, end, position, endpos=None):
+    """Return whether subject[start:end] occurs in subject at position
+    and ends before endpos.
 
-    todo: This decorator also resets the expression if the matching
-    failed. Find a name for the decorator that includes this behaviour!
+    subject may be any sequence: str and bytes are compared with their
+    startswith() method, other types like memoryview and mmap by
+    comparing the two slices. Only the span start:end is copied, never
+    the rest of the subject.
 
     """
-    def __copykeys(d, k):
-        """Copy key value pairs k from d into a new dict."""
-        return dict(map(lambda x: (x, d[x]), k))
-
-    def wrap_matches(obj, context):
-        if fn(obj, context):
-            if obj._names is not None and obj.has_current_repetition:
-                context.push_match(obj._names, __copykeys(
-                        obj._current_repetition, ("start", "end")))
-            return True
-        if len(obj._current_match):
-            context.progress = obj._current_match[0]["start"]
-        obj._matches.pop()
-        return False
-
-    def wrap_retry(obj, context):
-        if fn(obj, context):
-            if obj._names is not None and obj.has_current_repetition:
-                context.override_match(obj._names, __copykeys(
-                        obj._current_repetition, ("start", "end")))
-            return True
-        obj.undo(context)
+    length = end - start
+    if position + length > (len(subject) if endpos is None else endpos):
         return False
-
-    if fn.__name__ == "matches":
-        return wrap_matches
-    if fn.__name__ == "retry":
-        return wrap_retry
-    raise Exception("synchronize_context only works with "
-                    + "Expression.matches and Expression.retry")
+    startswith = getattr(subject, "startswith", None)
+    if startswith is not None:
+        return startswith(subject[start:end], position)
+    return subject[start:end] == subject[position:position + length]
 
 
 class EvaluationContext:
     """The evaluation context holds information about the current
     parsing state at runtime. This includes the subject, current
-    parsing progress and the results of capturing expressions.
+    parsing progress, the results of capturing expressions and the
+    backtracking state of every expression.
+
+    Expression trees never store state themselves, so a single tree
+    can be evaluated by any number of contexts at the same time.
+
+    Like the pos and endpos arguments of the builtin re module, pos and
+    endpos restrict matching to a window of the subject without
+    copying it. All offsets, including progress, are indices into the
+    whole subject.
+
+    The properties are the public interface of the context; the
+    expressions in this module read and write the underlying slots
+    directly, because they are evaluated once per character.
+
+    Matches of named expressions are recorded on a trail: a flat list
+    that holds four items per match, the evaluation (the list of
+    repetitions in the expression state) that committed it, the names
+    of the expression and the start and end of its last repetition.
+    Committing a match appends an entry, backtracking removes the
+    entries from the end of the trail again. Anonymous expressions
+    never touch the trail.
+
+    If budget is given, every call of matches() and retry() charges a
+    step to that StepBudget.
     """
 
-    def __init__(self, subject):
+    __slots__ = ("_progress", "_subject", "_endpos", "_trail",
+                 "_expression_states", "_budget")
+
+    def __init__(self, subject, pos=0, endpos=None, budget=None):
         # Number of parsed characters; changed by expressions
         # during evaluation
-        self._progress = 0
+        self._progress = pos
 
-        # String that is being parsed
+        # String that is being parsed, and the index at which parsing
+        # has to stop; None stands for the end of the subject.
         self._subject = subject
+        self._endpos = endpos
 
         # Matches of capturing groups; used by BackReferenceExpressions
         # and returned as the result of successful matching operation.
-        self._matches = {}
+        self._trail = []
+
+        # Backtracking state of the evaluated expressions, keyed by the
+        # id of the expression. See Expression.matches() for the
+        # structure of a single state.
+        self._expression_states = {}
+
+        # StepBudget that limits the evaluation, or None.
+        self._budget = budget
 
     @property
     def progress(self):
@@ -73,9 +88,15 @@ class EvaluationContext:
     def subject(self):
         return self._subject
 
+    @property
+    def end(self):
+        if self._endpos is None:
+            return len(self._subject)
+        return min(self._endpos, len(self._subject))
+
     @property
     def remaining_subject(self):
-        return self._subject[self._progress:]
+        return self._subject[self._progress:self.end]
 
     @property
     def current_subject_character(self):
@@ -83,33 +104,75 @@ class EvaluationContext:
 
     @property
     def matches(self):
-        return self._matches
-
-    def push_match(self, names, value):
-        for n in names:
-            self._matches.setdefault(n, []).append(value)
+        """Dict of the matches of all names, in the order in which they
+        were committed, built from the trail."""
+        matches = {}
+        trail = self._trail
+        for i in range(0, len(trail), 4):
+            span = {"start": trail[i + 2], "end": trail[i + 3]}
+            for n in trail[i + 1]:
+                matches.setdefault(n, []).append(span)
+        return matches
+
+    def expression_state(self, expression):
+        """Return the list of match results of expression.
+
+        Each item holds the repetitions of one evaluation of
+        expression, or only its start offset if expression is anonymous
+        and matches exactly once; the last item is the current
+        evaluation.
 
-    def override_match(self, names, value):
-        for n in names:
-            self._matches[n][-1] = value
+        """
+        try:
+            return self._expression_states[id(expression)]
+        except KeyError:
+            state = self._expression_states[id(expression)] = []
+            return state
+
+    def push_match(self, names, evaluation):
+        """Commit the last repetition of evaluation as the match of
+        names. Nothing is committed if evaluation has no repetitions."""
+        if evaluation:
+            span = evaluation[-1]
+            trail = self._trail
+            trail.append(evaluation)
+            trail.append(names)
+            trail.append(span["start"])
+            trail.append(span["end"])
+
+    def pop_match(self, evaluation):
+        """Remove the match committed by evaluation.
+
+        Expressions are undone in the reverse order in which they
+        matched, so the match of evaluation, if it committed one, is
+        always the last entry of the trail.
 
-    def pop_match(self, names):
-        for n in names:
-            self._matches[n].pop()
-            if not len(self._matches[n]):
-                del self._matches[n]
+        """
+        trail = self._trail
+        if len(trail) >= 4 and trail[-4] is evaluation:
+            del trail[-4:]
 
     @property
     def flattened_matches(self):
         return dict(map(lambda x: (x[0], x[1][-1]),
-                        self._matches.items()))
+                        self.matches.items()))
+
+    def _last_match(self, group):
+        """Return the (start, end) span of the last match of group, or
+        None if group didn't match."""
+        trail = self._trail
+        for i in range(len(trail) - 4, -1, -4):
+            if group in trail[i + 1]:
+                return trail[i + 2], trail[i + 3]
+        return None
 
     def get_match_string(self, group):
-        last_result = self.matches[group][-1]
-        return self._subject[last_result["start"]:last_result["end"]]
+        start, end = self._last_match(group)
+        return self._subject[start:end]
 
     def get_match_range(self, group):
-        return self.matches[group][-1]
+        start, end = self._last_match(group)
+        return {"start": start, "end": end}
 
 
 class Expression:
@@ -121,53 +184,94 @@ class Expression:
     Expressions form an object tree that is evaluated recursively. Every
     expression has a method matches() that works on an EvaluationContext
     object and tries to match itself against the contexts subject.
+    All results of the evaluation are stored in the context, which
+    makes the tree itself immutable during matching.
+
+    Expressions are created in large numbers by the parser, so they and
+    all their subclasses declare __slots__ instead of carrying a
+    __dict__.
 
     """
 
+    __slots__ = ("_min_repetitions", "_max_repetitions", "_greedy",
+                 "_names", "_possessive")
+
     def __init__(self, min_repetitions=1, max_repetitions=1,
-                 greedy=True, names=None):
+                 greedy=True, names=None, possessive=False):
         self._min_repetitions = min_repetitions
         self._max_repetitions = max_repetitions
         self._greedy = greedy
         self._names = tuple(names) if names is not None else None
-        self._matches = []
+        # A possessive expression never gives back repetitions on
+        # retry(); set by the Optimizer where that can't change the
+        # result.
+        self._possessive = possessive
 
-    @property
-    def _current_match(self):
-        return self._matches[-1]
+    def _current_match(self, context):
+        return context.expression_state(self)[-1]
 
-    @property
-    def _current_repetition(self):
-        return self._current_match[-1]
+    def has_current_repetition(self, context):
+        state = context.expression_state(self)
+        return len(state) and (state[-1].__class__ is int
+                               or len(state[-1]))
 
-    @property
-    def has_current_repetition(self):
-        return len(self._matches) and len(self._current_match)
-
-    @synchronize_context
     def matches(self, context):
         """Check whether the expression matches in the assigned context.
 
-        Add every match result to self._matches for later use and update
-        the context progress.
-        Return True if the expression matches, else False.
+        Add every match result to the expression state in the context
+        for later use and update the context progress. If the
+        expression is named, commit its last repetition to the context.
+        Return True if the expression matches, else False; in that case
+        the context is left as it was.
+
+        Anonymous expressions that match exactly once are by far the
+        most frequent ones, and they can't give back a repetition on
+        retry(). Their state is only the start offset of that
+        repetition, so matching them allocates neither a list nor a
+        span dict.
 
         """
-        self._matches.append([])
+        if context._budget is not None:
+            context._budget.charge()
+        # The subject doesn't change during matching, so its end is
+        # only computed once; progress is read from the slot.
+        end = context.end
+        if (self._names is None and self._min_repetitions == 1
+                and self._max_repetitions == 1):
+            start = context._progress
+            if start >= end:
+                return False
+            match_end = self._match_end(context)
+            if match_end is None:
+                return False
+            context.expression_state(self).append(start)
+            context._progress = match_end
+            return True
+
+        state = context.expression_state(self)
+        current_match = []
+        state.append(current_match)
         upper_limit = (self._min_repetitions,
                        self._max_repetitions)[self._greedy]
 
-        while (context.progress < len(context.subject)
-               and len(self._current_match) < upper_limit):
-            match = self._matches_once(context)
-            if match is None:
+        match_end = self._match_end
+        while context._progress < end and len(current_match) < upper_limit:
+            position = match_end(context)
+            if position is None:
                 break
-            self._current_match.append(match)
-            context.progress = match["end"]
+            current_match.append({"start": context._progress,
+                                  "end": position})
+            context._progress = position
 
-        return self._min_repetitions <= len(self._current_match)
+        if self._min_repetitions <= len(current_match):
+            if self._names is not None:
+                context.push_match(self._names, current_match)
+            return True
+        if current_match:
+            context._progress = current_match[0]["start"]
+        state.pop()
+        return False
 
-    @synchronize_context
     def retry(self, context):
         """Reevaluate the expression to the next repetition count.
 
@@ -181,49 +285,117 @@ class Expression:
         subject during reevaluation.
         if the expression is nongreedy, it matches as few characters as
         possible during the initial evaluation and we consume additional
-        parts of the subject during reevaluation.
+        parts of the subject during reevaluation. A possessive
+        expression never frees anything, so its reevaluation fails.
 
         Return True if reevaluation was successful and the new
         repetition count is valid or False if the reevaluation
         failed, for example because it overflowed the repetition
         limits.
 
+        The match of a named expression is taken back before _retry()
+        runs, which keeps the trail in order for the children, and
+        committed again if _retry() succeeds. If it fails, the
+        expression is undone.
+
         """
-        if (len(self._current_match) == (self._max_repetitions,
-                                         self._min_repetitions)[self._greedy]):
+        if context._budget is not None:
+            context._budget.charge()
+        current_match = context.expression_state(self)[-1]
+        if self._names is None:
+            if self._retry(context, current_match):
+                return True
+        else:
+            context.pop_match(current_match)
+            if self._retry(context, current_match):
+                context.push_match(self._names, current_match)
+                return True
+        self.undo(context)
+        return False
+
+    def _retry(self, context, current_match):
+        """Perform the iteration step of retry() on current_match, the
+        current evaluation of the expression."""
+        if current_match.__class__ is int:
+            # Anonymous and matched exactly once; see matches().
+            return False
+        if (len(current_match) == (self._max_repetitions,
+                                   self._min_repetitions)[self._greedy]):
             return False
 
         if self._greedy:
-            context.progress = self._current_match.pop()["start"]
+            if self._possessive:
+                return False
+            context._progress = current_match.pop()["start"]
+        elif context._progress >= context.end:
+            return False
         else:
-            match = self._matches_once(context)
-            if match is not None:
-                self._current_match.append(match)
-                context.progress = match["end"]
-            else:
+            position = self._match_end(context)
+            if position is None:
                 return False
+            current_match.append({"start": context._progress,
+                                  "end": position})
+            context._progress = position
         return True
 
     def undo(self, context):
-        """Undo the last match with all repetitions."""
-        if len(self._current_match):
-            context.progress = self._current_match[0]["start"]
-        if self._names is not None:
-            context.pop_match(self._names)
-        self._matches.pop()
+        """Undo the last match with all repetitions.
 
-    def _matches_once(self, context):
+        Subclasses that undo their children have to call pop_match()
+        before they do, because the match of the expression itself was
+        committed after the matches of its children.
+
+        """
+        state = context.expression_state(self)
+        current_match = state[-1]
+        if current_match.__class__ is int:
+            context._progress = current_match
+        elif len(current_match):
+            context._progress = current_match[0]["start"]
+        if self._names is not None:
+            context.pop_match(current_match)
+        state.pop()
+
+    def walk(self):
+        """Yield this expression and all its descendants, depth first."""
+        yield self
+
+    def dump(self, indent=0):
+        """Return a human readable listing of the tree, one expression
+        per line, with children indented below their parent."""
+        line = "  " * indent + type(self).__name__
+        for detail in (self._dump_operands(), self._repetition_to_string(),
+                       "" if self._names is None
+                       else "names=%r" % (self._names,)):
+            if detail:
+                line += " " + detail
+        return "\n".join([line] + [c.dump(indent + 1)
+                                   for c in getattr(self, "_children", ())])
+
+    def _dump_operands(self):
+        """Helper method for dump(); describe what the expression
+        matches, apart from its children and repetitions."""
+        return ""
+
+    def _match_end(self, context):
         """Evaluate the expression once without modifying state.
 
         Check whether the expression matches the subject inside the
         context beginning at context.progress without evaluating
         repetitions. Return None if the expression did not match, else
-        a dict with keys "start" and "end" pointing to the respective
-        indices in subject.
+        the index in subject where the match ends.
 
         """
         raise NotImplementedError()
 
+    def _matches_once(self, context):
+        """Like _match_end(), but return a dict with keys "start" and
+        "end" pointing to the respective indices in subject."""
+        end = self._match_end(context)
+        if end is None:
+            return None
+        return {"start": context._progress, "end": end}
+
     def _wrap_with_name(self, v):
         """Helper method for __str__; wrap v with name reference."""
         if self._names is None:
@@ -252,82 +424,314 @@ class Expression:
                                 else str(self._max_repetitions))
         if not self._greedy:
             r += "?"
+        elif self._possessive:
+            r += "+"
         return r
 
     def __eq__(self, other):
-        return all(map(lambda x: getattr(self, x) == getattr(other, x),
-                       vars(self)))
+        return all(getattr(self, x) == getattr(other, x)
+                   for x in _all_slots(type(self)))
+
+    def __getstate__(self):
+        # A tuple of the slot values is much smaller when pickled than
+        # the default dict of slot names and values.
+        return tuple(getattr(self, x) for x in _all_slots(type(self)))
+
+    def __setstate__(self, state):
+        for name, value in zip(_all_slots(type(self)), state):
+            object.__setattr__(self, name, value)
+
+
+def _all_slots(cls, _cache={}):
+    """Return the names of the slots of cls and all its base classes."""
+    try:
+        return _cache[cls]
+    except KeyError:
+        slots = _cache[cls] = tuple(x for base in cls.__mro__
+                                    for x in getattr(base, "__slots__", ()))
+        return slots
 
 
 class CharacterExpression(Expression):
-    """Represents a single character."""
+    """Represents a single character.
+
+    Expressions parsed from bytes patterns store the integer value of
+    the byte, which is what indexing a bytes-like subject returns.
+
+    """
+
+    __slots__ = ("_char",)
 
     def __init__(self, character, **kwargs):
         super().__init__(**kwargs)
         self._char = character
 
-    def _matches_once(self, context):
-        if context.current_subject_character == self._char:
-            return {"start": context.progress, "end": context.progress + 1}
+    def _match_end(self, context):
+        progress = context._progress
+        if context._subject[progress] == self._char:
+            return progress + 1
         return None
 
+    def _dump_operands(self):
+        return repr(self._char)
+
+    def __str__(self):
+        char = self._char if type(self._char) is str else chr(self._char)
+        return self._wrap_with_name(char) + self._repetition_to_string()
+
+
+class LiteralExpression(Expression):
+    """Represents a run of fixed characters, like "abc".
+
+    The Optimizer merges consecutive CharacterExpressions into a
+    literal, which is matched with a single startswith() call instead
+    of one expression per character. Literals of bytes patterns are
+    bytes.
+
+    """
+
+    __slots__ = ("_literal",)
+
+    def __init__(self, literal, **kwargs):
+        super().__init__(**kwargs)
+        self._literal = literal
+
+    def _match_end(self, context):
+        progress = context._progress
+        literal = self._literal
+        end = progress + len(literal)
+        if end > context.end:
+            return None
+        subject = context._subject
+        startswith = getattr(subject, "startswith", None)
+        if startswith is not None:
+            if not startswith(literal, progress):
+                return None
+        elif subject[progress:end] != literal:
+            return None
+        return end
+
+    def _dump_operands(self):
+        return repr(self._literal)
+
     def __str__(self):
-        return self._wrap_with_name(self._char) + self._repetition_to_string()
+        literal = self._literal
+        if type(literal) is not str:
+            literal = literal.decode("latin-1")
+        repetition = self._repetition_to_string()
+        if repetition and self._names is None and len(literal) > 1:
+            literal = "(?:%s)" % literal
+        return self._wrap_with_name(literal) + repetition
 
 
 class CharacterRangeExpression(Expression):
-    """Represents a character range, like [a-z].
+    """Represents a single character range, like a-z.
 
-    For a collection of ranges, like [a-zA-Z], multiple range
-    expressions are concatenated in an AnyOfOptionsExpression.
+    The Parser doesn't create range expressions: a character group
+    like [a-z] or [a-zA-Z] becomes a single CharacterClassExpression.
+    They can still be built by hand, and the Optimizer and the
+    compiler handle them like a class of one range.
 
     """
 
+    __slots__ = ("_start", "_end")
+
     def __init__(self, start, end, **kwargs):
         super().__init__(**kwargs)
         self._start = start
         self._end = end
 
-    def _matches_once(self, context):
-        if self._start <= context.current_subject_character <= self._end:
-            return {"start": context.progress, "end": context.progress + 1}
+    def _match_end(self, context):
+        progress = context._progress
+        if self._start <= context._subject[progress] <= self._end:
+            return progress + 1
         return None
 
+    def _dump_operands(self):
+        return "%r-%r" % (self._start, self._end)
+
     def __str__(self):
         return (self._wrap_with_name("[%s-%s]" % (self._start, self._end))
                 + self._repetition_to_string())
 
 
+class CharacterClassExpression(Expression):
+    """Represents a character class, like [a-z_], [^0-9] or \\w.
+
+    The characters are stored in an interned CharacterSet, so a single
+    membership test replaces the alternatives of an
+    AnyOfOptionsExpression. source is the pattern substring the class
+    was parsed from; it is only used by __str__.
+
+    """
+
+    __slots__ = ("_set", "_source")
+
+    def __init__(self, character_set, source=None, **kwargs):
+        super().__init__(**kwargs)
+        self._set = character_set
+        self._source = source
+
+    def _match_end(self, context):
+        progress = context._progress
+        if context._subject[progress] in self._set:
+            return progress + 1
+        return None
+
+    def _dump_operands(self):
+        return str(CharacterClassExpression(self._set, self._source))
+
+    def __str__(self):
+        source = self._source
+        if source is None:
+            source = "[%s%s]" % ("^" if self._set.negated else "", "".join(
+                "%s-%s" % (chr(first), chr(last)) if first != last
+                else chr(first) for first, last in self._set.ranges))
+        return self._wrap_with_name(source) + self._repetition_to_string()
+
+
+class CharacterRun:
+    """The evaluation of a CharacterRunExpression: count repetitions of
+    a single character each, starting at start.
+
+    It stands in for the list of repetitions other expressions store:
+    len() is the number of repetitions, and indexing returns the
+    {"start", "end"} dict of a single repetition, which is only created
+    when it is looked at.
+
+    """
+
+    __slots__ = ("start", "count")
+
+    def __init__(self, start, count):
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("repetition index out of range")
+        return {"start": self.start + index, "end": self.start + index + 1}
+
+
+class CharacterRunExpression(CharacterClassExpression):
+    """Represents a single character, range or class that is repeated
+    without an upper limit, like "a*", "[a-z]+" or "\\s*".
+
+    The Optimizer replaces such expressions by this one. It scans the
+    whole run in one loop and stores its evaluation as a CharacterRun,
+    so a repetition costs neither a call of _match_end() nor a dict,
+    and retry() only changes the count. char is the character if the
+    run was a CharacterExpression, else None.
+
+    """
+
+    __slots__ = ("_char",)
+
+    def __init__(self, character_set, source=None, char=None, **kwargs):
+        super().__init__(character_set, source, **kwargs)
+        self._char = char
+
+    def matches(self, context):
+        """Match as many characters as possible if the expression is
+        greedy, else as few as possible."""
+        if context._budget is not None:
+            context._budget.charge()
+        start = context._progress
+        limit = context.end
+        minimum = self._min_repetitions
+        if self._greedy:
+            if self._max_repetitions < limit - start:
+                limit = start + self._max_repetitions
+        elif minimum < limit - start:
+            limit = start + minimum
+        subject = context._subject
+        position = start
+        char = self._char
+        if char is not None:
+            while position < limit and subject[position] == char:
+                position += 1
+        else:
+            contains = self._set.__contains__
+            while position < limit and contains(subject[position]):
+                position += 1
+        if position - start < minimum:
+            return False
+        run = CharacterRun(start, position - start)
+        context.expression_state(self).append(run)
+        context._progress = position
+        if self._names is not None:
+            context.push_match(self._names, run)
+        return True
+
+    def _retry(self, context, run):
+        if self._greedy:
+            if self._possessive or run.count == self._min_repetitions:
+                return False
+            run.count -= 1
+        else:
+            position = run.start + run.count
+            if (run.count == self._max_repetitions
+                    or position >= context.end
+                    or context._subject[position] not in self._set):
+                return False
+            run.count += 1
+        context._progress = run.start + run.count
+        return True
+
+
 class AbstractIteratorExpression(Expression):
     """"""
 
+    __slots__ = ("_children",)
+
     def __init__(self, children, **kwargs):
         super().__init__(**kwargs)
         self._children = tuple(children)
 
-    @synchronize_context
+    def walk(self):
+        yield self
+        for child in self._children:
+            yield from child.walk()
+
     def matches(self, context):
         """Check whether the expression matches in the assigned context.
         """
-        self._matches.append([])
+        if context._budget is not None:
+            context._budget.charge()
+        state = context.expression_state(self)
+        current_match = []
+        state.append(current_match)
         upper_limit = (self._min_repetitions,
                        self._max_repetitions)[self._greedy]
 
         while True:
-            while len(self._current_match) < upper_limit:
+            while len(current_match) < upper_limit:
                 match = self._matches_once(context)
                 if match is None:
                     break
-                self._current_match.append(match)
-            if len(self._current_match) >= self._min_repetitions:
+                current_match.append(match)
+                if self._ends_repetitions(current_match):
+                    break
+            if len(current_match) >= self._min_repetitions:
+                if self._names is not None:
+                    context.push_match(self._names, current_match)
                 return True
             if not self._reevaluate_previous_repetition(context):
+                if current_match:
+                    context._progress = current_match[0]["start"]
+                state.pop()
                 return False
 
-    @synchronize_context
-    def retry(self, context):
+    def _retry(self, context, current_match):
         """Retry children before adding or removing repetitions."""
-        initial_repetitions = len(self._current_match)
+        initial_repetitions = len(current_match)
+        ended = (initial_repetitions > 0
+                 and self._ends_repetitions(current_match))
 
         if initial_repetitions == 0:
             if self._greedy:
@@ -344,86 +748,243 @@ class AbstractIteratorExpression(Expression):
         # last repetition.
         if (self._greedy):
             for _ in range(0, initial_repetitions - 1):
-                self._current_match.append(self._matches_once(context))
+                current_match.append(self._matches_once(context))
         else:
+            if ended:
+                # Another repetition would only match empty again.
+                return False
             for _ in range(0, initial_repetitions + 1):
                 match = self._matches_once(context)
                 if match is None:
                     return False
-                self._current_match.append(match)
+                current_match.append(match)
         return True
 
+    def _ends_repetitions(self, current_match):
+        """Return whether the last repetition of current_match ends the
+        repetitions: like in the builtin re module, a repetition beyond
+        min_repetitions that matches the empty string does, because the
+        next one would match empty as well."""
+        last = current_match[-1]
+        return (len(current_match) > self._min_repetitions
+                and last["start"] == last["end"])
+
 
 class AnyOfOptionsExpression(AbstractIteratorExpression):
     """Represents a logical-or expression with two or more values.
 
-    This class will be instantiated for
-    the following expression strings:
-    * Two or more expressions concatenated with "|"
-    * Character groups like "[abc]", which will be represented as an
-      option group of  CharacterExpressions or CharacterRangeExpressions
+    The Parser instantiates this class for two or more expressions
+    concatenated with "|". Character groups like "[abc]" become a
+    CharacterClassExpression instead.
 
     """
 
+    __slots__ = ()
+
     def undo(self, context):
         """Undo the children that matched in each repetition."""
-        for m in reversed(self._current_match):
+        current_match = self._current_match(context)
+        if self._names is not None:
+            context.pop_match(current_match)
+        for m in reversed(current_match):
             self._children[m["matching_child"]].undo(context)
         super().undo(context)
 
     def _matches_once(self, context):
         """Evaluate children in order until one matches."""
-        start = context.progress
+        start = context._progress
         for i, c in enumerate(self._children):
             if c.matches(context):
                 return {"start": start,
-                        "end": context.progress,
+                        "end": context._progress,
                         "matching_child": i}
         return None
 
     def _reevaluate_previous_repetition(self, context):
-        """"""
-        if not len(self._current_match):
+        """Find the next match of the last repetition: retry the child
+        that matched it, then try the children that follow it. If none
+        of them matches, reevaluate the repetition before and try all
+        children again."""
+        current_match = self._current_match(context)
+        if not len(current_match):
             return False
-        self._current_match.pop()
-
-        current_child_index = self._current_repetition["matching_child"]
-        child = self._children[current_child_index]
-        start = end = context.progress
+        repetition = current_match.pop()
 
-        if child.retry(context):
-            if child.has_current_repetition:
-                start = child._current_repetition["start"]
-                end = child._current_repetition["end"]
-            self._current_match.append({"start": start, "end": end})
+        current_child_index = repetition["matching_child"]
+        if self._children[current_child_index].retry(context):
+            current_match.append({"start": repetition["start"],
+                                  "end": context._progress,
+                                  "matching_child": current_child_index})
             return True
 
         start_child_iteration = current_child_index + 1
         while True:
+            start = context._progress
             for i in range(start_child_iteration, len(self._children)):
-                child = self._children[i]
-                if child.matches(context):
-                    if child.has_current_repetition:
-                        start = child._current_repetition["start"]
-                        end = child._current_repetition["end"]
-                    self._current_match.append({"start": start, "end": end})
+                if self._children[i].matches(context):
+                    current_match.append({"start": start,
+                                          "end": context._progress,
+                                          "matching_child": i})
                     return True
             start_child_iteration = 0
             if not self._reevaluate_previous_repetition(context):
                 return False
 
 
+class LiteralAlternationExpression(AnyOfOptionsExpression):
+    """An AnyOfOptionsExpression whose options are all literals, like
+    "(GET|POST|PUT)".
+
+    Instead of trying every option in turn, the options are stored in a
+    trie that is followed along the subject: this finds all options
+    that occur at the current position in time proportional to the
+    length of the longest one, however many options there are. Options
+    are still chosen leftmost-first: a repetition matches the first
+    option that occurs, and reevaluating it continues with the next
+    one, like in AnyOfOptionsExpression. matching_child is the index of
+    the matched option.
+
+    The children are kept for everything but matching; they are never
+    evaluated themselves. Options that are a duplicate of an earlier
+    one can't lead to a different match and are left out of the trie.
+
+    """
+
+    __slots__ = ("_trie", "_lengths")
+
+    # Key of the option index in the node of the trie where it ends.
+    END = None
+
+    def __init__(self, children, literals, **kwargs):
+        super().__init__(children, **kwargs)
+        self._lengths = tuple(len(literal) for literal in literals)
+        self._trie = {}
+        for i, literal in enumerate(literals):
+            node = self._trie
+            for character in literal:
+                node = node.setdefault(character, {})
+            node.setdefault(self.END, i)
+
+    def undo(self, context):
+        """Undo the expression; the children never matched."""
+        Expression.undo(self, context)
+
+    def _occurring_options(self, context, start):
+        """Return the indices of the options that occur at start."""
+        subject = context._subject
+        end = context.end
+        node = self._trie
+        position = start
+        found = []
+        while True:
+            index = node.get(self.END)
+            if index is not None:
+                found.append(index)
+            if position >= end:
+                return found
+            node = node.get(subject[position])
+            if node is None:
+                return found
+            position += 1
+
+    def _match_option(self, context, first):
+        """Match the first occurring option whose index is at least
+        first at the current position, and return the repetition."""
+        start = context._progress
+        indices = [i for i in self._occurring_options(context, start)
+                   if i >= first]
+        if not indices:
+            return None
+        index = min(indices)
+        context._progress = start + self._lengths[index]
+        return {"start": start, "end": context._progress,
+                "matching_child": index}
+
+    def _matches_once(self, context):
+        return self._match_option(context, 0)
+
+    def _dump_operands(self):
+        return "trie of %d options" % len(self._children)
+
+    def _reevaluate_previous_repetition(self, context):
+        """Replace the last repetition by the next option that occurs at
+        its start. If there is none, reevaluate the repetition before
+        and match again from its end."""
+        current_match = self._current_match(context)
+        if not len(current_match):
+            return False
+        repetition = current_match.pop()
+        context._progress = repetition["start"]
+        match = self._match_option(context, repetition["matching_child"] + 1)
+        while match is None:
+            if not self._reevaluate_previous_repetition(context):
+                return False
+            match = self._match_option(context, 0)
+        current_match.append(match)
+        return True
+
+
 class GroupExpression(AbstractIteratorExpression):
-    """Represents and manages a group of expressions, like "(ab|c)". """
+    """Represents and manages a group of expressions, like "(ab|c)".
+
+    Like the anonymous expressions of Expression.matches(), an
+    anonymous group that matches exactly once stores only the start
+    offset of its repetition as its state.
+
+    """
+
+    __slots__ = ()
+
+    def matches(self, context):
+        """Evaluate the children once if the group is anonymous and
+        matches exactly once, else proceed with default behaviour."""
+        if (self._names is not None or self._min_repetitions != 1
+                or self._max_repetitions != 1):
+            return super().matches(context)
+        if context._budget is not None:
+            context._budget.charge()
+        start = context._progress
+        if not self._match_children(context):
+            return False
+        context.expression_state(self).append(start)
+        return True
+
+    def retry(self, context):
+        """Retry the children of an anonymous group that matches exactly
+        once, else proceed with default behaviour."""
+        start = self._current_match(context)
+        if start.__class__ is not int:
+            return super().retry(context)
+        if context._budget is not None:
+            context._budget.charge()
+        if self._retry_children(len(self._children) - 1, context):
+            return True
+        # The children have reverted themselves.
+        context.expression_state(self).pop()
+        context._progress = start
+        return False
 
     def undo(self, context):
         """Undo all children, then proceed with default behaviour."""
-        for _ in self._current_match:
+        current_match = self._current_match(context)
+        if self._names is not None:
+            context.pop_match(current_match)
+        repetitions = (1 if current_match.__class__ is int
+                       else len(current_match))
+        for _ in range(repetitions):
             for c in reversed(self._children):
                 c.undo(context)
         super().undo(context)
 
     def _matches_once(self, context):
+        """Evaluate the children once, see _match_children(), and return
+        the repetition."""
+        start = context._progress
+        if self._match_children(context):
+            return {"start": start, "end": context._progress}
+        return None
+
+    def _match_children(self, context):
         """Execute all child expressions in order.
 
         Iterate recursively over self._children to find a combination
@@ -433,7 +994,8 @@ class GroupExpression(AbstractIteratorExpression):
         reevaluated.
 
         If the expression does not match, the iterative calls to retry
-        will automatically reset the child expressions.
+        will automatically reset the child expressions. Return whether
+        the children match; the repetition ends at context.progress.
 
         """
         def __match_one_child(child):
@@ -451,13 +1013,7 @@ class GroupExpression(AbstractIteratorExpression):
                     return False
             return True
 
-        start = end = context.progress
-        if __match_one_child(0):
-            for c in self._children:
-                if c.has_current_repetition:
-                    end = c._current_repetition["end"]
-            return {"start": start, "end": end}
-        return None
+        return __match_one_child(0)
 
     def _reevaluate_previous_repetition(self, context):
         """Reevaluate child expressions to find the next valid match.
@@ -481,8 +1037,7 @@ class GroupExpression(AbstractIteratorExpression):
         repetition is already completely reversed. All that needs to be
         done now is to pop the last repetition from the group
         expression.
-        This behaviour is encapsulated in the internal function
-        __retry_one_child(child).
+        This behaviour is encapsulated in _retry_children().
 
         But! We're not done yet. The last paragraph just described our
         approach for a single repetition. To find all combinations of
@@ -498,38 +1053,38 @@ class GroupExpression(AbstractIteratorExpression):
 
         This method completely reverts any state if the reevaluation
         fails, including the context progress, the context match
-        reference and self._current_match.
+        reference and the expression state.
 
         """
-        def __retry_one_child(child):
-            if child < 0:
-                return False
-            current = self._children[child]
-            if current.retry(context):
-                return True
-            while __retry_one_child(child - 1):
-                if current.matches(context):
-                    return True
+        current_match = self._current_match(context)
+        if not len(current_match):
             return False
+        repetition = current_match.pop()
 
-        if not len(self._current_match):
-            return False
-        self._current_match.pop()
-
-        if __retry_one_child(len(self._children) - 1):
-            start = end = context.progress
-            for c in self._children:
-                if c.has_current_repetition:
-                    if c._current_repetition["start"] < start:
-                        start = c._current_repetition["start"]
-                    end = c._current_repetition["end"]
-            self._current_match.append({"start": start, "end": end})
+        if self._retry_children(len(self._children) - 1, context):
+            # A reevaluated repetition still starts where it did.
+            current_match.append({"start": repetition["start"],
+                                  "end": context._progress})
             return True
 
         while self._reevaluate_previous_repetition(context):
             result = self._matches_once(context)
             if result is not None:
-                self._current_match.append(result)
+                current_match.append(result)
+                return True
+        return False
+
+    def _retry_children(self, child, context):
+        """Find the next combination of matches of the children up to
+        the index child in the current repetition. Return False if there
+        is none; the children are reverted then."""
+        if child < 0:
+            return False
+        current = self._children[child]
+        if current.retry(context):
+            return True
+        while self._retry_children(child - 1, context):
+            if current.matches(context):
                 return True
         return False
 
@@ -542,16 +1097,25 @@ class GroupExpression(AbstractIteratorExpression):
 class BackReferenceExpression(Expression):
     """"""
 
+    __slots__ = ("_reference",)
+
     def __init__(self, reference, **kwargs):
         super().__init__(**kwargs)
         self._reference = reference
 
-    def _matches_once(self, context):
-        pattern = context.get_match_string(self._reference)
-        if context.remaining_subject.startswith(pattern):
-            return {"start": context.progress,
-                    "end": context.progress + len(pattern)}
+    def _match_end(self, context):
+        span = context._last_match(self._reference)
+        if span is None:
+            # The referenced group didn't participate in the match.
+            return None
+        start, end = span
+        progress = context._progress
+        if occurs_at(context._subject, start, end, progress, context.end):
+            return progress + end - start
         return None
 
+    def _dump_operands(self):
+        return repr(self._reference)
+
     def __str__(self):
         return "(?P=%s)" % self._reference + self._repetition_to_string()
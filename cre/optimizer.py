@@ -0,0 +1,240 @@
+import copy
+from .analysis import *
+
+
+def _literal(expression):
+    """Return the tuple of characters that expression matches if it is
+    an anonymous literal, else None."""
+    if expression._names is not None:
+        return None
+    if expression._min_repetitions != expression._max_repetitions:
+        return None
+    if type(expression) is CharacterExpression:
+        literal = (expression._char,)
+    elif type(expression) is LiteralExpression:
+        literal = tuple(expression._literal)
+    elif type(expression) is GroupExpression:
+        literal = ()
+        for child in expression._children:
+            child_literal = _literal(child)
+            if child_literal is None:
+                return None
+            literal += child_literal
+    else:
+        return None
+    return literal * expression._min_repetitions
+
+
+def _is_plain(expression):
+    """Return whether expression is anonymous and matches exactly once,
+    so it only stands for its contents."""
+    return (expression._names is None
+            and expression._min_repetitions == 1
+            and expression._max_repetitions == 1)
+
+
+def _character_run(expression):
+    """Return a CharacterRunExpression for expression if it repeats a
+    single character, range or class without an upper limit, else
+    expression itself."""
+    if expression._max_repetitions != float("inf"):
+        return expression
+    char = None
+    if type(expression) is CharacterExpression:
+        char = expression._char
+        code = char if type(char) is int else ord(char)
+        character_set = CharacterSet.get(((code, code),))
+        source = chr(code)
+    elif type(expression) is CharacterRangeExpression:
+        first, last = (c if type(c) is int else ord(c)
+                       for c in (expression._start, expression._end))
+        character_set = CharacterSet.get(((first, last),))
+        source = "[%s-%s]" % (chr(first), chr(last))
+    elif type(expression) is CharacterClassExpression:
+        character_set = expression._set
+        source = expression._source
+    else:
+        return expression
+    return CharacterRunExpression(character_set, source, char,
+                                  **Optimizer._repetition(expression))
+
+
+def _fold(outer, inner):
+    """Return the (min, max) repetitions of inner repeated by outer, or
+    None if there is no single equivalent repetition. Both are
+    (min_repetitions, max_repetitions) pairs."""
+    inf = float("inf")
+    if outer[0] == outer[1] and inner[0] == inner[1]:
+        return outer[0] * inner[0], outer[0] * inner[0]
+    # ?, * and + nested in each other: x?+ is x*, x+? is x*, ...
+    if (outer[0] in (0, 1) and inner[0] in (0, 1)
+            and outer[1] in (1, inf) and inner[1] in (1, inf)):
+        return outer[0] * inner[0], outer[1] * inner[1]
+    return None
+
+
+class Optimizer:
+    """Rewrite an expression tree into an equivalent one that is faster
+    to evaluate.
+
+    Trees are never modified; optimize() returns a new tree that shares
+    the subtrees it didn't change. The rewritten tree matches exactly
+    the same strings with the same captures and priorities. The
+    rewrites are:
+
+    * anonymous groups that match exactly once are replaced by their
+      children, inside a group, or by their only child;
+    * runs of single characters in a group are merged into a
+      LiteralExpression;
+    * an anonymous group with a single anonymous child is replaced by
+      the child, repeated by both quantifiers if they fold into one,
+      like "(?:a+)*" into "a*" or "(?:a{2}){3}" into "a{6}";
+    * alternations of literals become LiteralAlternationExpressions;
+    * single characters, ranges and classes that are repeated without
+      an upper limit become CharacterRunExpressions;
+    * greedy repetitions of single characters and literals become
+      possessive if nothing that can follow them starts with a
+      character they can start with, like the "a+" of "a+b" or the
+      "\\s*" of "\\s*x". Giving back a repetition would only let the
+      following expressions start at such a character, where they
+      fail; the end of the pattern follows nothing, so it never
+      prevents possessiveness.
+
+    """
+
+    def optimize(self, expression):
+        """Return the optimized tree of expression."""
+        self._first_sets = FirstSets()
+        return self._possessify(self._rewrite(expression), ())
+
+    def _rewrite(self, expression):
+        """Apply all rewrites but possessiveness."""
+        if isinstance(expression, LiteralAlternationExpression):
+            return expression
+        if isinstance(expression, GroupExpression):
+            return self._optimize_group(expression)
+        if isinstance(expression, AnyOfOptionsExpression):
+            children = tuple(self._rewrite(c) for c in expression._children)
+            literals = [_literal(c) for c in children]
+            if all(literals):
+                return LiteralAlternationExpression(
+                    children, literals, **self._repetition(expression))
+            return self._rebuild(expression, children)
+        return expression
+
+    def _optimize_group(self, group):
+        children = []
+        for child in group._children:
+            child = self._rewrite(child)
+            if type(child) is GroupExpression and _is_plain(child):
+                children.extend(child._children)
+            else:
+                children.append(child)
+        children = self._merge_literals(children)
+
+        if group._names is None and len(children) == 1:
+            child = children[0]
+            if _is_plain(group):
+                return child
+            # A child that can match the empty string may repeat a
+            # different number of times once folded, which changes the
+            # captures of the groups inside it.
+            if child._names is None and not (
+                    self._first_sets.first(child)[1]
+                    and any(e._names is not None for e in child.walk())):
+                repetitions = _fold(
+                    (group._min_repetitions, group._max_repetitions),
+                    (child._min_repetitions, child._max_repetitions))
+                # The greediness of an exact repetition doesn't matter.
+                if (child._min_repetitions != child._max_repetitions
+                        and child._greedy != group._greedy):
+                    repetitions = None
+                if repetitions is not None:
+                    child = copy.copy(child)
+                    child._min_repetitions, child._max_repetitions = (
+                        repetitions)
+                    child._greedy = group._greedy
+                    return child
+        return self._rebuild(group, children)
+
+    def _possessify(self, expression, follow):
+        """Make the repetitions in expression possessive where they can
+        be. follow holds the ranges of the characters that can follow
+        expression."""
+        if isinstance(expression, LiteralAlternationExpression):
+            return expression
+        if isinstance(expression, AbstractIteratorExpression):
+            if expression._max_repetitions > 1:
+                # The next repetition can follow as well.
+                follow = union_ranges(
+                    follow, self._first_sets.first(expression)[0])
+            if isinstance(expression, AnyOfOptionsExpression):
+                children = [self._possessify(c, follow)
+                            for c in expression._children]
+            else:
+                children = []
+                for child in reversed(expression._children):
+                    children.append(self._possessify(child, follow))
+                    ranges, nullable = self._first_sets.first(child)
+                    follow = (union_ranges(ranges, follow) if nullable
+                              else ranges)
+                children.reverse()
+            return self._rebuild(expression, children)
+
+        if (type(expression) in (CharacterExpression, LiteralExpression,
+                                 CharacterRangeExpression,
+                                 CharacterClassExpression)
+                and expression._greedy and not expression._possessive
+                and expression._max_repetitions > expression._min_repetitions
+                and not ranges_overlap(
+                    self._first_sets.first(expression)[0], follow)):
+            expression = copy.copy(expression)
+            expression._possessive = True
+        return _character_run(expression)
+
+    def _merge_literals(self, children):
+        """Merge runs of anonymous single characters and literals in
+        children into LiteralExpressions."""
+        merged = []
+        run = []
+
+        def __flush():
+            if len(run) > 1:
+                literal = [x for c in run for x in _literal(c)]
+                if type(literal[0]) is str:
+                    literal = "".join(literal)
+                else:
+                    literal = bytes(literal)
+                merged.append(LiteralExpression(literal))
+            else:
+                merged.extend(run)
+            run.clear()
+
+        for child in children:
+            if (type(child) in (CharacterExpression, LiteralExpression)
+                    and _is_plain(child)):
+                run.append(child)
+            else:
+                __flush()
+                merged.append(child)
+        __flush()
+        return merged
+
+    def _rebuild(self, expression, children):
+        """Return expression with children, or expression itself if the
+        children didn't change."""
+        if (len(children) == len(expression._children)
+                and all(new is old for new, old
+                        in zip(children, expression._children))):
+            return expression
+        return type(expression)(children, **self._repetition(expression))
+
+    @staticmethod
+    def _repetition(expression):
+        """Return the keyword arguments that recreate the repetition and
+        names of expression."""
+        return {"min_repetitions": expression._min_repetitions,
+                "max_repetitions": expression._max_repetitions,
+                "greedy": expression._greedy,
+                "names": expression._names,
+                "possessive": expression._possessive}
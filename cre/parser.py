@@ -1,226 +1,527 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
 from .expression import *
+from .optimizer import *
+from .regex import *
+
+
+CacheInfo = namedtuple("CacheInfo", ("hits", "misses", "maxsize", "currsize"))
+
+
+class ExpressionCache:
+    """Bounded least-recently-used cache for compiled patterns.
+
+    Entries are kept in access order; once more than maxsize entries
+    are stored, the least recently used ones are evicted. A maxsize of
+    None disables the limit, a maxsize of 0 disables caching.
+
+    Each method holds a lock while it touches the entries, so a cache
+    can be shared by threads.
+
+    """
+
+    def __init__(self, maxsize=512):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, value):
+        with self._lock:
+            self._maxsize = value
+            self._evict()
+
+    def get(self, key):
+        """Return the entry for key and mark it as recently used, or
+        None if the key is not cached."""
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def clear(self):
+        """Drop all entries and reset the hit and miss counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self._maxsize,
+                             len(self._entries))
+
+    def _evict(self):
+        """Drop the least recently used entries; the lock must be
+        held."""
+        if self._maxsize is None:
+            return
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class DiskCache:
+    """Directory of serialized patterns that outlives the process.
+
+    Every pattern is stored in a file of its own, named by a hash of
+    its cache key, so a process only reads the files of the patterns
+    it actually compiles. Files that RegexObject.loads() rejects
+    because they were written in another serialization format or by
+    another version of the library, and files that can't be read or
+    unpickled, are treated like missing entries and replaced. Files
+    are written under a temporary name and then renamed, so processes
+    that share the directory never read a partially written file.
+
+    """
+
+    SUFFIX = ".cre"
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """Return the path of the file that holds the entry for key."""
+        digest = hashlib.sha256(repr(key).encode("utf-8", "surrogatepass"))
+        return os.path.join(self.directory, digest.hexdigest() + self.SUFFIX)
+
+    def get(self, key):
+        """Return the RegexObject stored for key, or None."""
+        try:
+            with open(self.path(key), "rb") as f:
+                regex = RegexObject.loads(f.read())
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError):
+            # Unreadable, truncated, or refers to classes that moved.
+            return None
+        # Guard against hash collisions.
+        if (type(regex.pattern), regex.pattern, regex.flags) != key[:3]:
+            return None
+        return regex
+
+    def put(self, key, regex):
+        """Store regex for key; a cache that can't be written is
+        ignored."""
+        try:
+            fd, temporary = tempfile.mkstemp(self.SUFFIX + ".tmp",
+                                             dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(regex.dumps())
+                os.replace(temporary, self.path(key))
+            except BaseException:
+                os.unlink(temporary)
+                raise
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove all entries."""
+        for name in os.listdir(self.directory):
+            if name.endswith(self.SUFFIX):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
 
 class Parser:
     """The parser creates expression object trees from pattern strings.
+
+    Patterns are read in a single pass by recursive descent. Every
+    _parse_* method consumes one construct at the current position and
+    returns its expressions; the first character of an atom selects
+    the method from _atom_parsers. Each character of the pattern is
+    looked at a constant number of times, so parsing takes time linear
+    in the length of the pattern, and the recursion only goes as deep
+    as the groups are nested.
+
+    Everything a single parse reads and writes is kept in a
+    _ParseState that is passed to the _parse_* methods, so threads can
+    compile patterns with the same Parser at the same time.
+
+    If cache_dir is given, compiled patterns are also stored in a
+    DiskCache in that directory, so other processes can load them
+    instead of compiling them again.
+
     """
 
-    def __init__(self):
-        self._context = None
-        self._stack = []
-        self._group_count = 1
-        self._groupindex = {}
-        self._expression_cache = {}
+    def __init__(self, cache_size=512, cache_dir=None):
+        self._expression_cache = ExpressionCache(cache_size)
+        self._disk_cache = None if cache_dir is None else DiskCache(cache_dir)
 
-    @property
-    def _current_state(self):
-        return self._stack[-1]["state"]
+    def compile(self, pattern, flags=0, engine="auto"):
+        """Return a RegexObject for pattern.
 
-    @property
-    def _current_children(self):
-        return self._stack[-1]["children"]
+        Compiled patterns are cached by (pattern, flags, engine), so
+        compiling the same pattern again only costs a dictionary lookup.
+        Patterns that aren't in memory are looked up in the disk cache,
+        if there is one, before they are parsed. The parsed tree is
+        rewritten by the Optimizer before it is compiled. See
+        cre.regex.ENGINES for the possible values of engine. Unless the
+        engine is "backtrack", ProgramTooLarge is raised if the counted
+        repetitions of the pattern unroll to too many instructions.
 
-    @property
-    def _current(self):
-        return self._stack[-1]
+        """
+        key = (type(pattern), pattern, flags, engine)
+        regex = self._expression_cache.get(key)
+        if regex is None:
+            if self._disk_cache is not None:
+                regex = self._disk_cache.get(key)
+            if regex is None:
+                tree, state = self._parse(pattern)
+                regex = RegexObject(Optimizer().optimize(tree), pattern,
+                                    state.group_count - 1, state.groupindex,
+                                    flags, engine)
+                if self._disk_cache is not None:
+                    self._disk_cache.put(key, regex)
+            self._expression_cache.put(key, regex)
+        return regex
 
     def parse(self, pattern):
-        self._context = EvaluationContext(pattern)
-        self._group_count = 1
-        self._stack.append({"state": "root", "children": []})
+        """Return the expression tree for pattern.
 
-        while self._context.progress < len(pattern):
-            getattr(self, "_parse_" + self._current_state)()
+        bytes patterns are parsed like their latin-1 decoding, but the
+        resulting expressions match integer byte values, so they can
+        be applied to bytes-like subjects without decoding them.
 
-        if len(self._stack) > 1:
-            raise Exception("More expressions opened than closed")
-
-        root = GroupExpression(self._stack.pop()["children"], names=(0,))
-        self._context = None
-        return root
-
-    def _parse_root(self):
-        """Push unknown state on the stack to keep parsing running."""
-        self._stack.append({"state": "unknown"})
-
-    def _parse_unknown(self):
-        """Find the appropriate parse_* method for the next character."""
-        self._stack.pop()
-        char = self._context.current_subject_character
-        new_state = {"\\": {"state": "escaped"},
-                     "(" : {"state": "conjunction",
-                            "children": [],
-                            "first_time_parsing": True},
-                     "[" : {"state": "character_group",
-                            "children": []}
-                    }.get(char, None)
-        if new_state is not None:
-            self._context.progress += 1
-            self._stack.append(new_state)
-
-        elif char in ("]", ")"):
-            raise Exception("The character '%s' at position %s closes "
-                            + "a group which was never opened."
-                            % (char, self._context.progress))
-
-        elif char == "|":
-            if not len(self._current_children):
-                raise Exception("The character '|' at position %s creates a "
-                                + "disjunction, but the left expression is "
-                                + "missing." % self._context.progress)
-            self._context.progress += 1
-            self._stack.append({"state": "disjunction",
-                                "children": [self._current_children.pop()]})
-            self._stack.append({"state": "unknown"})
-
-        else:
-            self._stack.append({"state": "character"})
-
-    def _parse_character(self):
+        """
+        return self._parse(pattern)[0]
+
+    def _parse(self, pattern):
+        """Return the expression tree for pattern and the _ParseState
+        that parsed it."""
+        binary = not isinstance(pattern, str)
+        if binary:
+            pattern = bytes(pattern).decode("latin-1")
+        state = _ParseState(pattern, binary)
+        children = self._parse_alternation(state)
+        if state.context._progress < len(pattern):
+            # Only an unmatched ")" ends the alternation early.
+            self._parse_unopened(state)
+        return GroupExpression(children, names=(0,)), state
+
+    def _parse_alternation(self, state):
+        """Parse options separated by "|" up to the next ")" or the end
+        of the pattern. Return the children of the group that holds
+        them: the children of the only option, or an
+        AnyOfOptionsExpression with an expression for every option."""
+        context = state.context
+        pattern = context._subject
+        options = [self._parse_sequence(state)]
+        while (context._progress < len(pattern)
+               and pattern[context._progress] == "|"):
+            context._progress += 1
+            options.append(self._parse_sequence(state))
+        if len(options) == 1:
+            return options[0]
+        return [AnyOfOptionsExpression(
+            option[0] if len(option) == 1 else GroupExpression(option)
+            for option in options)]
+
+    def _parse_sequence(self, state):
+        """Parse atoms up to the next "|", ")" or the end of the
+        pattern, and return their expressions."""
+        context = state.context
+        pattern = context._subject
+        length = len(pattern)
+        atom_parsers = self._atom_parsers
+        children = []
+        while context._progress < length:
+            char = pattern[context._progress]
+            if char == "|" or char == ")":
+                break
+            children.append(atom_parsers.get(char, Parser._parse_character)(
+                self, state))
+        return children
+
+    def _parse_character(self, state):
         """Parse the next character as CharacterExpression."""
-        args = {"character": self._context.current_subject_character}
-        self._context.progress += 1
-        args.update(self._resolve_repetitions())
-        self._stack.pop()
-        self._current_children.append(CharacterExpression(**args))
-
-    def _parse_character_group(self):
-        pass
-
-    def _parse_conjunction(self):
-        """Extend or close the current GroupExpression."""
-        if self._current["first_time_parsing"]:
-            self._current["first_time_parsing"] = False
-            self._current["names"] = [self._group_count]
-            self._group_count += 1
-            if GroupExpression(children=(
-                    CharacterExpression("?"),
-                    CharacterExpression("P"),
-                    CharacterExpression("<"),
-                    GroupExpression(children=(
-                        CharacterRangeExpression(start="a", end="z",
-                                                 max_repetitions=float("inf")),
-                    ), names=("name",)),
-                    CharacterExpression(">")
-                )).matches(self._context):
-                # Search for the pattern "?P<(?P<name>[a-z]+)>" with this
-                # expression object right after the opening parenthesis
-                #
-                # todo: Replace "[a-z]" with "\w" once the
-                #       AnyOfOptionsExpression works.
-                self._current["names"].append(
-                    self._context.get_match_string("name"))
-
-        if self._context.current_subject_character == ")":
-            if not len(self._current_children):
-                raise Exception("The assigned pattern contains an empty group"
-                                + "at position %s." % self._context.progress)
-            self._context.progress += 1
-            args = {"children": self._current_children,
-                    "names": self._current["names"]}
-            args.update(self._resolve_repetitions())
-            self._stack.pop()
-            self._current_children.append(GroupExpression(**args))
-
-        else:
-            self._stack.append({"state": "unknown"})
-
-
-    def _parse_disjunction(self):
-        """Parse the contents of a character group."""
-
-    def _parse_escaped(self):
+        context = state.context
+        char = context._subject[context._progress]
+        context._progress += 1
+        return CharacterExpression(ord(char) if state.binary else char,
+                                   **self._resolve_repetitions(state))
+
+    def _parse_unopened(self, state):
+        """Reject a closing bracket that has no opening one."""
+        context = state.context
+        raise Exception("The character '%s' at position %s closes a group "
+                        "which was never opened."
+                        % (context._subject[context._progress],
+                           context._progress))
+
+    def _parse_group(self, state):
+        """Parse a group like (ab), (?P<name>ab) or (?:ab) up to the
+        closing parenthesis into a GroupExpression, or a named back
+        reference (?P=name) into a BackReferenceExpression."""
+        context = state.context
+        pattern = context._subject
+        start = context._progress
+        context._progress += 1
+        names = [state.group_count]
+        if pattern.startswith("?", context._progress):
+            if pattern.startswith("?:", context._progress):
+                context._progress += 2
+                names = None
+            elif pattern.startswith("?P<", context._progress):
+                position = context._progress + 3
+                name = self._read_group_name(state, position, ">")
+                if name in state.groupindex:
+                    raise Exception("Redefinition of the group name %s at "
+                                    "position %s." % (name, position))
+                names.append(name)
+                state.groupindex[name] = names[0]
+            elif pattern.startswith("?P=", context._progress):
+                name = self._read_group_name(state, context._progress + 3, ")")
+                if name not in state.groupindex:
+                    raise Exception("The back reference (?P=%s) at position "
+                                    "%s refers to an unknown group."
+                                    % (name, start))
+                return BackReferenceExpression(
+                    name, **self._resolve_repetitions(state))
+            else:
+                raise Exception("Unknown extension (%s at position %s."
+                                % (pattern[context._progress:
+                                           context._progress + 2], start))
+        if names is not None:
+            state.group_count += 1
+
+        children = self._parse_alternation(state)
+        if context._progress >= len(pattern):
+            raise Exception("More expressions opened than closed")
+        if not children:
+            raise Exception("The assigned pattern contains an empty group "
+                            "at position %s." % start)
+        context._progress += 1
+        return GroupExpression(children, names=names,
+                               **self._resolve_repetitions(state))
+
+    def _read_group_name(self, state, position, terminator):
+        """Read the group name that starts at position and ends with
+        terminator, and move behind the terminator."""
+        context = state.context
+        end = context._subject.find(terminator, position)
+        name = context._subject[position:end]
+        if end < 0 or not name.isidentifier():
+            raise Exception("Bad group name at position %s." % position)
+        context._progress = end + 1
+        return name
+
+    def _parse_character_group(self, state):
+        """Parse a character group like [a-z_] or [^\\s] up to the
+        closing bracket into a CharacterClassExpression."""
+        context = state.context
+        pattern = context._subject
+        length = len(pattern)
+        start = context._progress
+        context._progress += 1
+        negated = False
+        if context._progress < length and pattern[context._progress] == "^":
+            negated = True
+            context._progress += 1
+
+        def __read_character():
+            """Consume a single, possibly escaped, character; return
+            it, or the ranges of a special sequence like \\d."""
+            if context._progress >= length:
+                raise Exception("The character group at position %s is "
+                                "never closed." % start)
+            char = pattern[context._progress]
+            context._progress += 1
+            if char == "\\":
+                if context._progress >= length:
+                    raise Exception("The character group at position %s "
+                                    "is never closed." % start)
+                char = pattern[context._progress]
+                context._progress += 1
+                if char in "sSdDwW":
+                    return category_ranges(char, state.binary)
+            return char
+
+        ranges = []
+        first = True
+        while True:
+            if (not first and context._progress < length
+                    and pattern[context._progress] == "]"):
+                context._progress += 1
+                break
+            first = False
+            range_start = context._progress
+            low = __read_character()
+            if (context._progress + 1 < length
+                    and pattern[context._progress] == "-"
+                    and pattern[context._progress + 1] != "]"):
+                context._progress += 1
+                high = __read_character()
+                # Special sequences like \d can't be either end.
+                if type(low) is tuple or type(high) is tuple or high < low:
+                    raise Exception("Bad character range %s at position %s."
+                                    % (pattern[range_start:context._progress],
+                                       range_start))
+                ranges.append((ord(low), ord(high)))
+            elif type(low) is tuple:
+                ranges.extend(low)
+            else:
+                ranges.append((ord(low), ord(low)))
+
+        return CharacterClassExpression(
+            CharacterSet.get(ranges, negated),
+            pattern[start:context._progress],
+            **self._resolve_repetitions(state))
+
+    def _parse_escaped(self, state):
         """Parse either a as special sequence or as escaped character.
 
         This method will either create an appropriate expression for
-        patterns like "\w" or prepare parsing of the next character as
+        patterns like "\\w" or "\\1", or parse the next character as
         CharacterExpression.
 
         """
-        if self._context.current_subject_character == "s":
-            self._context.progress += 1
-            args = {"options": (CharacterExpression(" "),
-                                CharacterExpression("\t"),
-                                CharacterExpression("\n"),
-                                CharacterExpression("\r"),
-                                CharacterExpression("\f"),
-                                CharacterExpression("\v"))}
-            args.update(self._resolve_repetitions())
-            self._pop_current()
-            self._current["children"].append(AnyOfOptionsExpression(**args))
-        # todo: cover the remaining escaped groups, like \w or \W
-        else:
-            self._current = {
-                "state": "character",
-                "character": self._context.current_subject_character}
-
-    def _resolve_repetitions(self):
+        context = state.context
+        pattern = context._subject
+        context._progress += 1
+        if context._progress >= len(pattern):
+            raise Exception("The pattern ends with an incomplete escape "
+                            "sequence.")
+        char = pattern[context._progress]
+        if char in "sSdDwW":
+            context._progress += 1
+            return CharacterClassExpression(
+                CharacterSet.get(category_ranges(char.lower(), state.binary),
+                                 char.isupper()),
+                "\\" + char, **self._resolve_repetitions(state))
+        if char in "123456789":
+            start = context._progress
+            while (context._progress < len(pattern)
+                   and pattern[context._progress] in _DIGITS):
+                context._progress += 1
+            reference = pattern[start:context._progress]
+            if int(reference) >= state.group_count:
+                raise Exception("The back reference \\%s at position %s "
+                                "refers to an unknown group."
+                                % (reference, context._progress))
+            return BackReferenceExpression(int(reference),
+                                           **self._resolve_repetitions(state))
+        # Parse the escaped character literally.
+        return self._parse_character(state)
+
+    # Methods that parse an atom, keyed by its first character; all
+    # other characters are parsed by _parse_character().
+    _atom_parsers = {"(": _parse_group,
+                     "[": _parse_character_group,
+                     "\\": _parse_escaped,
+                     "]": _parse_unopened}
+
+    def _resolve_repetitions(self, state):
         """Read repetitions and greed from the current position.
 
         Return a dict with keys greedy, min_repetitions and
         max_repetitions, like the named parameters for Expression,
-        filled with resolved or default values.
-
-        todo: handle repetitions indications like {1,} or {5}
+        filled with resolved or default values. Like in the builtin re
+        module, a "{" that doesn't start a repetition like {5}, {2,5},
+        {,5} or {2,} is left to be parsed as a character.
 
         """
+        context = state.context
+        pattern = context._subject
+        length = len(pattern)
+        position = context._progress
         minimum, maximum, greedy = 1, 1, True
-        inf = float("inf")
-
-        if self._context.progress >= len(self._context._subject):
-            # The caller already consumed the remaining subject; don't
-            # read any further.
-            return {"min_repetitions": minimum,
-                    "max_repetitions": maximum,
-                    "greedy": greedy}
-        elif self._context.current_subject_character == "+":
-            minimum = 1
-            maximum = inf
-            self._context.progress += 1
-        elif self._context.current_subject_character == "?":
-            minimum = 0
-            maximum = 1
-            self._context.progress += 1
-        elif self._context.current_subject_character == "*":
-            minimum = 0
-            maximum = inf
-            self._context.progress += 1
-
-        # expression object for pattern "{(?P<repetition>\d+)}"
-        elif GroupExpression((
-                    CharacterExpression(character="{"),
-                    GroupExpression((CharacterRangeExpression(start="0",
-                                                end="9",max_repetitions=inf),),
-                                    names=("repetition",)),
-                    CharacterExpression("}"))
-             ).matches(self._context):
-                minimum = maximum = int(
-                    self._context.get_match_string("repetition"))
-
-        # expression object for pattern "{(?P<min>\d*),(?P<max>\d*)}"
-        elif GroupExpression((CharacterExpression(character="{"),
-                              GroupExpression(
-                                    (CharacterRangeExpression(start="0",
-                                        end="9", min_repetitions=0,
-                                        max_repetitions=inf),),
-                                    names=("min",)),
-                              CharacterExpression(","),
-                              GroupExpression(
-                                    (CharacterRangeExpression(start="0",
-                                        end="9", min_repetitions=0,
-                                        max_repetitions=inf),),
-                                    names=("max",)),
-                              CharacterExpression("}"))
-             ).matches(self._context):
-                minimum = self._context.get_match_string("min")
-                maximum = self._context.get_match_string("max")
-                minimum = int(minimum) if len(minimum) else 0
-                maximum = int(maximum) if len(maximum) else inf
-
-        if (self._context.progress < len(self._context._subject)
-                and self._context.current_subject_character == "?"):
+
+        char = pattern[position] if position < length else None
+        if char == "+":
+            minimum, maximum = 1, _INFINITY
+            position += 1
+        elif char == "?":
+            minimum, maximum = 0, 1
+            position += 1
+        elif char == "*":
+            minimum, maximum = 0, _INFINITY
+            position += 1
+        elif char == "{":
+            end = position + 1
+            while end < length and pattern[end] in _DIGITS:
+                end += 1
+            low = high = pattern[position + 1:end]
+            if end < length and pattern[end] == ",":
+                comma = end
+                end += 1
+                while end < length and pattern[end] in _DIGITS:
+                    end += 1
+                high = pattern[comma + 1:end]
+            if end < length and pattern[end] == "}" and end > position + 1:
+                minimum = int(low) if low else 0
+                maximum = int(high) if high else _INFINITY
+                if maximum < minimum:
+                    raise Exception("The repetition at position %s has a "
+                                    "maximum below its minimum." % position)
+                position = end + 1
+
+        if position < length and position > context._progress \
+                and pattern[position] == "?":
             greedy = False
-            self._context.progress += 1
+            position += 1
+        context._progress = position
 
         return {"min_repetitions": minimum,
                 "max_repetitions": maximum,
                 "greedy": greedy}
+
+
+class _ParseState:
+    """What a single call of Parser.parse() knows about the pattern.
+
+    The position is kept in the progress of an EvaluationContext over
+    the pattern, which is only used as a cursor. group_count is the
+    number of the next capturing group, groupindex maps the names of
+    the groups seen so far to their numbers. binary is True for bytes
+    patterns.
+
+    """
+
+    __slots__ = ("context", "group_count", "groupindex", "binary")
+
+    def __init__(self, pattern, binary=False):
+        self.context = EvaluationContext(pattern)
+        self.group_count = 1
+        self.groupindex = {}
+        self.binary = binary
+
+
+_DIGITS = frozenset("0123456789")
+
+_INFINITY = float("inf")
+
+
+# This object is used by the module function cre.compile(), which in
+# turn is used by cre.match(), cre.search() and others, and by RegexSet
+# when it isn't given a parser; they all share its caches.
+default_parser = Parser()
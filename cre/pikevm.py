@@ -0,0 +1,354 @@
+from .captures import *
+from .compiler import *
+from .prefilter import *
+
+
+class PikeVM:
+    """Simulate a Program on all paths at once.
+
+    This is the construction described by Thompson and refined by Rob
+    Pike to track submatches: instead of backtracking, the VM advances
+    a list of threads over the subject one character at a time. Every
+    thread carries its own capture registers, and threads that reach
+    an instruction another thread already reached at the same position
+    are dropped. This bounds the work per character by the size of the
+    program, so matching takes O(len(subject) * len(program)) steps.
+
+    Threads are kept in priority order, which makes the VM select the
+    same match as the backtracking expression tree would.
+
+    Captures are stored as persistent linked lists of
+    (slot, start, end, previous) tuples, so threads that split share
+    their common history instead of copying it.
+
+    Whether a thread may jump back to the start of a loop depends on
+    whether the current repetition consumed characters. While
+    following empty transitions, each thread carries a bit mask of the
+    loops whose repetition started at the current position; two
+    threads are only considered equal if they agree on pc and mask.
+
+    If the captures are streamed to callbacks or limited (see
+    Captures), the histories are cut short every FLUSH_INTERVAL
+    characters once a match was found: the part that the match and all
+    remaining threads share is final, so it is appended to the
+    Captures object and dropped from the histories. Memory then
+    doesn't grow with the number of repetitions.
+
+    Before a match is found, match() can't append captures yet: if all
+    threads die, there is no match. If the captures are only limited,
+    the part that all threads share is moved to a staging Captures
+    object instead, which keeps just as many matches per group, and
+    appended once a match is found. Callbacks can't be called early,
+    and search() starts threads with an empty history, so in these
+    cases the histories grow until a match is found.
+
+    If a StepBudget is passed to match() or search(), every thread
+    that is advanced over a character is charged as a step, and so is
+    every empty transition that is followed to add a thread.
+
+    """
+
+    FLUSH_INTERVAL = 64
+
+    def __init__(self, program):
+        self._program = program
+
+    def match(self, subject, pos=0, not_empty=False, endpos=None,
+              captures=None, budget=None):
+        """Match the program at pos, treating endpos as the end of
+        subject.
+
+        Return the Captures of all groups, or None if the program
+        doesn't match. If not_empty is True, empty matches are rejected.
+        If captures is given, the spans are appended to it as soon as
+        they can't be retracted anymore.
+
+        """
+        history = self._run(subject, pos, None, pos if not_empty else -1,
+                            endpos, captures, budget)[0]
+        return self._build_captures(history, captures)
+
+    def search(self, subject, pos=0, scanner=None, not_empty=False,
+               endpos=None, captures=None, budget=None):
+        """Find the leftmost match in subject[pos:endpos].
+
+        A new thread is started at every candidate position returned by
+        scanner (or at every position if scanner is None) until a match
+        was found. New threads have the lowest priority, so matches that
+        start earlier win. If not_empty is True, an empty match at pos
+        is rejected. Return the same as match().
+
+        """
+        if scanner is None:
+            scanner = Prefilter().scanner(subject, endpos)
+        history = self._run(subject, pos, scanner, pos if not_empty else -1,
+                            endpos, captures, budget)[0]
+        return self._build_captures(history, captures)
+
+    def search_partial(self, subject, pos=0, scanner=None, not_empty=False,
+                       endpos=None, budget=None):
+        """Like search(), but also report whether the result depends on
+        what follows the end of subject.
+
+        Return a tuple (matches, resume). resume is -1 if appending to
+        subject can't change the result; else it is the earliest
+        position at which a match may start once more characters are
+        known, and matches must not be trusted.
+
+        """
+        if scanner is None:
+            scanner = Prefilter().scanner(subject, endpos)
+        history, resume = self._run(subject, pos, scanner,
+                                    pos if not_empty else -1, endpos, None,
+                                    budget)
+        return self._build_captures(history), resume
+
+    def _run(self, subject, pos, scanner, forbidden_end, endpos=None,
+             captures=None, budget=None):
+        """Advance the threads over subject.
+
+        Return the capture history of the match, or None, and the
+        position at which the first thread started that still wanted
+        to consume a character at the end of subject, or -1. The part
+        of the history that was flushed to captures is missing from the
+        returned history.
+
+        """
+        instructions = self._program.instructions
+        slots = len(self._program.slot_names)
+        empty = (None,) * slots
+        # visited[pc] holds the last position at which a thread reached
+        # pc; it replaces a per-step set of program counters.
+        visited = [-1] * len(instructions)
+        end = len(subject) if endpos is None else min(endpos, len(subject))
+
+        flush = captures is not None and captures.bounded
+        unflushed = 0
+        # Captures that all threads share before a match was found.
+        staged = None
+        if flush and scanner is None:
+            staged = captures.staging()
+
+        current = []
+        seen = set()
+        matched = None
+        resume = -1
+        position = pos
+        while True:
+            if matched is None:
+                if scanner is None:
+                    if position == pos:
+                        self._add_thread(current, visited, seen, 0, position,
+                                         position, empty, empty, None, budget)
+                else:
+                    if not current:
+                        # Skip right to the next candidate.
+                        position = scanner.next(position)
+                        if position < 0:
+                            break
+                        seen = set()
+                    if scanner.next(position) == position:
+                        self._add_thread(current, visited, seen, 0, position,
+                                         position, empty, empty, None, budget)
+            if not current:
+                break
+            if budget is not None:
+                budget.steps += len(current)
+                if budget.steps >= budget.next_check:
+                    budget.check()
+
+            following = []
+            seen = set()
+            character = subject[position] if position < end else None
+            for pc, origin, starts, pending, history in current:
+                instruction = instructions[pc]
+                opcode = instruction[0]
+                if opcode == MATCH:
+                    if position == forbidden_end:
+                        continue
+                    # All remaining threads have a lower priority.
+                    matched = history
+                    break
+                if character is None:
+                    # Threads are ordered by their start position, so
+                    # the first one that ran out of characters started
+                    # earliest.
+                    if resume < 0:
+                        resume = origin
+                    continue
+                if opcode == CHAR:
+                    if character != instruction[1]:
+                        continue
+                elif opcode == CLASS:
+                    if character not in instruction[1]:
+                        continue
+                elif opcode == SWITCH:
+                    target = instruction[1].get(character)
+                    if target is not None:
+                        self._add_thread(following, visited, seen, target,
+                                         position + 1, origin, starts,
+                                         pending, history, budget)
+                    continue
+                elif not instruction[1] <= character <= instruction[2]:
+                    continue
+                self._add_thread(following, visited, seen, pc + 1,
+                                 position + 1, origin, starts, pending,
+                                 history, budget)
+            current = following
+            position += 1
+            if staged is not None and matched is not None:
+                # The staged captures precede the match.
+                captures.extend(staged)
+                staged = None
+            if flush and (matched is not None or staged is not None):
+                unflushed += 1
+                if unflushed >= self.FLUSH_INTERVAL:
+                    if matched is not None:
+                        matched, current = self._flush(matched, current,
+                                                       captures)
+                    elif current:
+                        current = self._flush(None, current, staged)[1]
+                    unflushed = 0
+
+        return matched, resume
+
+    def _add_thread(self, threads, visited, seen, pc, position, origin,
+                    starts, pending, history, budget=None):
+        """Follow all empty transitions from pc and append the
+        resulting threads in priority order.
+
+        origin is the position at which the thread was started. Every
+        transition that is followed is charged to budget, if given.
+
+        visited and seen record the (pc, mask) pairs that were already
+        reached at position; mask 0 is tracked in visited, which is by
+        far the most common case.
+
+        """
+        instructions = self._program.instructions
+        stack = [(pc, 0, starts, pending, history)]
+        while stack:
+            pc, mask, starts, pending, history = stack.pop()
+            if budget is not None:
+                budget.steps += 1
+                if budget.steps >= budget.next_check:
+                    budget.check()
+            if mask:
+                if (pc, mask) in seen:
+                    continue
+                seen.add((pc, mask))
+            else:
+                if visited[pc] == position:
+                    continue
+                visited[pc] = position
+            instruction = instructions[pc]
+            opcode = instruction[0]
+            if opcode == JMP:
+                stack.append((instruction[1], mask, starts, pending, history))
+            elif opcode == SPLIT:
+                stack.append((instruction[2], mask, starts, pending, history))
+                stack.append((instruction[1], mask, starts, pending, history))
+            elif opcode == MARK:
+                mask |= 1 << instruction[1]
+                stack.append((pc + 1, mask, starts, pending, history))
+            elif opcode == LOOP:
+                bit = 1 << instruction[1]
+                if mask & bit:
+                    # The repetition was empty; leave the loop.
+                    stack.append((pc + 1, mask & ~bit, starts, pending,
+                                  history))
+                else:
+                    stack.append((instruction[2], mask, starts, pending,
+                                  history))
+            elif opcode == SAVE_START:
+                slot = instruction[1]
+                starts = starts[:slot] + (position,) + starts[slot + 1:]
+                stack.append((pc + 1, mask, starts, pending, history))
+            elif opcode == SAVE_END:
+                slot = instruction[1]
+                pending = (pending[:slot] + ((starts[slot], position),)
+                           + pending[slot + 1:])
+                stack.append((pc + 1, mask, starts, pending, history))
+            elif opcode == COMMIT:
+                slot = instruction[1]
+                if pending[slot] is not None:
+                    history = (slot, pending[slot][0], pending[slot][1],
+                               history)
+                    pending = pending[:slot] + (None,) + pending[slot + 1:]
+                stack.append((pc + 1, mask, starts, pending, history))
+            elif visited[pc] != position or not mask:
+                # Consuming instructions don't depend on the mask.
+                visited[pc] = position
+                threads.append((pc, origin, starts, pending, history))
+
+    def _flush(self, matched, threads, captures):
+        """Append the part of the history that matched and all threads
+        share to captures, and return matched and threads without it.
+        If matched is None, append the part that all threads share.
+        """
+        # Find the newest node of matched, or of the first thread, that
+        # all threads contain.
+        chain = []
+        index = {}
+        node = matched if matched is not None else threads[0][4]
+        while node is not None:
+            index[id(node)] = len(chain)
+            chain.append(node)
+            node = node[3]
+        cutoff = 0
+        for thread in threads:
+            node = thread[4]
+            while node is not None and id(node) not in index:
+                node = node[3]
+            if node is None:
+                return matched, threads
+            cutoff = max(cutoff, index[id(node)])
+        # Keep the newest node, so that the history of the match, or of
+        # a thread that is about to match, doesn't become empty; None
+        # means that nothing matched.
+        cutoff = max(cutoff, 1)
+        if cutoff >= len(chain):
+            return matched, threads
+
+        slot_groups = self._program.slot_groups
+        for slot, start, end, _ in reversed(chain[cutoff:]):
+            if slot_groups[slot] is not None:
+                captures.append(slot_groups[slot], start, end)
+
+        # Copy the newer nodes on top of an empty history; rebuilt maps
+        # old nodes to their copies, so shared nodes stay shared.
+        rebuilt = {id(chain[cutoff]): None}
+
+        def __rebuild(node):
+            path = []
+            while id(node) not in rebuilt:
+                path.append(node)
+                node = node[3]
+            history = rebuilt[id(node)]
+            for old in reversed(path):
+                history = (old[0], old[1], old[2], history)
+                rebuilt[id(old)] = history
+            return history
+
+        if matched is not None:
+            matched = __rebuild(matched)
+        return matched, [
+            (pc, origin, starts, pending, __rebuild(history))
+            for pc, origin, starts, pending, history in threads]
+
+    def _build_captures(self, history, captures=None):
+        """Convert a capture history into a new Captures object, or
+        append it to captures."""
+        if history is None:
+            return None
+        entries = []
+        while history is not None:
+            slot, start, end, history = history
+            entries.append((slot, start, end))
+        if captures is None:
+            captures = Captures(self._program.group_count)
+        slot_groups = self._program.slot_groups
+        for slot, start, end in reversed(entries):
+            if slot_groups[slot] is not None:
+                captures.append(slot_groups[slot], start, end)
+        return captures
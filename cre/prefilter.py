@@ -0,0 +1,253 @@
+from .analysis import *
+
+
+def _literal_info(expression):
+    """Collect the literals that every match of expression contains.
+
+    Return a tuple (exact, prefix, required): exact is the only string
+    the expression can match, or None if there are several; prefix is
+    a string every match starts with and required is the longest known
+    string every match contains. Both are "" if nothing is known. Bytes
+    are represented by the characters with the same code points.
+
+    """
+    if (isinstance(expression, CharacterExpression)
+            or (isinstance(expression, CharacterRunExpression)
+                and expression._char is not None)):
+        char = expression._char
+        info = (char if type(char) is str else chr(char),) * 3
+    elif isinstance(expression, LiteralExpression):
+        literal = expression._literal
+        if type(literal) is not str:
+            literal = literal.decode("latin-1")
+        info = (literal,) * 3
+    elif isinstance(expression, GroupExpression):
+        info = _sequence_info(expression._children)
+    elif isinstance(expression, AnyOfOptionsExpression):
+        infos = [_literal_info(c) for c in expression._children]
+        exacts = set(i[0] for i in infos)
+        if len(exacts) == 1 and None not in exacts:
+            info = infos[0]
+        else:
+            prefix = _common_prefix([i[1] for i in infos])
+            info = (None, prefix, prefix)
+    else:
+        info = (None, "", "")
+
+    minimum = expression._min_repetitions
+    maximum = expression._max_repetitions
+    exact, prefix, required = info
+    if minimum == 0:
+        return ("" if maximum == 0 else None, "", "")
+    if exact is not None:
+        if minimum == maximum:
+            return (exact * minimum,) * 3
+        return (None, exact * minimum, exact * minimum)
+    return (None, prefix, required)
+
+
+def _sequence_info(children):
+    """_literal_info() for the concatenation of children."""
+    infos = [_literal_info(c) for c in children]
+
+    prefix = ""
+    for exact, child_prefix, _ in infos:
+        if exact is None:
+            prefix += child_prefix
+            break
+        prefix += exact
+    else:
+        return (prefix,) * 3
+
+    # The exact children between two inexact ones form a contiguous
+    # literal, which is extended by the prefix of the following child.
+    required = ""
+    run = ""
+    for exact, child_prefix, child_required in infos:
+        if exact is not None:
+            run += exact
+            continue
+        for literal in (run + child_prefix, child_required):
+            if len(literal) > len(required):
+                required = literal
+        run = ""
+    if len(run) > len(required):
+        required = run
+    return (None, prefix, required)
+
+
+def _common_prefix(strings):
+    prefix = strings[0]
+    for s in strings[1:]:
+        while not s.startswith(prefix):
+            prefix = prefix[:-1]
+    return prefix
+
+
+class HorspoolTable:
+    """Boyer-Moore-Horspool search for a literal.
+
+    str and bytes subjects are searched with their own find() method,
+    which is implemented in C; this table is used for subjects that
+    don't provide one.
+
+    """
+
+    def __init__(self, literal):
+        self.literal = literal
+        last = len(literal) - 1
+        self._shifts = {}
+        for i, character in enumerate(literal[:last]):
+            self._shifts[character] = last - i
+
+    def find(self, subject, start, end):
+        """Return the lowest index of the literal in subject[start:end],
+        or -1."""
+        literal = self.literal
+        length = len(literal)
+        if length == 0:
+            return start if start <= end else -1
+        last = length - 1
+        shifts = self._shifts
+        position = start
+        while position + length <= end:
+            i = last
+            while subject[position + i] == literal[i]:
+                if i == 0:
+                    return position
+                i -= 1
+            position += shifts.get(subject[position + last], length)
+        return -1
+
+
+def find_literal(subject, literal, table, start, end):
+    """Find literal in subject[start:end] with subject.find() if
+    available, else with the HorspoolTable table."""
+    find = getattr(subject, "find", None)
+    if find is not None:
+        return find(literal, start, end)
+    return table.find(subject, start, end)
+
+
+class Prefilter:
+    """Reject start positions at which a pattern can't match.
+
+    A prefilter is derived from an expression tree. If every match
+    starts with a literal prefix, only the occurrences of the prefix
+    are candidates; else, if every match starts with a character of
+    the CharacterSet first, only the positions of such characters are.
+    If every match contains another literal, the search ends as soon
+    as the literal doesn't occur in the remaining subject anymore.
+
+    Matches are at least min_length and at most max_length characters
+    long; max_length is None if it is unbounded. No candidate is closer
+    than min_length to the end of the subject, and if max_length is
+    known, none is so far in front of the next occurrence of the
+    required literal that a match starting there can't reach it.
+
+    """
+
+    def __init__(self, prefix="", required="", first=None, min_length=0,
+                 max_length=None):
+        self.prefix = prefix
+        # The prefix is checked anyway; don't search for it twice.
+        self.required = "" if required == prefix else required
+        self.first = first
+        self.min_length = min_length
+        self.max_length = max_length
+        self._prefix_table = HorspoolTable(self.prefix)
+        self._required_table = HorspoolTable(self.required)
+
+    @classmethod
+    def from_tree(cls, tree, binary=False):
+        """Derive the prefilter of tree. If binary is True, the tree
+        was parsed from a bytes pattern, and the literals are bytes."""
+        exact, prefix, required = _literal_info(tree)
+        if binary:
+            prefix = prefix.encode("latin-1")
+            required = required.encode("latin-1")
+        ranges, nullable = FirstSets().first(tree)
+        first = None
+        if not nullable and ranges != ANY:
+            first = CharacterSet.get(ranges)
+        min_length, max_length = match_lengths(tree)
+        if max_length == float("inf"):
+            max_length = None
+        return cls(prefix, required, first, min_length, max_length)
+
+    def scanner(self, subject, end=None):
+        """Return a CandidateScanner for subject[:end]."""
+        return CandidateScanner(self, subject,
+                                len(subject) if end is None else end)
+
+
+class CandidateScanner:
+    """Iterates the candidate start positions of a single search."""
+
+    def __init__(self, prefilter, subject, end):
+        self._prefilter = prefilter
+        self._subject = subject
+        self._end = end
+        # The last position at which a match fits into the subject.
+        self._last = end - prefilter.min_length
+        # The last candidate that was found, and the next occurrence of
+        # the required literal.
+        self._candidate = -1
+        self._required_at = -1
+        self._exhausted = False
+
+    def next(self, position):
+        """Return the first candidate at or after position, or -1 if a
+        match can't start at or after position."""
+        if self._exhausted:
+            return -1
+        if position <= self._candidate:
+            return self._candidate
+        prefilter = self._prefilter
+        while True:
+            candidate = position if position <= self._last else -1
+            if candidate >= 0 and prefilter.prefix:
+                candidate = find_literal(self._subject, prefilter.prefix,
+                                         prefilter._prefix_table,
+                                         position, self._end)
+                if candidate > self._last:
+                    candidate = -1
+            if candidate >= 0 and prefilter.required:
+                if self._required_at < candidate:
+                    self._required_at = find_literal(
+                        self._subject, prefilter.required,
+                        prefilter._required_table, candidate, self._end)
+                if self._required_at < 0:
+                    candidate = -1
+                elif prefilter.max_length is not None:
+                    # A match must end behind the required literal.
+                    earliest = (self._required_at + len(prefilter.required)
+                                - prefilter.max_length)
+                    if candidate < earliest:
+                        position = earliest
+                        continue
+            if (candidate >= 0 and not prefilter.prefix
+                    and prefilter.first is not None):
+                # Checked after the required literal, which is found
+                # much faster.
+                position = self._find_first(candidate)
+                if position != candidate:
+                    if position >= 0:
+                        continue
+                    candidate = -1
+            break
+        if candidate < 0:
+            self._exhausted = True
+        else:
+            self._candidate = candidate
+        return candidate
+
+    def _find_first(self, position):
+        """Return the first position at or after position whose
+        character is in the first set of the prefilter, or -1."""
+        first = self._prefilter.first
+        subject = self._subject
+        for position in range(position, min(self._last + 1, self._end)):
+            if subject[position] in first:
+                return position
+        return -1
@@ -0,0 +1,772 @@
+import pickle
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from .expression import *
+from .captures import *
+from .compiler import *
+from .pikevm import *
+from .dfa import *
+from .vm import *
+from .prefilter import *
+from .budget import *
+from .version import __version__
+
+
+# Names of the matching engines that RegexObject can use.
+#   "backtrack": evaluate the expression tree recursively.
+#   "vm":        run the compiled program on the BacktrackingVM.
+#   "pike":      run the compiled program on the PikeVM; linear in the
+#                subject length, but can't handle back references.
+#   "auto":      "pike" if possible, else "vm".
+ENGINES = ("auto", "backtrack", "vm", "pike")
+
+# Header of serialized patterns: the magic bytes, then the version of
+# the format as a single byte, then the __version__ of the library,
+# terminated by a newline. Patterns are only loaded by the same format
+# and library version that wrote them.
+SERIALIZATION_MAGIC = b"cre"
+SERIALIZATION_FORMAT = 1
+
+
+# Every worker of match_many() and test_many() gets about this many
+# chunks of the batch, so workers that finish early take over the
+# rest of the work.
+CHUNKS_PER_WORKER = 4
+
+# match_many() stops asking the lazy DFA to reject subjects once more
+# than this many subjects of a batch matched per subject that didn't:
+# then scanning the matching subjects twice costs more than the DFA
+# saves on the others.
+DFA_ACCEPTS_PER_REJECT = 4
+
+
+def _bounds(string, pos, endpos):
+    """Return the window (pos, endpos) of string that is matched.
+
+    Like in the builtin re module, the bounds are clamped to the
+    subject rather than interpreted like slice indices. If endpos is
+    less than pos, nothing can match. The subject is never sliced: the
+    engines only look at string[pos:endpos].
+
+    """
+    length = len(string)
+    pos = 0 if pos is None else min(max(pos, 0), length)
+    endpos = length if endpos is None else min(max(endpos, 0), length)
+    return pos, endpos
+
+
+def _check_subject(binary, string):
+    """Raise a TypeError if string can't be matched by a bytes pattern,
+    if binary is True, or by a string pattern, like the builtin re
+    module does. Used by RegexObject and RegexSet."""
+    if isinstance(string, str):
+        if binary:
+            raise TypeError("cannot use a bytes pattern on a "
+                            "string-like object")
+    elif not binary:
+        raise TypeError("cannot use a string pattern on a "
+                        "bytes-like object")
+
+
+class RegexObject:
+    """Compiled regular expression objects
+
+    Regex objects can be pickled, which stores the result of dumps():
+    the expression tree together with the compiled program, so loading
+    them doesn't parse or compile the pattern again.
+
+    """
+
+    def __init__(self, expression_tree, pattern, groups, groupindex, flags=0,
+                 engine="auto", program=None, prefilter=None):
+        self._expression_tree = expression_tree
+        self.pattern = pattern
+        self.flags = flags
+        self.groups = groups
+        self.groupindex = groupindex
+
+        if engine not in ENGINES:
+            raise ValueError("unknown engine %r" % (engine,))
+        if engine == "auto" or (engine == "pike" and program is None):
+            needs_backtracking = any(isinstance(e, BackReferenceExpression)
+                                     for e in expression_tree.walk())
+            if engine == "auto":
+                engine = "vm" if needs_backtracking else "pike"
+            elif needs_backtracking:
+                raise ValueError("The pike engine can't match back "
+                                 "references.")
+        self.engine = engine
+
+        # bytes patterns match bytes-like subjects (bytes, bytearray,
+        # memoryview, mmap) by their integer byte values.
+        self._binary = not isinstance(pattern, str)
+
+        # The compiled program runs on self._vm, which is either a
+        # PikeVM or a BacktrackingVM. program and prefilter are only
+        # passed in by loads(); else they are derived from the tree.
+        self._vm = None
+        self._dfa = None
+        if engine != "backtrack" and program is None:
+            program = ProgramCompiler().compile(expression_tree)
+        if engine == "pike":
+            self._vm = PikeVM(program)
+            self._dfa = LazyDFA(program)
+        elif engine == "vm":
+            self._vm = BacktrackingVM(program)
+
+        if prefilter is None:
+            prefilter = Prefilter.from_tree(expression_tree, self._binary)
+        self._prefilter = prefilter
+
+    def dumps(self):
+        """dumps() -> bytes.
+        Serialize the compiled pattern for loads(). The result starts
+        with a header that names the serialization format and the
+        version of the library, followed by the pickled expression tree
+        and program."""
+        program = self._vm._program if self._vm is not None else None
+        prefilter = self._prefilter
+        state = (self.pattern, self.flags, self.engine, self.groups,
+                 self.groupindex, self._expression_tree, program,
+                 (prefilter.prefix, prefilter.required, prefilter.first,
+                  prefilter.min_length, prefilter.max_length))
+        return (SERIALIZATION_MAGIC + bytes((SERIALIZATION_FORMAT,))
+                + __version__.encode("ascii") + b"\n"
+                + pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def loads(cls, data):
+        """loads(data) -> regex object.
+        Return the regex object that dumps() serialized to data. Raise
+        ValueError if data wasn't written by dumps() in the same
+        serialization format and version of the library. Like pickle,
+        this must only be used on trusted data."""
+        header_length = len(SERIALIZATION_MAGIC) + 1
+        if (data[:len(SERIALIZATION_MAGIC)] != SERIALIZATION_MAGIC
+                or len(data) < header_length
+                or data[header_length - 1] != SERIALIZATION_FORMAT):
+            raise ValueError("data is not a serialized pattern of this "
+                             "format")
+        end = data.find(b"\n", header_length)
+        version = bytes(data[header_length:end]).decode("ascii", "replace")
+        if end < 0 or version != __version__:
+            raise ValueError("the pattern was serialized by version %s of "
+                             "cre, this is %s" % (version, __version__))
+        (pattern, flags, engine, groups, groupindex, tree, program,
+         prefilter) = pickle.loads(data[end + 1:])
+        return cls(tree, pattern, groups, groupindex, flags, engine, program,
+                   Prefilter(*prefilter))
+
+    def __reduce__(self):
+        return (RegexObject.loads, (self.dumps(),))
+
+    @property
+    def optimized_tree(self):
+        """The expression tree the pattern is matched with. Parser.compile()
+        rewrites the parsed tree with the Optimizer first."""
+        return self._expression_tree
+
+    @property
+    def min_length(self):
+        """The length of the shortest string the pattern can match."""
+        return self._prefilter.min_length
+
+    @property
+    def max_length(self):
+        """The length of the longest string the pattern can match, or
+        None if it is unbounded."""
+        return self._prefilter.max_length
+
+    @property
+    def first_set(self):
+        """The CharacterSet of the characters every match starts with,
+        or None if a match may be empty or start with any character."""
+        return self._prefilter.first
+
+    def dump(self):
+        """dump() -> str.
+        Return a human readable listing of optimized_tree, followed by
+        the compiled program, if the engine uses one."""
+        listing = self._expression_tree.dump()
+        if self._vm is not None:
+            listing += "\n\n" + self._vm._program.dump()
+        return listing
+
+    def match(self, string, pos=None, endpos=None, capture_limit=None,
+              on_capture=None, max_steps=None, timeout=None):
+        """match(string[, pos[, endpos[, capture_limit[, on_capture[,
+        max_steps[, timeout]]]]]]) -> match object or None.
+        Matches zero or more characters at the beginning of the string.
+
+        All matches of every group are kept, unless capture_limit is
+        given: then only the last capture_limit matches of each group
+        are kept. on_capture maps group numbers or names to functions
+        (like the send() method of a generator, or list.append), which
+        are called with the (start, end) tuple of every match of the
+        group; only the last match of these groups is kept. Captures
+        are only reported once they can't be retracted by backtracking
+        anymore. With the pike engine, that happens while the subject
+        is matched once a match was found, so memory doesn't grow with
+        the number of repetitions. Until a match is found, the pike
+        engine keeps at most capture_limit matches per group in match()
+        if no on_capture is given; else, and in search(), all captures
+        are kept until then. The backtracking engines report captures
+        when the match is complete.
+
+        If more than max_steps steps are taken or more than timeout
+        seconds pass, BudgetExceeded is raised; what counts as a step
+        depends on the engine, see StepBudget. Limits that aren't given
+        default to the ones set with cre.set_match_limits()."""
+        _check_subject(self._binary, string)
+        pos, endpos = _bounds(string, pos, endpos)
+        if endpos - pos < self._prefilter.min_length:
+            return None
+        matches = self._match(string, pos, endpos, False,
+                              self._new_captures(capture_limit, on_capture),
+                              StepBudget.create(max_steps, timeout))
+        if matches is not None:
+            return MatchObject(self, string, pos, endpos, matches)
+
+    def search(self, string, pos=None, endpos=None, capture_limit=None,
+               on_capture=None, max_steps=None, timeout=None):
+        """search(string[, pos[, endpos[, capture_limit[, on_capture[,
+        max_steps[, timeout]]]]]]) -> match object or None.
+        Scan through string looking for a match, and return a
+        corresponding match object instance. Return None if no
+        position in the string matches. See match() for capture_limit,
+        on_capture, max_steps and timeout; the limits apply to the
+        whole search."""
+        _check_subject(self._binary, string)
+        pos, endpos = _bounds(string, pos, endpos)
+        if pos > endpos:
+            return None
+        matches = self._search(string, pos, endpos, False,
+                               self._new_captures(capture_limit, on_capture),
+                               StepBudget.create(max_steps, timeout))
+        if matches is not None:
+            return MatchObject(self, string, pos, endpos, matches)
+
+    def finditer(self, string, pos=None, endpos=None, capture_limit=None,
+                 on_capture=None, max_steps=None, timeout=None):
+        """finditer(string[, pos[, endpos[, capture_limit[, on_capture[,
+        max_steps[, timeout]]]]]]) -> iterator.
+        Return an iterator over all non-overlapping matches for the
+        pattern in string. For each match, the iterator returns a
+        match object. See match() for capture_limit, on_capture,
+        max_steps and timeout; the limits apply to the search for each
+        match separately."""
+        _check_subject(self._binary, string)
+        pos, endpos = _bounds(string, pos, endpos)
+        position = pos
+        not_empty = False
+        while position <= endpos:
+            matches = self._search(
+                string, position, endpos, not_empty,
+                self._new_captures(capture_limit, on_capture),
+                StepBudget.create(max_steps, timeout))
+            if matches is None:
+                return
+            yield MatchObject(self, string, pos, endpos, matches)
+            start, position = matches.last(0)
+            # Like the builtin re module, don't accept another empty
+            # match at the end of an empty match.
+            not_empty = start == position
+
+    def finditer_stream(self, fileobj, chunk_size=1 << 16, max_steps=None,
+                        timeout=None):
+        """finditer_stream(fileobj[, chunk_size[, max_steps[, timeout]]])
+        -> iterator.
+        Like finditer(), but read the subject from the file object
+        fileobj in chunks of chunk_size characters (or bytes).
+
+        Only the part of the file that may still contain the start of a
+        match is kept in memory: for patterns whose matches are shorter
+        than the chunks, that is at most about two chunks. The spans,
+        pos and endpos of the returned match objects are offsets into
+        the whole file: pos is always 0, and endpos is the end of the
+        part of the file that was read when the match was found.
+        max_steps and timeout limit every search in a chunk, see
+        match(). Raise ProgramTooLarge if the pattern is too large to
+        be compiled into a program."""
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+        vm = self._vm
+        if vm is None:
+            # The expression tree can't tell whether it reached the end
+            # of the subject; use a compiled program instead.
+            vm = BacktrackingVM(ProgramCompiler().compile(
+                self._expression_tree))
+        # The required literal may be in a chunk that wasn't read yet,
+        # and the end of the buffer isn't the end of the subject; only
+        # filter by the start of the matches.
+        prefilter = Prefilter(self._prefilter.prefix,
+                              first=self._prefilter.first)
+
+        buffer = fileobj.read(chunk_size)
+        offset = 0
+        position = 0
+        not_empty = False
+        eof = not buffer
+        _check_subject(self._binary, buffer)
+        while True:
+            resume = -1
+            while position <= len(buffer):
+                scanner = prefilter.scanner(buffer)
+                budget = StepBudget.create(max_steps, timeout)
+                if eof:
+                    matches = vm.search(buffer, position, scanner, not_empty,
+                                        None, None, budget)
+                else:
+                    matches, resume = vm.search_partial(
+                        buffer, position, scanner, not_empty, budget=budget)
+                    if resume >= 0:
+                        break
+                if matches is None:
+                    break
+                start, position = matches.last(0)
+                not_empty = start == position
+                # Like the spans, pos and endpos count from the start of
+                # the stream; endpos is the end of what was read so far.
+                yield MatchObject(self, buffer, 0, offset + len(buffer),
+                                  matches, offset)
+            if eof:
+                return
+            if resume > position:
+                # Every position in front of resume already failed.
+                position = resume
+                not_empty = False
+
+            # Drop everything in front of the earliest position at which
+            # a match may still start. The scanner doesn't see a prefix
+            # that is cut off by the end of the buffer.
+            keep = max(len(buffer) - len(prefilter.prefix) + 1, 0)
+            if 0 <= resume < keep:
+                keep = resume
+            keep = min(keep, len(buffer))
+            if keep > position:
+                position = keep
+                not_empty = False
+            chunk = fileobj.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[keep:] + chunk
+            offset += keep
+            position -= keep
+
+    def _new_captures(self, limit, on_capture):
+        """Return an empty Captures object that applies limit and the
+        callbacks in on_capture, or None if neither is given."""
+        if limit is None and not on_capture:
+            return None
+        callbacks = None
+        if on_capture:
+            callbacks = {self._resolve_group(group): callback
+                         for group, callback in on_capture.items()}
+        return Captures(self.groups + 1, limit, callbacks)
+
+    def _resolve_group(self, group):
+        """Translate a group name or index into the group number."""
+        if type(group) is not int:
+            try:
+                return self.groupindex[group]
+            except KeyError:
+                raise IndexError("no such group")
+        if not 0 <= group <= self.groups:
+            raise IndexError("no such group")
+        return group
+
+    def _match(self, subject, position, endpos, not_empty=False,
+               captures=None, budget=None):
+        """Match at position in subject[:endpos]; return the Captures of
+        all groups, or None. If not_empty is True, reject empty
+        matches. If captures is given, the spans are appended to it.
+        budget is the StepBudget of the match, or None."""
+        if self._vm is not None:
+            return self._vm.match(subject, position, not_empty, endpos,
+                                  captures, budget)
+        context = EvaluationContext(subject, position, endpos, budget)
+        if not self._expression_tree.matches(context):
+            return None
+        while not_empty and context.progress == position:
+            if not self._expression_tree.retry(context):
+                return None
+        if captures is None:
+            return Captures.from_matches(context.matches, self.groups + 1)
+        captures.add_matches(context.matches)
+        return captures
+
+    def _search(self, subject, position, endpos, not_empty=False,
+                captures=None, budget=None):
+        """Find the leftmost match in subject[position:endpos]; return
+        the same as _match(). If not_empty is True, reject an empty
+        match at position."""
+        scanner = self._prefilter.scanner(subject, endpos)
+        if self._vm is not None:
+            return self._vm.search(subject, position, scanner, not_empty,
+                                   endpos, captures, budget)
+        start = position
+        position = scanner.next(position)
+        while position >= 0:
+            matches = self._match(subject, position, endpos,
+                                  not_empty and position == start, captures,
+                                  budget)
+            if matches is not None:
+                return matches
+            position = scanner.next(position + 1)
+        return None
+
+    def test(self, string, pos=None, endpos=None, max_steps=None,
+             timeout=None):
+        """test(string[, pos[, endpos[, max_steps[, timeout]]]]) -> bool.
+        Return whether match() would find a match, without computing
+        the spans of the match and its groups. Patterns on the pike
+        engine are decided by the lazy DFA, which takes linear time;
+        only the engine it falls back to when its state cache thrashes
+        is limited by max_steps and timeout. Patterns on the other
+        engines have no DFA and are matched by their engine. A pattern
+        never loses its DFA because of its size: patterns whose program
+        would be too large raise ProgramTooLarge when they are
+        compiled."""
+        _check_subject(self._binary, string)
+        pos, endpos = _bounds(string, pos, endpos)
+        return self._test(string, pos, endpos, max_steps, timeout)
+
+    def _test(self, string, pos, endpos, max_steps, timeout):
+        """test() of a subject that was already checked."""
+        if endpos - pos < self._prefilter.min_length:
+            return False
+        if self._dfa is not None:
+            result = self._dfa.test(string, pos, endpos)
+            if result is not None:
+                return result
+        return self._match(string, pos, endpos, False, None,
+                           StepBudget.create(max_steps, timeout)) is not None
+
+    def test_many(self, subjects, workers=None, max_steps=None,
+                  timeout=None):
+        """test_many(subjects[, workers[, max_steps[, timeout]]]) -> mask.
+        Return whether test() is True for each string in the iterable
+        subjects. The result is a boolean array if subjects is a NumPy
+        array, else an array("b") of 0 and 1.
+
+        Each subject is still matched on its own; the batch only saves
+        the per-call work of test(): the subject types are checked once
+        per type instead of once per subject, one StepBudget is
+        restarted for every subject instead of creating a new one, and
+        pos and endpos aren't handled. The state cache of the lazy DFA
+        lives on the pattern, so it carries over from one subject to
+        the next either way. If workers is greater than 1, the batch is
+        split into chunks that are matched by a pool of that many
+        processes. max_steps and timeout limit the match of every
+        subject separately, see match()."""
+        numpy = _numpy_module(subjects)
+        mask = array("b")
+        for chunk in self._run_batch("_test_batch", subjects, workers,
+                                     max_steps, timeout):
+            mask.extend(chunk)
+        if numpy is not None:
+            return numpy.array(mask, dtype=numpy.bool_)
+        return mask
+
+    def match_many(self, subjects, workers=None, max_steps=None,
+                   timeout=None):
+        """match_many(subjects[, workers[, max_steps[, timeout]]]) -> spans.
+        Return the span of the match that match() finds in each string
+        in the iterable subjects, or (-1, -1) if there is none. The
+        result is an integer array of shape (len(subjects), 2) if
+        subjects is a NumPy array, else a SpanSequence. No match
+        objects are created. See test_many() for workers, max_steps and
+        timeout.
+
+        With the pike engine, the lazy DFA rejects subjects without
+        running the engine, but a subject it accepts is scanned again
+        by the engine to find the span. The DFA is therefore only used
+        while no more than DFA_ACCEPTS_PER_REJECT subjects matched per
+        subject that didn't."""
+        numpy = _numpy_module(subjects)
+        starts = array("q")
+        ends = array("q")
+        for chunk_starts, chunk_ends in self._run_batch(
+                "_match_batch", subjects, workers, max_steps, timeout):
+            starts.extend(chunk_starts)
+            ends.extend(chunk_ends)
+        if numpy is not None:
+            return numpy.stack((numpy.array(starts, dtype=numpy.int64),
+                                numpy.array(ends, dtype=numpy.int64)),
+                               axis=1)
+        return SpanSequence(starts, ends)
+
+    def _run_batch(self, method, subjects, workers, max_steps, timeout):
+        """Call method with subjects, or with chunks of subjects in a
+        pool of workers processes; return the list of results."""
+        if _numpy_module(subjects) is not None:
+            # Python strings are much faster to match than NumPy
+            # scalars.
+            subjects = subjects.tolist()
+        if workers is None or workers <= 1:
+            return [getattr(self, method)(subjects, max_steps, timeout)]
+        if not isinstance(subjects, list):
+            subjects = list(subjects)
+        size = max(-(-len(subjects) // (workers * CHUNKS_PER_WORKER)), 1)
+        chunks = [subjects[i:i + size]
+                  for i in range(0, len(subjects), size)]
+        with ProcessPoolExecutor(workers, initializer=_start_worker,
+                                 initargs=(self,)) as pool:
+            return list(pool.map(_run_in_worker, [method] * len(chunks),
+                                 chunks, [max_steps] * len(chunks),
+                                 [timeout] * len(chunks)))
+
+    def _test_batch(self, subjects, max_steps, timeout):
+        """test_many() of subjects in this process."""
+        mask = array("b")
+        checked = set()
+        min_length = self._prefilter.min_length
+        dfa = self._dfa
+        budget = StepBudget.create(max_steps, timeout)
+        for subject in subjects:
+            if type(subject) not in checked:
+                _check_subject(self._binary, subject)
+                checked.add(type(subject))
+            end = len(subject)
+            result = None
+            if end < min_length:
+                result = False
+            elif dfa is not None:
+                result = dfa.test(subject, 0, end)
+            if result is None:
+                if budget is not None:
+                    budget.restart()
+                result = self._match(subject, 0, end, False, None,
+                                     budget) is not None
+            mask.append(result)
+        return mask
+
+    def _match_batch(self, subjects, max_steps, timeout):
+        """Return the starts and ends of match_many() of subjects in
+        this process."""
+        starts = array("q")
+        ends = array("q")
+        checked = set()
+        min_length = self._prefilter.min_length
+        dfa = self._dfa
+        budget = StepBudget.create(max_steps, timeout)
+        # Subjects with and without a match so far.
+        accepted = rejected = 0
+        for subject in subjects:
+            if type(subject) not in checked:
+                _check_subject(self._binary, subject)
+                checked.add(type(subject))
+            end = len(subject)
+            if end < min_length:
+                starts.append(-1)
+                ends.append(-1)
+                continue
+            matches = None
+            if (dfa is None
+                    or accepted > DFA_ACCEPTS_PER_REJECT * (rejected + 1)
+                    or dfa.test(subject, 0, end) is not False):
+                if budget is not None:
+                    budget.restart()
+                matches = self._match(subject, 0, end, False, None, budget)
+            if matches is None:
+                rejected += 1
+                starts.append(-1)
+                ends.append(-1)
+            else:
+                accepted += 1
+                start, end = matches.last(0)
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
+    def __repr__(self):
+        return "cre.compile(%r)" % (self.pattern,)
+
+
+def _numpy_module(subjects):
+    """Return the numpy module if subjects is a NumPy array, else None.
+    NumPy is optional: if it wasn't imported, subjects can't be one of
+    its arrays."""
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(subjects, numpy.ndarray):
+        return numpy
+    return None
+
+
+# The regex object that the batches of a worker process of
+# match_many() and test_many() are matched with. It is only sent to
+# each worker once.
+_worker_regex = None
+
+
+def _start_worker(regex):
+    global _worker_regex
+    _worker_regex = regex
+
+
+def _run_in_worker(method, subjects, max_steps, timeout):
+    return getattr(_worker_regex, method)(subjects, max_steps, timeout)
+
+
+class MatchObject:
+    """The result of re.match() and re.search().
+    Match objects always have a boolean value of True.
+
+    The spans of all matches of every capturing group are kept in the
+    Captures object that the engine produced; the last one is the
+    result that the builtin re module would report. captures(),
+    spans(), starts() and ends() give access to all of them.
+
+    Matches found by finditer_stream() only know the part of the
+    stream that was buffered when the match was found; string is that
+    part and offset is its position in the stream. Their spans, pos and
+    endpos are positions in the stream.
+
+    """
+
+    __slots__ = ("re", "pos", "endpos", "string", "offset", "_captures")
+
+    def __init__(self, re, string, pos, endpos, captures, offset=0):
+        self.re = re
+        self.pos = 0 if pos is None else pos
+        self.endpos = len(string) if endpos is None else endpos
+        self.string = string
+        self.offset = offset
+
+        # Spans of all matches of the capturing groups. The engines
+        # count offsets from the start of string, so only matches in a
+        # stream need to be shifted.
+        captures.shift(offset)
+        captures.trim()
+        self._captures = captures
+
+    @property
+    def lastindex(self):
+        raise NotImplementedError()
+
+    @property
+    def lastgroup(self):
+        raise NotImplementedError()
+
+    #'lastgroup', 'lastindex', regs',
+
+    def _resolve_group(self, group):
+        """Translate a group name or index into the group number."""
+        return self.re._resolve_group(group)
+
+    def _last_span(self, group):
+        """Return the last span of group, or None if it didn't match."""
+        return self._captures.last(self._resolve_group(group))
+
+    def _columns(self, group):
+        """Return the start and end columns of group."""
+        group = self._resolve_group(group)
+        captures = self._captures
+        if group >= len(captures.starts):
+            return array("q"), array("q")
+        return captures.starts[group], captures.ends[group]
+
+    def captures(self, group=0):
+        """captures([group=0]) -> sequence.
+        Return the substrings of all matches of group, in the order
+        in which they were matched. The substrings are only sliced
+        from string when they are accessed."""
+        starts, ends = self._columns(group)
+        return CaptureSequence(self.string, starts, ends, self.offset)
+
+    def spans(self, group=0):
+        """spans([group=0]) -> sequence.
+        Return the (start, end) spans of all matches of group."""
+        return SpanSequence(*self._columns(group))
+
+    def starts(self, group=0):
+        """starts([group=0]) -> memoryview.
+        Return a read-only view of the start offsets of all matches of
+        group, without copying them."""
+        return memoryview(self._columns(group)[0]).toreadonly()
+
+    def ends(self, group=0):
+        """ends([group=0]) -> memoryview.
+        Return a read-only view of the end offsets of all matches of
+        group, without copying them."""
+        return memoryview(self._columns(group)[1]).toreadonly()
+
+    def expand(self):
+        """expand(template) -> str.
+
+        Return the string obtained by doing backslash substitution
+        on the string template, as done by the sub() method.
+
+        """
+        raise NotImplementedError()
+
+    def group(self, *groups):
+        """group([group1, ...]) -> str or tuple.
+        Return subgroup(s) of the match by indices or names.
+        For 0 returns the entire match."""
+        def __group_string(group):
+            span = self._last_span(group)
+            if span is None:
+                return None
+            return substring(self.string, span[0] - self.offset,
+                             span[1] - self.offset)
+
+        if len(groups) == 0:
+            return __group_string(0)
+        if len(groups) == 1:
+            return __group_string(groups[0])
+        return tuple(map(__group_string, groups))
+
+    def groups(self, default=None):
+        """groups([default=None]) -> tuple.
+        Return a tuple containing all the subgroups of the match, from 1.
+        The default argument is used for groups
+        that did not participate in the match"""
+        return tuple(map(lambda x: x if x is not None else default,
+                         (self.group(g) for g in range(1, self.re.groups + 1))))
+
+    def groupdict(self, default=None):
+        """groupdict([default=None]) -> dict.
+        Return a dictionary containing all the named subgroups of the match,
+        keyed by the subgroup name. The default argument is used for groups
+        that did not participate in the match"""
+        result = {}
+        for name in self.re.groupindex:
+            value = self.group(name)
+            result[name] = value if value is not None else default
+        return result
+
+    def start(self, group=0):
+        """start([group=0]) -> int.
+
+        Return index of the start of the substring matched by group.
+
+        """
+        span = self._last_span(group)
+        return -1 if span is None else span[0]
+
+    def end(self, group=0):
+        """end([group=0]) -> int.
+        Return index of the end of the substring matched by group."""
+        span = self._last_span(group)
+        return -1 if span is None else span[1]
+
+    def span(self, group=0):
+        """span([group]) -> tuple.
+        For MatchObject m, return the 2-tuple (m.start(group), m.end(group))."""
+        return (self.start(group), self.end(group))
+
+    def __bool__(self):
+        """Match objects always have a boolean value of True.
+        Since match() and search() return None when there is no match,
+        you can test whether there was a match with a simple if
+        statement."""
+        return True
+
+    def __repr__(self):
+        """return repr(self)."""
+        return ("<cre.MatchObject object; span=({0}, {1}), match={2!r}>"
+                .format(self.start(), self.end(), self.group()))
+
+    __str__ = __repr__
+    """return str(self)."""
@@ -0,0 +1,109 @@
+from .parser import *
+from .regex import _bounds, _check_subject
+
+
+class RegexSet:
+    """A set of patterns that are matched against a subject together.
+
+    match() and search() return the indices of all patterns that
+    match, like calling match() or search() of every pattern, but the
+    subject is only read once: all patterns are combined into a single
+    MultiDFA.
+
+    Patterns with back references can't be decided by the automaton.
+    It treats their back references as matching any string, so it
+    acts as a combined prefilter for them: only the patterns it
+    reports are matched individually, with their own engine. The same
+    happens for all patterns if the state cache of the automaton
+    thrashes, and for patterns whose program would be too large, see
+    ProgramTooLarge.
+
+    patterns may contain pattern strings, which are compiled with
+    parser (by default the one behind cre.compile(), so its cache is
+    shared), and RegexObjects. All patterns must be either strings or
+    bytes.
+
+    """
+
+    def __init__(self, patterns, flags=0, parser=None):
+        if parser is None:
+            parser = default_parser
+        self.regexes = tuple(p if isinstance(p, RegexObject)
+                             else parser.compile(p, flags) for p in patterns)
+        self.patterns = tuple(r.pattern for r in self.regexes)
+        binaries = set(r._binary for r in self.regexes)
+        if len(binaries) > 1:
+            raise TypeError("cannot mix string and bytes patterns")
+        self._binary = binaries.pop() if binaries else False
+
+        programs = []
+        # Indices of the patterns the automaton can only prefilter.
+        self._fallback = set()
+        for index, regex in enumerate(self.regexes):
+            if regex._vm is not None:
+                programs.append(regex._vm._program)
+            else:
+                try:
+                    programs.append(
+                        ProgramCompiler().compile(regex._expression_tree))
+                except ProgramTooLarge:
+                    # Let the automaton report the pattern everywhere;
+                    # it is then matched individually.
+                    programs.append(Program([(MATCH,)], ()))
+                    self._fallback.add(index)
+                    continue
+            if regex.engine != "pike" and any(
+                    isinstance(e, BackReferenceExpression)
+                    for e in regex._expression_tree.walk()):
+                self._fallback.add(index)
+
+        # The state cache grows with the size of the combined program;
+        # give every pattern some room.
+        max_cache_bytes = max(1 << 20, 4096 * len(programs))
+        self._anchored = MultiDFA(programs, False, max_cache_bytes)
+        self._unanchored = MultiDFA(programs, True, max_cache_bytes)
+
+    def match(self, string, pos=None, endpos=None, max_steps=None,
+              timeout=None):
+        """match(string[, pos[, endpos[, max_steps[, timeout]]]]) -> list.
+        Return the sorted indices of the patterns whose match() finds a
+        match. max_steps and timeout limit every pattern that has to be
+        matched individually."""
+        return self._matching(self._anchored, "match", string, pos, endpos,
+                              max_steps, timeout)
+
+    def search(self, string, pos=None, endpos=None, max_steps=None,
+               timeout=None):
+        """search(string[, pos[, endpos[, max_steps[, timeout]]]]) -> list.
+        Return the sorted indices of the patterns whose search() finds
+        a match."""
+        return self._matching(self._unanchored, "search", string, pos,
+                              endpos, max_steps, timeout)
+
+    def _matching(self, dfa, method, string, pos, endpos, max_steps,
+                  timeout):
+        _check_subject(self._binary, string)
+        pos, endpos = _bounds(string, pos, endpos)
+        if pos > endpos or not self.regexes:
+            return []
+        found = dfa.matching(string, pos, endpos)
+        if found is None:
+            candidates = range(len(self.regexes))
+            found = set()
+        else:
+            candidates = sorted(found & self._fallback)
+            found -= self._fallback
+        for index in candidates:
+            regex = self.regexes[index]
+            result = getattr(regex, method)(string, pos, endpos,
+                                            max_steps=max_steps,
+                                            timeout=timeout)
+            if result is not None:
+                found.add(index)
+        return sorted(found)
+
+    def __len__(self):
+        return len(self.regexes)
+
+    def __repr__(self):
+        return "cre.RegexSet(%r)" % (list(self.patterns),)
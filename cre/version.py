@@ -0,0 +1,4 @@
+# Version of the library, read by setup.py. Serialized patterns record
+# it and are only loaded by the same version, because the classes of
+# pickled expressions and programs may change between versions.
+__version__ = "0.1.0"
@@ -0,0 +1,371 @@
+from array import array
+from .captures import *
+from .compiler import *
+from .prefilter import *
+
+
+class BacktrackingVM:
+    """Execute a Program by depth-first search with an explicit stack.
+
+    This engine explores the same alternatives in the same order as
+    the recursive expression tree, but it runs in a single loop: every
+    SPLIT pushes the alternative target on a stack of choice points,
+    and when an instruction fails, the most recent choice point is
+    resumed. The search depth is therefore limited only by memory, and
+    unlike the PikeVM, the VM can match back references.
+
+    Register writes are recorded in an undo trail. A choice point
+    stores the length of the trail and of the capture history at the
+    time it was created; resuming it undoes all later writes. The
+    capture history is a flat array of (group, start, end) triples.
+
+    The instructions are split into parallel lists of opcodes and
+    operands, so the loop only performs list lookups.
+
+    Unless memoize is False, the VM remembers which loop heads it
+    entered at which position in a MemoTable. Reaching the same loop
+    head at the same position again can't lead to a match, because the
+    first visit already explored everything that follows it; this
+    bounds the work of a match to the number of loop heads times the
+    length of the subject. Loop heads from which a BACKREF can be
+    reached are not memoized, because the outcome there depends on
+    what the groups captured on the way.
+
+    If a StepBudget is passed to match() or search(), every resumed
+    choice point, including the final failure of each attempt, is
+    charged as a step.
+
+    """
+
+    def __init__(self, program, memoize=True):
+        self._program = program
+        instructions = program.instructions
+        self._opcodes = [i[0] for i in instructions]
+        self._operands1 = [i[1] if len(i) > 1 else None for i in instructions]
+        self._operands2 = [i[2] if len(i) > 2 else None for i in instructions]
+        self._memo_rows, self._enclosing_loops = (
+            _memo_rows(program) if memoize else ([-1] * len(program), []))
+        self._memo_size = max(self._memo_rows, default=-1) + 1
+
+    def match(self, subject, pos=0, not_empty=False, endpos=None,
+              captures=None, budget=None):
+        """Match the program at pos, treating endpos as the end of
+        subject.
+
+        Return the Captures of all groups, or None if the program
+        doesn't match. If not_empty is True, empty matches are rejected.
+        If captures is given, the spans are appended to it, but only
+        once the match succeeded: until then, any of them may still be
+        retracted.
+
+        """
+        return self._match(subject, pos, not_empty, endpos, captures,
+                           None, budget)[0]
+
+    def _match(self, subject, pos, not_empty, endpos=None, captures=None,
+               memo=None, budget=None):
+        """Return the result of match() and whether an instruction
+        failed only because the end of subject was reached.
+
+        memo is the MemoTable of the search that the match is part of;
+        by default, a new one is used.
+
+        """
+        opcodes = self._opcodes
+        operands1 = self._operands1
+        operands2 = self._operands2
+        slots = len(self._program.slot_names)
+        slot_groups = self._program.slot_groups
+        memo_rows = self._memo_rows
+        enclosing_loops = self._enclosing_loops
+
+        # Registers: start of the current repetition of each slot, span
+        # of the last repetition not committed yet, last committed span
+        # and start of the current repetition of each loop.
+        starts = [None] * slots
+        pending = [None] * slots
+        last = [None] * slots
+        marks = [None] * self._program.loop_count
+        history = array("q")
+        trail = []
+        choices = []
+
+        end = len(subject) if endpos is None else min(endpos, len(subject))
+        forbidden_end = pos if not_empty else -1
+        if memo is None:
+            memo = self._new_memo()
+        if memo is not None:
+            visited = memo.visited
+            memo_rows_count = memo.rows
+        hit_end = False
+        pc = 0
+        position = pos
+        while True:
+            opcode = opcodes[pc]
+            if opcode == CHAR:
+                if position < end and subject[position] == operands1[pc]:
+                    pc += 1
+                    position += 1
+                    continue
+            elif opcode == CLASS:
+                if position < end and subject[position] in operands1[pc]:
+                    pc += 1
+                    position += 1
+                    continue
+            elif opcode == RANGE:
+                if (position < end and operands1[pc] <= subject[position]
+                        <= operands2[pc]):
+                    pc += 1
+                    position += 1
+                    continue
+            elif opcode == SWITCH:
+                if position < end:
+                    target = operands1[pc].get(subject[position])
+                    if target is not None:
+                        pc = target
+                        position += 1
+                        continue
+            elif opcode == SPLIT:
+                row = memo_rows[pc]
+                if row >= 0 and memo is not None and all(
+                        marks[loop] != position
+                        for loop in enclosing_loops[row]):
+                    key = position * memo_rows_count + row
+                    if key in visited:
+                        # Everything from here on already failed.
+                        pc = -1
+                    else:
+                        visited.add(key)
+                if pc >= 0:
+                    choices.append((operands2[pc], position, len(trail),
+                                    len(history)))
+                    pc = operands1[pc]
+                    continue
+            elif opcode == JMP:
+                pc = operands1[pc]
+                continue
+            elif opcode == SAVE_START:
+                slot = operands1[pc]
+                trail.append((starts, slot, starts[slot]))
+                starts[slot] = position
+                pc += 1
+                continue
+            elif opcode == SAVE_END:
+                slot = operands1[pc]
+                trail.append((pending, slot, pending[slot]))
+                pending[slot] = (starts[slot], position)
+                pc += 1
+                continue
+            elif opcode == COMMIT:
+                slot = operands1[pc]
+                span = pending[slot]
+                if span is not None:
+                    if slot_groups[slot] is not None:
+                        history.extend((slot_groups[slot], span[0], span[1]))
+                    trail.append((last, slot, last[slot]))
+                    last[slot] = span
+                    trail.append((pending, slot, span))
+                    pending[slot] = None
+                pc += 1
+                continue
+            elif opcode == MARK:
+                loop = operands1[pc]
+                trail.append((marks, loop, marks[loop]))
+                marks[loop] = position
+                pc += 1
+                continue
+            elif opcode == LOOP:
+                if marks[operands1[pc]] != position:
+                    pc = operands2[pc]
+                else:
+                    # The repetition was empty; leave the loop.
+                    pc += 1
+                continue
+            elif opcode == BACKREF:
+                span = last[operands1[pc]]
+                if span is not None:
+                    length = span[1] - span[0]
+                    if occurs_at(subject, span[0], span[1], position, end):
+                        pc += 1
+                        position += length
+                        continue
+                    if (position + length > end and occurs_at(
+                            subject, position, end, span[0])):
+                        hit_end = True
+            elif position != forbidden_end:
+                return self._build_captures(history, captures), hit_end
+
+            # The current instruction failed; resume the most recent
+            # choice point.
+            if budget is not None:
+                budget.steps += 1
+                if budget.steps >= budget.next_check:
+                    budget.check()
+            if position >= end:
+                # More characters might have let it succeed.
+                hit_end = True
+            if not choices:
+                return None, hit_end
+            pc, position, trail_length, history_length = choices.pop()
+            while len(trail) > trail_length:
+                registers, index, value = trail.pop()
+                registers[index] = value
+            del history[history_length:]
+
+    def search(self, subject, pos=0, scanner=None, not_empty=False,
+               endpos=None, captures=None, budget=None):
+        """Find the leftmost match in subject[pos:endpos] by matching at
+        every candidate position returned by scanner, or at every
+        position if scanner is None. If not_empty is True, an empty
+        match at pos is rejected. Return the same as match()."""
+        if scanner is None:
+            scanner = Prefilter().scanner(subject, endpos)
+        # A loop head that failed at a position fails no matter where
+        # the match started, so all attempts share one memo table. The
+        # attempt that rejects empty matches may fail where the others
+        # succeed and gets its own.
+        memo = self._new_memo()
+        position = scanner.next(pos)
+        while position >= 0:
+            if not_empty and position == pos:
+                matches = self._match(subject, position, True, endpos,
+                                      captures, None, budget)[0]
+            else:
+                matches = self._match(subject, position, False, endpos,
+                                      captures, memo, budget)[0]
+            if matches is not None:
+                return matches
+            position = scanner.next(position + 1)
+        return None
+
+    def search_partial(self, subject, pos=0, scanner=None, not_empty=False,
+                       budget=None):
+        """Like search(), but also report whether the result depends on
+        what follows the end of subject.
+
+        Return a tuple (matches, resume). resume is -1 if appending to
+        subject can't change the result; else it is the earliest
+        position at which a match may start once more characters are
+        known, and matches must not be trusted.
+
+        """
+        if scanner is None:
+            scanner = Prefilter().scanner(subject)
+        memo = self._new_memo()
+        position = scanner.next(pos)
+        while position >= 0:
+            if not_empty and position == pos:
+                matches, hit_end = self._match(subject, position, True,
+                                               None, None, None, budget)
+            else:
+                matches, hit_end = self._match(subject, position, False,
+                                               None, None, memo, budget)
+            if hit_end:
+                # Whatever is found at later positions isn't final.
+                return matches, position
+            if matches is not None:
+                return matches, -1
+            position = scanner.next(position + 1)
+        return None, -1
+
+    def _new_memo(self):
+        """Return an empty MemoTable, or None if no loop head is
+        memoized."""
+        if not self._memo_size:
+            return None
+        return MemoTable(self._memo_size)
+
+    def _build_captures(self, history, captures=None):
+        """Collect the capture history into a new Captures object, or
+        append it to captures."""
+        if captures is not None:
+            for i in range(0, len(history), 3):
+                captures.append(history[i], history[i + 1], history[i + 2])
+            return captures
+        captures = Captures(self._program.group_count)
+        starts = captures.starts
+        ends = captures.ends
+        for i in range(0, len(history), 3):
+            starts[history[i]].append(history[i + 1])
+            ends[history[i]].append(history[i + 2])
+        return captures
+
+
+class MemoTable:
+    """A set of (loop head, position) pairs that the BacktrackingVM has
+    visited.
+
+    Each pair is stored as the integer position * rows + row, where row
+    is the MemoTable row of the loop head. The table only grows with
+    the pairs actually visited, so a match that fails after a few
+    characters costs the same no matter how long the subject is.
+
+    """
+
+    __slots__ = ("visited", "rows")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.visited = set()
+
+
+def _memo_rows(program):
+    """Choose the loop heads of program that can be memoized.
+
+    Return a list that maps every instruction to its row in a
+    MemoTable, or -1, and a list that holds the loops enclosing the
+    loop head of each row. A loop head can only be memoized while every
+    enclosing loop has consumed characters in its current repetition:
+    otherwise, LOOP may still end that repetition as empty, which
+    depends on more than the position.
+
+    """
+    instructions = program.instructions
+
+    def __successors(pc):
+        opcode = instructions[pc][0]
+        if opcode == MATCH:
+            return ()
+        if opcode == JMP:
+            return (instructions[pc][1],)
+        if opcode == SPLIT:
+            return instructions[pc][1:]
+        if opcode == LOOP:
+            return (instructions[pc][2], pc + 1)
+        if opcode == SWITCH:
+            return tuple(instructions[pc][1].values())
+        return (pc + 1,)
+
+    # Find the instructions from which a BACKREF can be reached.
+    predecessors = [[] for _ in instructions]
+    for pc in range(len(instructions)):
+        for successor in __successors(pc):
+            predecessors[successor].append(pc)
+    reaches_backref = [i[0] == BACKREF for i in instructions]
+    pending = [pc for pc, value in enumerate(reaches_backref) if value]
+    while pending:
+        for predecessor in predecessors[pending.pop()]:
+            if not reaches_backref[predecessor]:
+                reaches_backref[predecessor] = True
+                pending.append(predecessor)
+
+    # Every MARK starts a repetition of its loop that ends at the next
+    # LOOP of the same loop.
+    bodies = []
+    for pc, instruction in enumerate(instructions):
+        if instruction[0] == MARK:
+            end = next(i for i in range(pc, len(instructions))
+                       if instructions[i][0] == LOOP
+                       and instructions[i][1] == instruction[1])
+            bodies.append((pc, end, instruction[1]))
+
+    rows = [-1] * len(instructions)
+    enclosing_loops = []
+    heads = set(i[2] for i in instructions if i[0] == LOOP)
+    for pc in sorted(heads):
+        if instructions[pc][0] != SPLIT or reaches_backref[pc]:
+            continue
+        rows[pc] = len(enclosing_loops)
+        enclosing_loops.append(tuple(loop for start, end, loop in bodies
+                                     if start < pc <= end))
+    return rows, enclosing_loops
@@ -1,9 +1,16 @@
+import os
+import re
 from setuptools import setup
 
+# The version is defined in cre/version.py only; it is read rather
+# than imported, so setup.py doesn't depend on the package.
+with open(os.path.join(os.path.dirname(__file__), "cre", "version.py")) as f:
+	version = re.search(r'__version__ = "(.*)"', f.read()).group(1)
+
 setup(
 	name="cre",
 	packages=["cre"],
-	version="0.1.0",
+	version=version,
 	author="Philipp Schiffmann",
 	author_email="philippschiffmann@icloud.com",
 	url="https://github.com/elaru/python3-cre",
@@ -1,9 +1,27 @@
+import copy
+import io
+import mmap
+import pickle
+import random
 import sys
+import tempfile
+import threading
+import tracemalloc
 import cre
 import unittest
 from mock import Mock
 from test import re_tests
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class MockExpression(cre.Expression):
+    """Expressions are slotted; this subclass has a __dict__, so tests
+    can replace _match_end with a Mock."""
+
 
 class TestRepetitionBehaviourWithCharacterExpression(unittest.TestCase):
 
@@ -24,7 +42,7 @@ class TestRepetitionBehaviourWithCharacterExpression(unittest.TestCase):
         e.matches(self.c)
         self.assertEqual(self.c._progress, 8)
 
-        self.assertEqual(self.c._matches, {"foo": [
+        self.assertEqual(self.c.matches, {"foo": [
             {"start": 0, "end": 1},
             {"start": 2, "end": 3},
             {"start": 7, "end": 8}
@@ -36,7 +54,7 @@ class TestRepetitionBehaviourWithCharacterExpression(unittest.TestCase):
         e.matches(self.c)
         e.matches(self.c)
         e.matches(self.c)
-        self.assertEqual(e._matches, [
+        self.assertEqual(self.c.expression_state(e), [
             [{"start": 0, "end": 1}, {"start": 1, "end": 2}],
             [{"start": 2, "end": 3}, {"start": 3, "end": 4}],
             [{"start": 4, "end": 5}]
@@ -49,7 +67,7 @@ class TestRepetitionBehaviourWithCharacterExpression(unittest.TestCase):
         e.matches(self.c)
         e.matches(self.c)
         e.matches(self.c)
-        self.assertEqual(e._matches, [
+        self.assertEqual(self.c.expression_state(e), [
             [{"start": 0, "end": 1}, {"start": 1, "end": 2}],
             [{"start": 2, "end": 3}, {"start": 3, "end": 4}]
         ])
@@ -58,24 +76,25 @@ class TestRepetitionBehaviourWithCharacterExpression(unittest.TestCase):
         self.c._progress = 5
         e = cre.CharacterExpression("a", min_repetitions=2,
                                     max_repetitions=4, names=("foo",))
-        e._matches = [[
+        self.c.expression_state(e)[:] = [[
             {"start": 0, "end": 1},
             {"start": 1, "end": 2},
             {"start": 2, "end": 3},
             {"start": 3, "end": 4}
         ]]
-        self.c._matches["foo"] = [{"start": 3, "end": 4}]
+        self.c.push_match(("foo",), self.c.expression_state(e)[-1])
+        self.assertEqual(self.c.matches["foo"], [{"start": 3, "end": 4}])
 
         self.assertEqual(e.retry(self.c), True)
-        self.assertEqual(self.c._matches["foo"],
+        self.assertEqual(self.c.matches["foo"],
                          [{"start": 2, "end": 3}])
 
         self.assertEqual(e.retry(self.c), True)
-        self.assertEqual(self.c._matches["foo"],
+        self.assertEqual(self.c.matches["foo"],
                          [{"start": 1, "end": 2}])
 
         self.assertEqual(e.retry(self.c), False)
-        self.assertEqual(self.c._matches, {})
+        self.assertEqual(self.c.matches, {})
 
     def test_retry_nongreedy_iterates_up_to_max_repetitions(self):
         e = cre.CharacterExpression("a", min_repetitions=1,
@@ -85,23 +104,23 @@ class TestRepetitionBehaviourWithCharacterExpression(unittest.TestCase):
         e.matches(self.c)
 
         self.assertEqual(e.retry(self.c), True)
-        self.assertEqual(self.c._matches["foo"],
+        self.assertEqual(self.c.matches["foo"],
                          [{"start": 1, "end": 2}])
         self.assertEqual(self.c._progress, 2)
 
         self.assertEqual(e.retry(self.c), True)
-        self.assertEqual(self.c._matches["foo"],
+        self.assertEqual(self.c.matches["foo"],
                          [{"start": 2, "end": 3}])
         self.assertEqual(self.c._progress, 3)
 
         self.assertEqual(e.retry(self.c), False)
-        self.assertEqual(self.c._matches, {})
+        self.assertEqual(self.c.matches, {})
         self.assertEqual(self.c._progress, 0)
 
     def test_unnamed_expression_does_not_store_result_in_context(self):
         e = cre.CharacterExpression("a")
         e.matches(self.c)
-        self.assertEqual(self.c._matches, {})
+        self.assertEqual(self.c.matches, {})
 
     def test_match_result_assignment_to_context(self):
         p = cre.Parser()
@@ -124,7 +143,6 @@ class TestRepetitionBehaviourWithCharacterExpression(unittest.TestCase):
         # re.match("(a(b*))+", "aba").group(2) -> ''
         c = cre.EvaluationContext("aba")
         e = p.parse("(a(b*))+")
-        e._children[0]._children[1].foo = 1
         e.matches(c)
         self.assertEqual(c.flattened_matches,
             { 0: {"start": 0, "end": 3},
@@ -191,14 +209,120 @@ class TestCharacterRangeExpression(unittest.TestCase):
         self.assertEqual(e.matches(c), True)
 
 
+class TestCharacterClassExpression(unittest.TestCase):
+
+    def test_expression_matches_characters_in_set(self):
+        e = cre.CharacterClassExpression(
+            cre.CharacterSet.get(((ord("a"), ord("c")), (0x3b1, 0x3c9))))
+        for subject, result in (("b", {"start": 0, "end": 1}), ("d", None),
+                                ("\u03b4", {"start": 0, "end": 1}),
+                                ("\u0391", None)):
+            self.assertEqual(e._matches_once(cre.EvaluationContext(subject)),
+                             result)
+
+    def test_negated_set(self):
+        s = cre.CharacterSet.get(cre.category_ranges("d"), negated=True)
+        self.assertNotIn("7", s)
+        self.assertNotIn("\u0663", s)
+        self.assertIn("x", s)
+
+    def test_equal_sets_are_interned(self):
+        p = cre.Parser()
+        first = p.parse("[0-9a-f]")._children[0]._set
+        self.assertIs(p.parse("[a-f0-9]")._children[0]._set, first)
+        self.assertIs(p.parse("[\\d]")._children[0]._set,
+                      p.parse("\\d")._children[0]._set)
+
+    def test_parsing_of_character_groups(self):
+        p = cre.Parser()
+        for pattern, ranges, negated in (
+                ("[abc]", ((97, 99),), False),
+                ("[^a-c_]", ((95, 95), (97, 99)), True),
+                ("[]-]", ((45, 45), (93, 93)), False),
+                ("[\\s]", cre.category_ranges("s"), False)):
+            e = p.parse(pattern)._children[0]
+            self.assertEqual((e._set.ranges, e._set.negated),
+                             (ranges, negated))
+            self.assertEqual(str(e), pattern)
+        self.assertRaises(Exception, p.parse, "[ab")
+        for pattern in ("[\\d-z]", "[a-\\d]"):
+            self.assertRaises(Exception, p.parse, pattern)
+        with self.assertRaisesRegex(Exception, "z-a at position 2"):
+            p.parse("x[z-a]")
+
+    def test_special_sequences_match_like_re(self):
+        for pattern, subject, span in ((r"\s+", " \t\u3000x", (0, 3)),
+                                       (r"\w+", "h\u00e9_1 x", (0, 4)),
+                                       (r"\D\S\W", "a\u00e9!", (0, 3))):
+            for engine in ("backtrack", "vm", "pike"):
+                m = cre.Parser().compile(pattern, engine=engine).match(subject)
+                self.assertEqual(m.span(), span)
+
+
+class TestCharacterRunExpression(unittest.TestCase):
+
+    def run_expression(self, pattern):
+        tree = cre.Optimizer().optimize(cre.Parser().parse(pattern))
+        return [e for e in tree.walk()
+                if isinstance(e, cre.CharacterRunExpression)][0]
+
+    def test_optimizer_creates_runs(self):
+        for pattern, source in (("a*b", "a"), ("x[a-c]+", "[a-c]"),
+                                ("\\s*?", "\\s")):
+            self.assertEqual(self.run_expression(pattern)._source, source)
+        tree = cre.Optimizer().optimize(cre.Parser().parse("a{2,5}b?"))
+        self.assertFalse(any(isinstance(e, cre.CharacterRunExpression)
+                             for e in tree.walk()))
+
+    def test_greedy_run_counts_down(self):
+        e = self.run_expression("a+a")
+        c = cre.EvaluationContext("xaaab", 1)
+        self.assertEqual(e.matches(c), True)
+        run = c.expression_state(e)[-1]
+        self.assertIsInstance(run, cre.CharacterRun)
+        self.assertEqual((run.start, len(run), c.progress), (1, 3, 4))
+        self.assertEqual(run[-1], {"start": 3, "end": 4})
+        self.assertEqual(e.retry(c), True)
+        self.assertEqual(c.progress, 3)
+        self.assertEqual(e.retry(c), True)
+        self.assertEqual(e.retry(c), False)
+        self.assertEqual((c.progress, c.expression_state(e)), (1, []))
+
+    def test_lazy_run_counts_up(self):
+        e = self.run_expression("[ab]*?c")
+        c = cre.EvaluationContext("abc")
+        self.assertEqual(e.matches(c), True)
+        self.assertEqual(c.progress, 0)
+        self.assertEqual(e.retry(c), True)
+        self.assertEqual(e.retry(c), True)
+        self.assertEqual(c.progress, 2)
+        self.assertEqual(e.retry(c), False)
+
+    def test_runs_match_like_unoptimized_tree(self):
+        p = cre.Parser()
+        for pattern, subject in (("(a*)(a+)b", "aaab"),
+                                 ("x(\\d*?)(\\d)y", "x123y"),
+                                 ("(?:(b+)a)+", "bbabab"), (b"(a*)b", b"aab"),
+                                 ("(?P<n>[^,]*),", "ab,cd,")):
+            results = []
+            compiled = p.compile(pattern)
+            for tree in (p.parse(pattern), cre.Optimizer().optimize(
+                    p.parse(pattern))):
+                r = cre.RegexObject(tree, pattern, compiled.groups,
+                                    compiled.groupindex, engine="backtrack")
+                results.append([(m.span(), m.groups(), m.captures(1))
+                                for m in r.finditer(subject)])
+            self.assertEqual(results[0], results[1], pattern)
+
+
 class TestAnyOfOptionsExpression(unittest.TestCase):
 
     def setUp(self):
         self.c = cre.EvaluationContext("abcd")
-        children = (cre.Expression(), cre.Expression(), cre.Expression())
-        children[0]._matches_once = Mock(side_effect=({"start": 0, "end": 1}, None, None, None))
-        children[1]._matches_once = Mock(side_effect=({"start": 1, "end": 2}, None, None))
-        children[2]._matches_once = Mock(side_effect=({"start": 2, "end": 3}, None))
+        children = (MockExpression(), MockExpression(), MockExpression())
+        children[0]._match_end = Mock(side_effect=(1, None, None, None))
+        children[1]._match_end = Mock(side_effect=(2, None, None))
+        children[2]._match_end = Mock(side_effect=(3, None))
         self.e = cre.AnyOfOptionsExpression(children)
 
     def test_expression_tries_children_in_order(self):
@@ -209,11 +333,11 @@ class TestAnyOfOptionsExpression(unittest.TestCase):
         self.assertEqual(self.c._progress, 3)
 
     def test_only_matching_option_changes_state(self):
-        self.e._children[0]._matches_once.side_effect = (None,)
+        self.e._children[0]._match_end.side_effect = (None,)
         self.e.matches(self.c)
-        self.assertEqual(self.e._children[0]._matches, [])
-        self.assertEqual(self.e._children[1]._matches, [[{"start": 1, "end": 2}]])
-        self.assertEqual(self.e._children[2]._matches, [])
+        self.assertEqual(self.c.expression_state(self.e._children[0]), [])
+        self.assertEqual(self.c.expression_state(self.e._children[1]), [0])
+        self.assertEqual(self.c.expression_state(self.e._children[2]), [])
 
     def test_retry_resets_state_of_all_children(self):
         """todo: properly define the behaviour of this expression!
@@ -227,35 +351,127 @@ class TestAnyOfOptionsExpression(unittest.TestCase):
         return
         self.e._max_repetitions = 2
         self.assertEqual(self.e.matches(self.c), True)
-        self.assertEqual(self.e._matches, [[
+        self.assertEqual(self.c.expression_state(self.e), [[
             {"start": 0, "end": 1, "matching_child": self.e._children[0]},
             {"start": 1, "end": 2, "matching_child": self.e._children[1]}]])
-        self.assertEqual(self.e._children[0]._matches, [[{"start": 0, "end": 1}]])
-        self.assertEqual(self.e._children[1]._matches, [[{"start": 1, "end": 2}]])
-        self.assertEqual(self.e._children[2]._matches, [])
+        self.assertEqual(self.c.expression_state(self.e._children[0]), [[{"start": 0, "end": 1}]])
+        self.assertEqual(self.c.expression_state(self.e._children[1]), [[{"start": 1, "end": 2}]])
+        self.assertEqual(self.c.expression_state(self.e._children[2]), [])
 
         self.assertEqual(self.e.retry(self.c), True)
-        self.assertEqual(self.e._matches, [[{"start": 0, "end": 1}]])
-        self.assertEqual(self.e._children[0]._matches, [[{"start": 0, "end": 1}]])
-        self.assertEqual(self.e._children[1]._matches, [])
-        self.assertEqual(self.e._children[2]._matches, [])
+        self.assertEqual(self.c.expression_state(self.e), [[{"start": 0, "end": 1}]])
+        self.assertEqual(self.c.expression_state(self.e._children[0]), [[{"start": 0, "end": 1}]])
+        self.assertEqual(self.c.expression_state(self.e._children[1]), [])
+        self.assertEqual(self.c.expression_state(self.e._children[2]), [])
 
         self.assertEqual(self.e.retry(self.c), False)
-        self.assertEqual(self.e._children[0]._matches, [[{"start": 0, "end": 1}]])
-        self.assertEqual(self.e._children[1]._matches, [])
-        self.assertEqual(self.e._children[2]._matches, [])
+        self.assertEqual(self.c.expression_state(self.e._children[0]), [[{"start": 0, "end": 1}]])
+        self.assertEqual(self.c.expression_state(self.e._children[1]), [])
+        self.assertEqual(self.c.expression_state(self.e._children[2]), [])
 
         self.assertEqual(self.e.retry(self.c), False)
-        self.assertEqual(self.e._children[0]._matches, [])
-        self.assertEqual(self.e._children[1]._matches, [])
-        self.assertEqual(self.e._children[2]._matches, [])
+        self.assertEqual(self.c.expression_state(self.e._children[0]), [])
+        self.assertEqual(self.c.expression_state(self.e._children[1]), [])
+        self.assertEqual(self.c.expression_state(self.e._children[2]), [])
+
+
+class TestLiteralAlternationExpression(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = cre.Parser()
+        self.tree = cre.Optimizer().optimize(
+            self.parser.parse("(ab|a|abc|ab)+c"))
+        # The capturing group (1) holds the alternation.
+        self.e = self.tree._children[0]._children[0]
+
+    def test_optimizer_finds_literal_alternations(self):
+        self.assertIsInstance(self.e, cre.LiteralAlternationExpression)
+        self.assertEqual(self.tree._children[0]._names, (1,))
+        for pattern in ("(a|b+)", "(a|(b)c)", "(a|)", "(x)(a|\\1)"):
+            tree = cre.Optimizer().optimize(self.parser.parse(pattern))
+            self.assertFalse(any(
+                isinstance(e, cre.LiteralAlternationExpression)
+                for e in tree.walk()), pattern)
+
+    def test_options_are_chosen_leftmost_first(self):
+        c = cre.EvaluationContext("abcx")
+        self.assertEqual(self.e.matches(c), True)
+        self.assertEqual(c.expression_state(self.e), [[
+            {"start": 0, "end": 2, "matching_child": 0}]])
+        self.assertEqual(self.e.retry(c), True)
+        self.assertEqual(c.expression_state(self.e), [[
+            {"start": 0, "end": 1, "matching_child": 1}]])
+        self.assertEqual(self.e.retry(c), True)
+        self.assertEqual(c.expression_state(self.e), [[
+            {"start": 0, "end": 3, "matching_child": 2}]])
+        # The duplicate "ab" can't match differently and is skipped.
+        self.assertEqual(self.e.retry(c), False)
+        self.assertEqual(c.progress, 0)
+
+    def test_matches_like_the_unoptimized_tree(self):
+        unoptimized = self.parser.parse("(ab|a|abc|ab)+c")
+        for subject in ("abc", "aabcc", "abcabcc", "abac", "abx", "ababab"):
+            spans = []
+            for tree in (unoptimized, self.tree):
+                r = cre.RegexObject(tree, "", 1, {}, engine="backtrack")
+                m = r.search(subject)
+                spans.append(m and (m.span(), m.spans(1)))
+            self.assertEqual(spans[0], spans[1], subject)
+
+    def test_compiled_patterns_are_optimized(self):
+        r = self.parser.compile("x(GET|POST|PUT)y", engine="backtrack")
+        self.assertIsInstance(r._expression_tree._children[1]._children[0],
+                              cre.LiteralAlternationExpression)
+        self.assertEqual(r.match("xPUTy").group(1), "PUT")
+        self.assertEqual(r.match("xPOSTy").span(1), (1, 5))
+        r = self.parser.compile(b"(ab|cd)+", engine="backtrack")
+        self.assertEqual(r.match(b"cdabx").span(), (0, 4))
+
+    def test_programs_follow_the_trie(self):
+        words = ["w%03d" % i for i in range(1000)]
+        r = self.parser.compile("(%s)x" % "|".join(words))
+        program = r._vm._program
+        # One SWITCH per character instead of one SPLIT per option.
+        self.assertEqual(sum(i[0] == cre.SPLIT for i in program.instructions),
+                         0)
+        self.assertEqual(sum(i[0] == cre.SWITCH
+                             for i in program.instructions), 111)
+        self.assertEqual(r.search("w1w999xw5").span(1), (2, 6))
+        self.assertEqual(r.test("w042x"), True)
+
+    def test_large_alternations_keep_the_pike_engine(self):
+        rng = random.Random(0)
+        words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz")
+                         for _ in range(rng.randint(3, 10)))
+                 for _ in range(10000)]
+        r = self.parser.compile("|".join(words))
+        self.assertEqual(r.engine, "pike")
+        self.assertIsNotNone(r._dfa)
+        self.assertEqual(r.test(words[-1]), True)
+        self.assertEqual(r.match(words[5000] + "!").span(),
+                         (0, len(words[5000])))
+
+    def test_programs_choose_options_leftmost_first(self):
+        # "a" ends between the options that continue with "b".
+        for engine in ("vm", "pike"):
+            r = self.parser.compile("(abc|a|ab)(b*)", engine=engine)
+            self.assertEqual(r.match("abbb").groups(), ("a", "bbb"))
+            self.assertEqual(r.match("abcb").groups(), ("abc", "b"))
+            r = self.parser.compile("(ab|a|abc|ab)+c", engine=engine)
+            for subject in ("abc", "aabcc", "abcabcc", "abac", "abx"):
+                m = r.search(subject)
+                expected = self.parser.compile(
+                    "(ab|a|abc|ab)+c", engine="backtrack").search(subject)
+                self.assertEqual(m and (m.span(), m.spans(1)),
+                                 expected and (expected.span(),
+                                               expected.spans(1)), subject)
 
 
 class TestBackReferenceExpression(unittest.TestCase):
 
     def setUp(self):
         self.c = cre.EvaluationContext("")
-        self.c._matches["foo"] = [{"start": 0, "end": 1}]
+        self.c.push_match(("foo",), [{"start": 0, "end": 1}])
 
     def test_matches_once_matches_previous_group_result(self):
         self.c._subject = "aaa"
@@ -268,26 +484,42 @@ class TestGroupExpression(unittest.TestCase):
 
     def setUp(self):
         self.c = cre.EvaluationContext("abcd")
-        children = (cre.Expression(), cre.Expression(), cre.Expression())
-        children[0]._matches_once = Mock(side_effect=({"start": 0, "end": 1}, None, None, None))
-        children[1]._matches_once = Mock(side_effect=({"start": 1, "end": 2}, None, None))
-        children[2]._matches_once = Mock(side_effect=({"start": 2, "end": 3}, None))
+        children = (MockExpression(), MockExpression(), MockExpression())
+        children[0]._match_end = Mock(side_effect=(1, None, None, None))
+        children[1]._match_end = Mock(side_effect=(2, None, None))
+        children[2]._match_end = Mock(side_effect=(3, None))
         self.e = cre.GroupExpression(children)
 
     def test_expression_evaluates_all_children_in_order(self):
         self.assertEqual(self.e.matches(self.c), True)
-        self.assertEqual(self.e._children[0]._matches, [[{"start": 0, "end": 1}]])
-        self.assertEqual(self.e._children[1]._matches, [[{"start": 1, "end": 2}]])
-        self.assertEqual(self.e._children[2]._matches, [[{"start": 2, "end": 3}]])
-        self.assertEqual(self.e._matches, [[{"start": 0, "end": 3}]])
+        # Anonymous expressions that match once only store their start.
+        self.assertEqual(self.c.expression_state(self.e._children[0]), [0])
+        self.assertEqual(self.c.expression_state(self.e._children[1]), [1])
+        self.assertEqual(self.c.expression_state(self.e._children[2]), [2])
+        self.assertEqual(self.c.expression_state(self.e), [0])
+        self.assertEqual(self.c._progress, 3)
+
+    def test_empty_repetition_ends_the_repetitions(self):
+        # Same results as the builtin re module and the PikeVM.
+        p = cre.Parser()
+        for pattern, subject, span, group in (
+                ("(a*)+", "aab", (0, 2), ""), ("(a*)*", "b", (0, 0), ""),
+                ("(a|b?)+c", "abx", None, None),
+                ("(a|b?)+c", "abc", (0, 3), ""),
+                ("(a*)*?b", "aab", (0, 3), "aa"),
+                ("(a?)+?c", "x", None, None)):
+            r = p.compile(pattern, engine="backtrack")
+            m = r.match(subject, max_steps=10000)
+            self.assertEqual(m and (m.span(), m.group(1)),
+                             span and (span, group), pattern)
 
     def test_matches_resets_child_expressions_on_failure(self):
-        self.e._children[2]._matches_once.side_effect = (None,)
+        self.e._children[2]._match_end.side_effect = (None,)
         self.assertEqual(self.e.matches(self.c), False)
-        self.assertEqual(self.e._children[0]._matches, [])
-        self.assertEqual(self.e._children[1]._matches, [])
-        self.assertEqual(self.e._children[2]._matches, [])
-        self.assertEqual(self.e._matches, [])
+        self.assertEqual(self.c.expression_state(self.e._children[0]), [])
+        self.assertEqual(self.c.expression_state(self.e._children[1]), [])
+        self.assertEqual(self.c.expression_state(self.e._children[2]), [])
+        self.assertEqual(self.c.expression_state(self.e), [])
 
     def test_retry_greedy_iterates_children_to_find_valid_match(self):
         """
@@ -414,8 +646,1029 @@ class TestParser(unittest.TestCase):
             ("{,}?", {"greedy": False, "min_repetitions": 0, "max_repetitions": inf}),
         )
         for a in assertions:
-            self.p._context = cre.EvaluationContext(a[0])
-            self.assertEqual(self.p._resolve_repetitions(), a[1])
+            state = cre.parser._ParseState(a[0])
+            self.assertEqual(self.p._resolve_repetitions(state), a[1])
+
+    def test_alternation_has_lowest_precedence(self):
+        self.assertEqual(self.p.parse("ab|c"), cre.GroupExpression(children=(
+            cre.AnyOfOptionsExpression(children=(
+                cre.GroupExpression(children=(
+                    cre.CharacterExpression("a"),
+                    cre.CharacterExpression("b")
+                )),
+                cre.CharacterExpression("c")
+            )),
+        ), names=(0,)))
+        m = cre.match("x(ab|a|)*y", "xabaay")
+        self.assertEqual((m.span(), m.span(1)), ((0, 6), (5, 5)))
+        m = cre.match("x((ab|a)y)+", "xabyay")
+        self.assertEqual(m.spans(2), [(1, 3), (4, 5)])
+
+    def test_group_extensions(self):
+        r = cre.compile("(?:a)(?P<word>b+)(?P=word)")
+        self.assertEqual((r.groups, r.groupindex), (1, {"word": 1}))
+        self.assertEqual(r.match("abbbb").group("word"), "bb")
+        self.assertRaises(Exception, self.p.parse, "(?P=word)")
+        self.assertRaises(Exception, self.p.parse, "(?P<1>a)")
+        with self.assertRaisesRegex(Exception, "position 12"):
+            self.p.parse("(?P<n>a)(?P<n>b)")
+
+    def test_incomplete_repetition_is_parsed_as_characters(self):
+        for pattern in ("a{", "a{}", "a{x}", "a{1,x}"):
+            self.assertEqual(cre.match(pattern, pattern).group(), pattern)
+        self.assertRaises(Exception, self.p.parse, "a{3,2}")
+
+    def test_unbalanced_brackets_are_rejected(self):
+        for pattern in ("(a", "a)", "a]", "[a", "()", "a\\"):
+            self.assertRaises(Exception, self.p.parse, pattern)
+
+    def test_large_generated_pattern(self):
+        words = ["kw%05d" % i for i in range(5000)]
+        r = self.p.compile("(%s)" % "|".join(words))
+        self.assertGreater(len(r.pattern), 30000)
+        self.assertEqual(r.match("kw04999").group(1), "kw04999")
+
+    def test_50kb_keyword_alternation_is_compiled_once_for_the_pike(self):
+        words = ["kw%05d" % i for i in range(7200)]
+        pattern = "(%s)" % "|".join(words)
+        self.assertGreater(len(pattern), 50000)
+        r = self.p.compile(pattern)
+        self.assertEqual(r.engine, "pike")
+        self.assertIsNotNone(r._dfa)
+        self.assertIs(self.p.compile(pattern), r)
+        m = r.search("x" * 1000 + "kw07199")
+        self.assertEqual(m.group(1), "kw07199")
+
+
+class TestOptimizer(unittest.TestCase):
+
+    def optimize(self, pattern):
+        return cre.Optimizer().optimize(cre.Parser().parse(pattern))
+
+    def test_merges_literals(self):
+        tree = self.optimize("ab(c)de[xy]fg")
+        self.assertEqual([type(c).__name__ for c in tree._children],
+                         ["LiteralExpression", "GroupExpression",
+                          "LiteralExpression", "CharacterClassExpression",
+                          "LiteralExpression"])
+        self.assertEqual(tree._children[2]._literal, "de")
+        self.assertEqual(self.optimize(b"a(?:bc)d")._children[0]._literal,
+                         b"abcd")
+
+    def test_flattens_groups(self):
+        tree = self.optimize("(?:(?:a)(?:b|cd))")
+        self.assertEqual(len(tree._children), 2)
+        self.assertIsInstance(tree._children[0], cre.CharacterExpression)
+        self.assertIsInstance(tree._children[1],
+                              cre.LiteralAlternationExpression)
+        # Capturing groups are kept.
+        self.assertEqual(self.optimize("(a)")._children[0]._names, (1,))
+
+    def test_folds_quantifiers(self):
+        inf = float("inf")
+        for pattern, repetitions in (("(?:a+)*", (0, inf, True)),
+                                     ("(?:a?)+", (0, inf, True)),
+                                     ("(?:a+)+", (1, inf, True)),
+                                     ("(?:a?)?", (0, 1, True)),
+                                     ("(?:a{2}){3}", (6, 6, True)),
+                                     ("(?:ab)*?", (0, inf, False)),
+                                     ("(?:a{2})+?", (1, inf, False))):
+            e = self.optimize(pattern)._children[0]
+            self.assertEqual((e._min_repetitions, e._max_repetitions,
+                              e._greedy), repetitions, pattern)
+        for pattern in ("(?:a{2})+", "(?:a+?)*", "(?:a{2,3}){2}",
+                        "(?:(a)+)*"):
+            e = self.optimize(pattern)._children[0]
+            self.assertIsInstance(e, cre.GroupExpression, pattern)
+
+    def test_possessive_repetitions(self):
+        for pattern, possessive in (("a+b", True), ("\\s*x", True),
+                                    ("[a-c]*\\d", True), ("a*", True),
+                                    ("(?:ba+)+c", True), ("(a+)(b|c)", True),
+                                    ("a+a", False), ("a+(?:b|)a", False),
+                                    ("(?:ba+)*a", False), ("a+?b", False),
+                                    ("(a)b+\\1", False), ("a{2}b", False),
+                                    ("[^b]+c", False)):
+            tree = self.optimize(pattern)
+            marked = [e for e in tree.walk() if e._possessive]
+            self.assertEqual(bool(marked), possessive, pattern)
+
+    def test_possessive_repetition_does_not_give_back(self):
+        e = cre.CharacterExpression("a", min_repetitions=0,
+                                    max_repetitions=float("inf"),
+                                    possessive=True)
+        c = cre.EvaluationContext("aaab")
+        self.assertEqual(e.matches(c), True)
+        self.assertEqual(c.progress, 3)
+        self.assertEqual(e.retry(c), False)
+        self.assertEqual(c.progress, 0)
+        self.assertEqual(str(e), "a*+")
+
+    def test_optimized_tree_matches_like_parsed_tree(self):
+        p = cre.Parser()
+        for pattern, subject in (("(?:ab)+c", "ababc"), ("x(?:a{2})*y", "xaaaay"),
+                                 ("(a(?:bc)*)+d", "abcabcd"),
+                                 ("(?:a|b)(?:cd)?", "bcd")):
+            results = []
+            compiled = p.compile(pattern)
+            for tree in (p.parse(pattern), cre.Optimizer().optimize(
+                    p.parse(pattern))):
+                r = cre.RegexObject(tree, pattern, compiled.groups,
+                                    compiled.groupindex, engine="backtrack")
+                m = r.search(subject)
+                results.append((m.span(), m.groups()))
+            self.assertEqual(results[0], results[1], pattern)
+
+    def test_literal_on_bytes_like_subjects(self):
+        r = cre.Parser().compile(b"abc+", engine="backtrack")
+        self.assertIsInstance(r.optimized_tree._children[0],
+                              cre.LiteralExpression)
+        for subject in (b"xabcc", bytearray(b"xabcc"),
+                        memoryview(b"xabcc")):
+            self.assertEqual(r.search(subject).span(), (1, 5))
+
+    def test_dump(self):
+        r = cre.Parser().compile("(?:ab)+(x|yz)", engine="backtrack")
+        self.assertEqual(r.dump(), "\n".join((
+            "GroupExpression names=(0,)",
+            "  LiteralExpression 'ab' ++",
+            "  GroupExpression names=(1,)",
+            "    LiteralAlternationExpression trie of 2 options",
+            "      CharacterExpression 'x'",
+            "      LiteralExpression 'yz'")))
+        r = cre.Parser().compile("ab", engine="pike")
+        self.assertTrue(r.dump().endswith("MATCH "))
+
+
+class TestReentrantExpressionTree(unittest.TestCase):
+
+    def test_expression_tree_does_not_store_state(self):
+        e = cre.Parser().parse("(a+)b")
+        before = copy.deepcopy(e)
+        e.matches(cre.EvaluationContext("aab"))
+        self.assertEqual(e, before)
+
+    def test_interleaved_contexts_share_one_tree(self):
+        e = cre.CharacterExpression("a", max_repetitions=float("inf"))
+        c1 = cre.EvaluationContext("aaa")
+        c2 = cre.EvaluationContext("aa")
+        self.assertEqual(e.matches(c1), True)
+        self.assertEqual(e.matches(c2), True)
+        self.assertEqual(e.retry(c1), True)
+        self.assertEqual(c1.progress, 2)
+        self.assertEqual(c2.progress, 2)
+
+    def test_regex_object_can_be_shared_between_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        r = cre.Parser().compile("(?P<x>a+)+b")
+        subjects = ["a" * n + "b" for n in range(1, 40)] * 4
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            spans = list(pool.map(lambda s: r.match(s).span("x"), subjects))
+        self.assertEqual(spans, [(0, len(s) - 1) for s in subjects])
+
+
+class TestTrail(unittest.TestCase):
+
+    def test_anonymous_expressions_do_not_touch_the_trail(self):
+        c = cre.EvaluationContext("abab")
+        self.assertEqual(cre.Parser().parse("[ab]*").matches(c), True)
+        # Only the implicit group 0 around the pattern is named.
+        self.assertEqual(c._trail[1::4], [(0,)])
+
+    def test_backtracking_truncates_the_trail(self):
+        c = cre.EvaluationContext("aab")
+        e = cre.Parser().parse("(a)*(a)b")
+        self.assertEqual(e.matches(c), True)
+        self.assertEqual(c.flattened_matches,
+                         {0: {"start": 0, "end": 3},
+                          1: {"start": 0, "end": 1},
+                          2: {"start": 1, "end": 2}})
+        self.assertEqual(c._trail[1::4], [(1,), (2,), (0,)])
+        e.undo(c)
+        self.assertEqual(c._trail, [])
+
+    def test_undo_of_groups_without_repetitions(self):
+        # Undoing a named group that matched zero times used to raise
+        # KeyError.
+        for pattern, subject, span in (("x(ab)*y", "xy", (0, 2)),
+                                       ("((a+)b)*a", "aab", (0, 1))):
+            r = cre.Parser().compile(pattern, engine="backtrack")
+            self.assertEqual(r.match(subject).span(), span)
+            self.assertEqual(r.match("x" + subject + "z", 1).span(),
+                             (span[0] + 1, span[1] + 1))
+
+
+class TestSlots(unittest.TestCase):
+
+    def test_expressions_have_no_instance_dict(self):
+        e = cre.Parser().parse("(?P<x>a[bc]\\d)*(?P=x)")
+        for node in e.walk():
+            self.assertFalse(hasattr(node, "__dict__"), type(node))
+        with self.assertRaises(AttributeError):
+            e.foo = 1
+
+    def test_context_and_match_object_have_no_instance_dict(self):
+        m = cre.Parser().compile("a").match("a")
+        for obj in (cre.EvaluationContext("a"), m):
+            self.assertFalse(hasattr(obj, "__dict__"), type(obj))
+
+    def test_equality_compares_slots_of_all_base_classes(self):
+        a = cre.CharacterExpression("a", min_repetitions=0)
+        self.assertEqual(a, cre.CharacterExpression("a", min_repetitions=0))
+        self.assertNotEqual(a, cre.CharacterExpression("a"))
+        self.assertNotEqual(a, cre.CharacterExpression("b", min_repetitions=0))
+
+
+class TestPikeVM(unittest.TestCase):
+
+    def match(self, pattern, subject):
+        return cre.Parser().compile(pattern, engine="pike").match(subject)
+
+    def test_engine_is_selected_automatically(self):
+        p = cre.Parser()
+        self.assertEqual(p.compile("(a*)*b").engine, "pike")
+        self.assertEqual(p.compile("(a)\\1").engine, "vm")
+        self.assertEqual(p.compile("(a*)*b", engine="backtrack").engine,
+                         "backtrack")
+        self.assertRaises(ValueError, p.compile, "(a)\\1", engine="pike")
+
+    def test_matches_like_backtracking(self):
+        m = self.match("(a+)(b*?)b", "aabbb")
+        self.assertEqual(m.span(), (0, 3))
+        self.assertEqual(m.groups(), ("aa", ""))
+        self.assertEqual(self.match("(ab){2,3}c", "ababd"), None)
+
+    def test_all_matches_of_nested_groups_are_kept(self):
+        m = self.match("((a)b)+", "ababab")
+        self.assertEqual(m.spans(2), [(0, 1), (2, 3), (4, 5)])
+        self.assertEqual(m.spans(1), [(4, 6)])
+
+    def test_empty_repetition_ends_loop(self):
+        # Same results as the builtin re module.
+        m = self.match("(a?)+", "aab")
+        self.assertEqual((m.span(), m.group(1)), ((0, 2), ""))
+        m = self.match("(a??b*)*", "bab")
+        self.assertEqual((m.span(), m.group(1)), ((0, 1), ""))
+
+    def test_nested_quantifiers_run_in_linear_time(self):
+        self.assertEqual(self.match("(a*)*b", "a" * 5000), None)
+        self.assertEqual(self.match("(a+)+b", "a" * 5000), None)
+
+    def test_large_programs_are_not_compiled(self):
+        # Unrolled, these need over a million and 300,000 instructions.
+        p = cre.Parser()
+        for pattern in ("((a{0,60}){0,60}){0,60}", "a{300000}"):
+            self.assertRaises(cre.ProgramTooLarge,
+                              cre.ProgramCompiler().compile, p.parse(pattern))
+            for engine in ("auto", "pike", "vm"):
+                self.assertRaises(cre.ProgramTooLarge, p.compile, pattern,
+                                  engine=engine)
+            self.assertEqual(p.compile(pattern, engine="backtrack").engine,
+                             "backtrack")
+        program = cre.ProgramCompiler(None).compile(p.parse("a{300000}"))
+        self.assertGreater(len(program), 300000)
+        s = cre.RegexSet([p.compile("a{300000}", engine="backtrack"), "b"])
+        self.assertEqual(s.match("a" * 300000), [0])
+        self.assertEqual(s.match("b"), [1])
+
+    def test_long_counted_repetitions_stay_linear(self):
+        r = cre.compile("(a*)+b{25000}")
+        self.assertEqual(r.engine, "pike")
+        self.assertIsNotNone(r._dfa)
+        self.assertEqual(r.test("a" * 10 + "b" * 25000), True)
+        self.assertEqual(r.match("a" * 1000 + "b" * 24999), None)
+        self.assertEqual(r.match("a" * 10 + "b" * 25000).span(), (0, 25010))
+
+
+class TestBacktrackingVM(unittest.TestCase):
+
+    def match(self, pattern, subject):
+        return cre.Parser().compile(pattern, engine="vm").match(subject)
+
+    def test_program_is_flat(self):
+        program = cre.ProgramCompiler().compile(cre.Parser().parse("(a)+\\1"))
+        self.assertEqual([i[0] for i in program.instructions], [
+            cre.SAVE_START, cre.SAVE_START, cre.CHAR, cre.SAVE_END,
+            cre.SPLIT, cre.MARK, cre.SAVE_START, cre.CHAR, cre.SAVE_END,
+            cre.LOOP, cre.COMMIT, cre.BACKREF, cre.SAVE_END, cre.COMMIT,
+            cre.MATCH])
+
+    def test_back_references(self):
+        m = self.match("(a+)b\\1", "aabaaa")
+        self.assertEqual((m.span(), m.group(1)), ((0, 5), "aa"))
+        self.assertEqual(self.match("(a+)b\\1", "aaba"), None)
+
+    def test_backtracking_restores_captures(self):
+        m = self.match("(a)*(a)\\1", "aaa")
+        self.assertEqual(m.span(), (0, 3))
+        self.assertEqual(m.spans(1), [(0, 1)])
+        self.assertEqual(m.spans(2), [(1, 2)])
+
+    def test_long_subjects_dont_exhaust_the_stack(self):
+        m = self.match("(a)*\\1", "a" * 100000)
+        self.assertEqual(m.span(), (0, 100000))
+        self.assertEqual(m.group(1), "a")
+
+    def test_memoization_bounds_nested_repetitions(self):
+        # Without memoization, this takes about 2 ** 40 steps.
+        r = cre.Parser().compile("(a+)+b", engine="vm")
+        self.assertEqual(r.search("a" * 40 + "c"), None)
+        self.assertEqual(r.search("a" * 40 + "b").spans(1), [(0, 40)])
+
+    def test_loops_that_reach_back_references_are_not_memoized(self):
+        program = cre.ProgramCompiler().compile(
+            cre.Parser().parse("(a*)*b(a*)*\\2"))
+        rows, enclosing_loops = cre.vm._memo_rows(program)
+        heads = [pc for pc, i in enumerate(program.instructions)
+                 if i[0] == cre.LOOP]
+        self.assertEqual(sorted(rows[program.instructions[pc][2]]
+                                for pc in heads), [-1, -1, -1, -1])
+        program = cre.ProgramCompiler().compile(
+            cre.Parser().parse("(a)\\1(a*)*b"))
+        rows, enclosing_loops = cre.vm._memo_rows(program)
+        self.assertEqual(sorted(r for r in rows if r >= 0), [0, 1])
+        self.assertEqual(enclosing_loops, [(), (0,)])
+
+    def test_memo_table_grows_with_the_work_done(self):
+        # Allocating a row per loop head for the whole subject would
+        # make every call O(len(subject)).
+        vm = cre.BacktrackingVM(
+            cre.ProgramCompiler().compile(cre.Parser().parse("(b*c)*d")))
+        memo = vm._new_memo()
+        self.assertEqual(vm._match("bbcx" + "x" * 5000000, 0, False,
+                                   memo=memo)[0], None)
+        self.assertLess(len(memo.visited), 10)
+        subject = "bc" * 3 + "x" * 5000000
+        for position in range(0, 1000, 7):
+            memo = vm._new_memo()
+            self.assertEqual(vm._match(subject, position, False,
+                                       memo=memo)[0], None)
+            self.assertLess(len(memo.visited), 10)
+
+    def test_memoization_does_not_change_results(self):
+        for pattern in ("([ab])*", "((a+)b)*a", "(a{1,3}b?){2,4}c",
+                        "(a)b*\\1(b*a)*c", "(a[ab]*?)+b?"):
+            program = cre.ProgramCompiler().compile(
+                cre.Parser().parse(pattern))
+            vms = (cre.BacktrackingVM(program),
+                   cre.BacktrackingVM(program, memoize=False))
+            for subject in ("", "abab", "aabaac", "abaabbac", "baaab"):
+                self.assertEqual(*(
+                    [(c.starts, c.ends) if c is not None else None
+                     for c in (vm.search(subject),)] for vm in vms))
+
+
+class TestMatchLimits(unittest.TestCase):
+
+    def tearDown(self):
+        cre.set_match_limits()
+
+    def test_max_steps_stops_catastrophic_backtracking(self):
+        for pattern, engine in (("(a|aa)*b", "backtrack"),
+                                ("(a*)*b\\1", "vm")):
+            r = cre.Parser().compile(pattern, engine=engine)
+            with self.assertRaises(cre.BudgetExceeded) as cm:
+                r.match("a" * 40, max_steps=5000)
+            self.assertEqual(cm.exception.steps, 5001)
+
+    def test_timeout_stops_match(self):
+        r = cre.Parser().compile("(a*)*b\\1", engine="vm")
+        with self.assertRaises(cre.BudgetExceeded):
+            r.match("a" * 40, timeout=0.05)
+
+    def test_limits_dont_change_results(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = cre.Parser().compile("([ab])*c", engine=engine)
+            m = r.search("xababc", max_steps=1000, timeout=10)
+            self.assertEqual(m.span(), (1, 6))
+            self.assertRaises(cre.BudgetExceeded, r.search, "ab" * 100 + "xc",
+                              max_steps=100)
+
+    def test_pike_charges_empty_transitions(self):
+        # Only two threads are ever advanced, but adding them follows
+        # hundreds of SAVE_START, SAVE_END and COMMIT instructions.
+        r = cre.Parser().compile("(" * 300 + "b" + ")" * 300, engine="pike")
+        self.assertEqual(r.match("b", max_steps=1000).span(), (0, 1))
+        self.assertRaises(cre.BudgetExceeded, r.match, "b", max_steps=100)
+
+    def test_module_default_applies_without_own_limits(self):
+        r = cre.Parser().compile("(a*)*b", engine="backtrack")
+        cre.set_match_limits(max_steps=100)
+        self.assertRaises(cre.BudgetExceeded, r.match, "a" * 40)
+        r = cre.Parser().compile("a*a*b", engine="backtrack")
+        self.assertEqual(r.match("a" * 200 + "b", max_steps=10000).span(),
+                         (0, 201))
+
+
+class TestLazyDFA(unittest.TestCase):
+
+    def setUp(self):
+        # pattern := "[a-b]*a[a-b]{8}"
+        inf = float("inf")
+        tree = cre.GroupExpression((
+            cre.CharacterRangeExpression("a", "b", min_repetitions=0,
+                                         max_repetitions=inf),
+            cre.CharacterExpression("a"),
+            cre.CharacterRangeExpression("a", "b", min_repetitions=8,
+                                         max_repetitions=8)
+        ), names=(0,))
+        self.program = cre.ProgramCompiler().compile(tree)
+        self.subject = "".join("ab"[(i * 7 + i // 3) % 2] for i in range(600))
+
+    def test_test_agrees_with_match(self):
+        p = cre.Parser()
+        for pattern, subject in (("(ab)+c", "ababc"), ("(ab)+c", "ababa"),
+                                 ("a*?b", "aab"), ("a{2,3}", "a"),
+                                 ("(a*)*b", "a" * 100)):
+            r = p.compile(pattern)
+            self.assertEqual(r.test(subject), r.match(subject) is not None)
+
+    def test_states_are_cached(self):
+        dfa = cre.LazyDFA(self.program)
+        self.assertEqual(dfa.test(self.subject), True)
+        states = dfa.state_count
+        self.assertEqual(dfa.test(self.subject), True)
+        self.assertEqual(dfa.state_count, states)
+        self.assertEqual(dfa.cache_resets, 0)
+
+    def test_thrashing_cache_gives_up(self):
+        dfa = cre.LazyDFA(self.program, max_cache_bytes=2000)
+        self.assertEqual(dfa.test(self.subject + "c"), None)
+
+    def test_regex_object_falls_back_when_cache_thrashes(self):
+        r = cre.Parser().compile("(a*b*)*a(a*b*)b")
+        r._dfa = cre.LazyDFA(r._dfa._program, max_cache_bytes=1000)
+        self.assertEqual(r.test(self.subject), True)
+        self.assertEqual(r.test("bbbbbb"), False)
+
+
+class TestRegexSet(unittest.TestCase):
+
+    patterns = ["ab+c", "(a|b)*d", "x(\\d+)y", "(ab)\\1", "a*", "(\\w+)-\\1"]
+
+    def setUp(self):
+        self.parser = cre.Parser()
+        self.set = cre.RegexSet(self.patterns, parser=self.parser)
+
+    def expected(self, method, subject):
+        return [i for i, pattern in enumerate(self.patterns)
+                if getattr(self.parser.compile(pattern), method)(subject)]
+
+    def test_agrees_with_individual_patterns(self):
+        for subject in ("abbc", "abababd", "x12y", "abab", "", "ab-ab",
+                        "ab-ac", "zzx1y", "qq-qq", "bd-bd"):
+            self.assertEqual(self.set.match(subject),
+                             self.expected("match", subject), subject)
+            self.assertEqual(self.set.search(subject),
+                             self.expected("search", subject), subject)
+
+    def test_patterns_share_the_module_cache_by_default(self):
+        cre.purge()
+        try:
+            first = cre.RegexSet(self.patterns)
+            second = cre.RegexSet(self.patterns)
+            self.assertEqual(cre.cache_info().hits, len(self.patterns))
+            self.assertEqual(first.regexes, second.regexes)
+            self.assertIs(first.regexes[0], cre.compile(self.patterns[0]))
+        finally:
+            cre.purge()
+
+    def test_window(self):
+        self.assertEqual(self.set.search("zzabbczz", 2, 6), [0, 4])
+        self.assertEqual(self.set.search("zzabbczz", 2, 5), [4])
+        self.assertEqual(self.set.match("zzx1y", 2), [2, 4])
+
+    def test_back_references_are_prefiltered(self):
+        self.set.regexes[3].search = Mock(side_effect=AssertionError)
+        self.assertEqual(self.set.search("x1y"), [2, 4])
+        self.set.regexes[5].search = Mock(return_value=None)
+        self.assertEqual(self.set.search("a-b"), [4])
+        self.assertEqual(self.set.regexes[5].search.call_count, 1)
+
+    def test_thrashing_cache_falls_back(self):
+        self.set._unanchored = cre.MultiDFA(
+            [r._vm._program for r in self.set.regexes], True,
+            max_cache_bytes=0)
+        self.assertEqual(self.set.search("x12y ab-ab"),
+                         self.expected("search", "x12y ab-ab"))
+
+    def test_bytes(self):
+        s = cre.RegexSet([b"ab", b"(a)\\1", b"c+"])
+        self.assertEqual(s.search(b"xaab"), [0, 1])
+        self.assertEqual(s.match(b"cc"), [2])
+        self.assertRaises(TypeError, s.match, "cc")
+        self.assertRaises(TypeError, cre.RegexSet, ["a", b"b"])
+
+    def test_empty_set(self):
+        self.assertEqual(cre.RegexSet([]).search("abc"), [])
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.p = cre.Parser()
+
+    def test_literal_prefix_and_required_literal(self):
+        for pattern, prefix, required in (("abc", "abc", ""),
+                                          ("ab+c", "ab", ""),
+                                          ("a*bcd[xy]ef", "", "bcd"),
+                                          ("(xy){2}z", "xyxyz", ""),
+                                          ("\\d+foo", "", "foo")):
+            prefilter = self.p.compile(pattern)._prefilter
+            self.assertEqual(prefilter.prefix, prefix)
+            self.assertEqual(prefilter.required, required)
+
+    def test_match_lengths_and_first_set(self):
+        for pattern, lengths, ranges in (
+                ("a+b", (2, None), ((97, 97),)),
+                ("(ab|c){2,3}", (2, 6), ((97, 97), (99, 99))),
+                ("(a)\\1", (1, None), ((97, 97),)),
+                ("x?(?:yz){0}", (0, 1), None),
+                (b"[ab]c\\d", (3, 3), ((97, 98),))):
+            r = self.p.compile(pattern)
+            self.assertEqual((r.min_length, r.max_length), lengths)
+            self.assertEqual(r.first_set and r.first_set.ranges, ranges)
+        r = cre.RegexObject.loads(self.p.compile("[ab]c{2,4}").dumps())
+        self.assertEqual((r.min_length, r.max_length), (3, 5))
+        self.assertEqual(r.first_set.ranges, ((97, 98),))
+
+    def test_short_subjects_are_rejected_without_the_engine(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("a\\w{3}", engine=engine)
+            r._vm = Mock()
+            r._expression_tree = Mock()
+            r._dfa = Mock()
+            self.assertEqual(r.match("abcd", 1), None)
+            self.assertEqual(r.test("abc"), False)
+            self.assertEqual(r._vm.method_calls, [])
+            self.assertEqual(r._dfa.method_calls, [])
+            self.assertEqual(r._expression_tree.method_calls, [])
+
+    def test_candidates_start_with_first_set_near_required_literal(self):
+        scanner = self.p.compile("[0-9]+")._prefilter.scanner("ab1c22")
+        self.assertEqual([scanner.next(0), scanner.next(3), scanner.next(6)],
+                         [2, 4, -1])
+        # "42" must end within 5 characters of the start.
+        scanner = self.p.compile("[a-z]{1,3}42")._prefilter.scanner(
+            "abcdefg42")
+        self.assertEqual(scanner.next(0), 4)
+        # No match fits behind the last "a".
+        scanner = self.p.compile("a\\w{3}")._prefilter.scanner("bcdaaa")
+        self.assertEqual(scanner.next(0), -1)
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile(b"[0-9]{2}", engine=engine)
+            self.assertEqual(r.search(b"a1b23c").span(), (3, 5))
+            self.assertEqual(r.search(memoryview(b"a1b2")), None)
+            r = self.p.compile("[a-z]{1,3}42", engine=engine)
+            self.assertEqual(r.search("abcdefg42").span(), (4, 9))
+
+    def test_search_finds_leftmost_match(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("b(a+)c", engine=engine)
+            m = r.search("xxbaabaaacbac")
+            self.assertEqual(m.span(), (5, 10))
+            self.assertEqual(m.group(1), "aaa")
+            self.assertEqual(r.search("xxbaab"), None)
+            self.assertEqual(r.search("bac", 1), None)
+
+    def test_finditer_continues_behind_empty_matches(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("b*?", engine=engine)
+            self.assertEqual([m.span() for m in r.finditer("bc")],
+                             [(0, 0), (0, 1), (1, 1), (2, 2)])
+            r = self.p.compile("\\d+", engine=engine)
+            self.assertEqual([m.group() for m in r.finditer("a1b22c333")],
+                             ["1", "22", "333"])
+
+    def test_horspool_table_without_find(self):
+        table = cre.HorspoolTable("aba")
+        subject = list("abbabbaba")
+        self.assertEqual(table.find(subject, 0, len(subject)), 6)
+        self.assertEqual(table.find(subject, 0, 8), -1)
+        prefilter = cre.Prefilter("aba")
+        self.assertEqual(prefilter.scanner(subject).next(0), 6)
+
+
+class TestBatchMatching(unittest.TestCase):
+
+    def setUp(self):
+        self.p = cre.Parser()
+        self.subjects = ["ab1", "x", "abab22", "", "ab"]
+
+    def test_results_equal_single_matches(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("(ab)+\\d", engine=engine)
+            self.assertEqual(list(r.test_many(iter(self.subjects))),
+                             [1, 0, 1, 0, 0])
+            self.assertEqual(r.match_many(self.subjects),
+                             [(0, 3), (-1, -1), (0, 5), (-1, -1), (-1, -1)])
+        r = self.p.compile(b"a+")
+        self.assertEqual(r.match_many([b"aab", memoryview(b"ba")]),
+                         [(0, 2), (-1, -1)])
+        self.assertRaises(TypeError, r.test_many, [b"a", "a"])
+
+    def test_limits_apply_to_every_subject(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("(a|b)*c", engine=engine)
+            subjects = ["ab" * 5 + "c"] * 100
+            limit = 200
+            self.assertEqual(list(r.test_many(subjects, max_steps=limit)),
+                             [1] * 100)
+            self.assertEqual(r.match_many(subjects, max_steps=limit),
+                             [(0, 11)] * 100)
+            # The BacktrackingVM only charges for backtracking, and the
+            # lazy DFA of the PikeVM would reject a subject without c.
+            heavy = "ab" * 500 + ("" if engine == "vm" else "c")
+            self.assertRaises(cre.BudgetExceeded, r.match_many,
+                              subjects + [heavy], max_steps=limit)
+
+    def test_mostly_matching_batches_skip_the_dfa(self):
+        r = self.p.compile("a+b")
+        subjects = ["aab", "bb"] + ["ab"] * 50
+        r._dfa.test = Mock(wraps=r._dfa.test)
+        self.assertEqual(r.match_many(subjects), [(0, 3), (-1, -1)]
+                         + [(0, 2)] * 50)
+        self.assertLess(r._dfa.test.call_count, 20)
+
+    def test_workers_split_the_batch(self):
+        r = self.p.compile("(ab)+\\d")
+        subjects = self.subjects * 10
+        self.assertEqual(r.test_many(subjects, workers=2),
+                         r.test_many(subjects))
+        self.assertEqual(r.match_many(subjects, workers=2),
+                         r.match_many(subjects))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_numpy_arrays(self):
+        r = self.p.compile("(ab)+\\d")
+        for dtype in (numpy.str_, object):
+            subjects = numpy.array(self.subjects, dtype=dtype)
+            mask = r.test_many(subjects)
+            self.assertEqual(mask.dtype, numpy.bool_)
+            self.assertEqual(mask.tolist(),
+                             [True, False, True, False, False])
+            spans = r.match_many(subjects)
+            self.assertEqual(spans.shape, (5, 2))
+            self.assertEqual(spans[:, 1].tolist(), [3, -1, 5, -1, -1])
+
+
+class TestFinditerStream(unittest.TestCase):
+
+    def setUp(self):
+        self.p = cre.Parser()
+
+    def test_matches_across_chunk_boundaries(self):
+        subject = "xxabbbc-abc-ab-abbbbbbbc"
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("a(b+)c", engine=engine)
+            expected = [(m.span(), m.group(1)) for m in r.finditer(subject)]
+            for chunk_size in (1, 2, 5, 100):
+                stream = io.StringIO(subject)
+                self.assertEqual(
+                    [(m.span(), m.group(1))
+                     for m in r.finditer_stream(stream, chunk_size)],
+                    expected)
+
+    def test_greedy_match_waits_for_next_chunk(self):
+        r = self.p.compile("\\d+")
+        self.assertEqual(
+            [m.group() for m in r.finditer_stream(io.StringIO("12 345"), 2)],
+            ["12", "345"])
+
+    def test_back_reference_across_chunk_boundary(self):
+        r = self.p.compile("(ab)x\\1")
+        m = next(r.finditer_stream(io.StringIO("zzabxabzz"), 3))
+        self.assertEqual(m.span(), (2, 7))
+        self.assertEqual(m.group(1), "ab")
+
+    def test_binary_stream(self):
+        r = self.p.compile(b"a\\d+")
+        self.assertEqual(
+            [m.span() for m in r.finditer_stream(io.BytesIO(b"a1 a23"), 2)],
+            [(0, 2), (3, 6)])
+
+    def test_pos_and_endpos_are_stream_offsets(self):
+        r = self.p.compile("a(b+)c")
+        matches = list(r.finditer_stream(io.StringIO("xxabbc-abbbbbc"), 4))
+        self.assertEqual([m.span() for m in matches], [(2, 6), (7, 14)])
+        for m in matches:
+            self.assertEqual(m.pos, 0)
+            self.assertLessEqual(m.end(), m.endpos)
+        self.assertEqual(matches[-1].endpos, 14)
+
+    def test_buffer_stays_bounded(self):
+        r = self.p.compile("ab")
+        matches = r.finditer_stream(io.StringIO("xab" * 1000), 16)
+        for m in matches:
+            self.assertLessEqual(len(m.string), 32)
+
+
+class TestWindows(unittest.TestCase):
+
+    class UnsliceableString(str):
+        def __getitem__(self, index):
+            if type(index) is slice:
+                raise AssertionError("the subject was sliced")
+            return str.__getitem__(self, index)
+
+    def setUp(self):
+        self.p = cre.Parser()
+
+    def test_spans_are_relative_to_string(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("a(b+)", engine=engine)
+            m = r.search("abbxabbb", 1)
+            self.assertEqual(m.span(), (4, 8))
+            self.assertEqual(m.span(1), (5, 8))
+            self.assertEqual(m.group(1), "bbb")
+            self.assertEqual(r.match("xxabb", 2, 4).span(), (2, 4))
+            self.assertEqual(r.match("abb", 1), None)
+            self.assertEqual([m.span() for m in r.finditer("ababb", 1, 4)],
+                             [(2, 4)])
+
+    def test_bounds_are_clamped_like_re(self):
+        r = self.p.compile("b*")
+        self.assertEqual(r.match("abc", -5, 99).span(), (0, 0))
+        self.assertEqual(r.search("abbc", -5, -1).span(), (0, 0))
+        self.assertEqual(r.search("abc", 2, 1), None)
+        self.assertEqual(r.test("abc", 2, 1), False)
+
+    def test_back_reference_stops_at_endpos(self):
+        for engine in ("backtrack", "vm"):
+            r = self.p.compile("(ab)\\1", engine=engine)
+            self.assertEqual(r.match("abab", 0, 3), None)
+            self.assertEqual(r.match("xabab", 1).span(), (1, 5))
+
+    def test_subject_is_not_sliced(self):
+        subject = self.UnsliceableString("xxabbbxx" * 10)
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("ab+", engine=engine)
+            self.assertEqual(r.search(subject, 3, 20).span(), (10, 14))
+            self.assertTrue(r.test(subject, 2, 5))
+
+
+class TestCaptures(unittest.TestCase):
+
+    def setUp(self):
+        self.p = cre.Parser()
+
+    def test_all_captures_of_repeated_group(self):
+        for engine in ("backtrack", "vm", "pike"):
+            m = self.p.compile("((?P<x>[0-9]+),)*", engine=engine).match(
+                "1,22,333,")
+            self.assertEqual(list(m.captures("x")), ["1", "22", "333"])
+            self.assertEqual(m.captures(2)[-1], "333")
+            self.assertEqual(m.spans("x"), [(0, 1), (2, 4), (5, 8)])
+            self.assertEqual(m.starts("x").tolist(), [0, 2, 5])
+            self.assertEqual(m.ends(2).tolist(), [1, 4, 8])
+            self.assertEqual(list(m.captures(1)), ["333,"])
+
+    def test_group_that_did_not_participate(self):
+        m = self.p.compile("a(b)*").match("a")
+        self.assertEqual(len(m.spans(1)), 0)
+        self.assertEqual(list(m.captures(1)), [])
+        self.assertRaises(IndexError, m.spans, 2)
+
+    def test_columns_are_read_only(self):
+        m = self.p.compile("(a)+").match("aa")
+        self.assertRaises(TypeError, m.starts(1).__setitem__, 0, 5)
+
+    def test_on_capture_receives_every_committed_capture(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("((?P<x>[0-9]+),)*", engine=engine)
+            spans = []
+            m = r.match("1,22,333,", on_capture={"x": spans.append})
+            self.assertEqual(spans, [(0, 1), (2, 4), (5, 8)])
+            self.assertEqual(m.spans("x"), [(5, 8)])
+            self.assertEqual(m.group("x"), "333")
+
+    def test_on_capture_accepts_the_send_method_of_a_generator(self):
+        def __lengths(totals):
+            while True:
+                start, end = yield
+                totals.append(end - start)
+
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("(?:([0-9]+),?)*", engine=engine)
+            totals = []
+            consumer = __lengths(totals)
+            next(consumer)
+            m = r.match("1,22,x", on_capture={1: consumer.send})
+            self.assertEqual(totals, [1, 2])
+            self.assertEqual(m.group(1), "22")
+
+    def test_retracted_captures_are_not_reported(self):
+        for engine in ("vm", "pike"):
+            r = self.p.compile("((a+)b)*a", engine=engine)
+            spans = []
+            m = r.search("xaabaaba", on_capture={2: spans.append})
+            self.assertEqual(m.span(), (1, 8))
+            self.assertEqual(spans, [(1, 3), (4, 6)])
+            spans[:] = []
+            m = r.match("aabaac", on_capture={2: spans.append})
+            self.assertEqual(m.span(), (0, 4))
+            self.assertEqual(spans, [(0, 2)])
+
+    def test_pike_flushes_final_captures_while_matching(self):
+        r = self.p.compile("(([0-9]+),)*x?", engine="pike")
+        subject = "1," * (3 * cre.PikeVM.FLUSH_INTERVAL) + "y"
+        spans = []
+        m = r.match(subject, on_capture={2: spans.append})
+        self.assertEqual(len(spans), 3 * cre.PikeVM.FLUSH_INTERVAL)
+        self.assertEqual(spans[:2], [(0, 1), (2, 3)])
+        self.assertEqual(m.spans(2), [spans[-1]])
+
+    def test_pike_limits_captures_before_the_match_is_decided(self):
+        # Nothing matches before the final "x", so the captures of all
+        # fields are kept until then unless they are limited.
+        r = self.p.compile("(?:([0-9]+),)*x", engine="pike")
+        peaks = []
+        for fields in (1000, 4000):
+            subject = "12," * fields + "x"
+            tracemalloc.start()
+            try:
+                m = r.match(subject, capture_limit=2)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(m.spans(1), [(3 * fields - 6, 3 * fields - 4),
+                                          (3 * fields - 3, 3 * fields - 1)])
+        self.assertLess(peaks[1], 2 * peaks[0])
+
+    def test_capture_limit_keeps_last_captures(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile("(([0-9]),)*", engine=engine)
+            m = r.match("1,2,3,4,5,", capture_limit=2)
+            self.assertEqual(list(m.captures(2)), ["4", "5"])
+            self.assertEqual(list(m.captures(1)), ["5,"])
+        self.assertRaises(ValueError, r.match, "1,", capture_limit=0)
+
+    def test_captures_in_stream_are_absolute(self):
+        r = self.p.compile("x(a)+")
+        m = list(r.finditer_stream(io.StringIO("....xaa..xa"), 4))[1]
+        self.assertEqual(m.spans(1), [(10, 11)])
+        self.assertEqual(list(m.captures(1)), ["a"])
+
+
+class TestBytesSubjects(unittest.TestCase):
+
+    def setUp(self):
+        self.p = cre.Parser()
+        self.data = b"\x00ab12\xff ab\tab7"
+
+    def test_bytes_like_subjects(self):
+        for engine in ("backtrack", "vm", "pike"):
+            r = self.p.compile(b"ab(\\d*)", engine=engine)
+            for subject in (self.data, bytearray(self.data),
+                            memoryview(self.data)):
+                self.assertEqual(
+                    [(m.span(), m.group(1)) for m in r.finditer(subject)],
+                    [((1, 5), b"12"), ((7, 9), b""), ((10, 13), b"7")])
+
+    def test_mmap_subject(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(self.data)
+            f.flush()
+            subject = mmap.mmap(f.fileno(), 0)
+            m = self.p.compile(b"(ab)\\d+[^a]\\s?\\1").search(subject)
+            self.assertEqual(m.span(), (1, 9))
+            self.assertEqual(m.group(), b"ab12\xff ab")
+            subject.close()
+
+    def test_character_classes_are_ascii_only(self):
+        self.assertEqual(self.p.compile(b"\\w+").search(b"\xe9t\xe9").span(),
+                         (1, 2))
+        self.assertEqual(self.p.compile(b"\\s").search(b"\x1c \x1d").span(),
+                         (1, 2))
+
+    def test_pattern_and_subject_types_must_agree(self):
+        self.assertRaises(TypeError, self.p.compile("a").match, b"a")
+        self.assertRaises(TypeError, self.p.compile(b"a").search, "a")
+
+
+class TestExpressionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.p = cre.Parser(cache_size=2)
+
+    def test_compile_reuses_cached_regex_object(self):
+        r = self.p.compile("ab")
+        self.assertIs(self.p.compile("ab"), r)
+        self.assertIsNot(self.p.compile("ab", 1), r)
+        self.assertEqual(self.p._expression_cache.info(),
+                         cre.CacheInfo(hits=1, misses=2, maxsize=2, currsize=2))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        a = self.p.compile("a")
+        self.p.compile("b")
+        self.p.compile("a")
+        self.p.compile("c")
+        self.assertIs(self.p.compile("a"), a)
+        self.assertNotIn((str, "b", 0), self.p._expression_cache)
+
+    def test_purge_resets_cache_and_counters(self):
+        cre.compile("abc")
+        cre.purge()
+        self.assertEqual(cre.cache_info().currsize, 0)
+        self.assertEqual(cre.cache_info().hits, 0)
+        self.assertEqual(cre.cache_info().misses, 0)
+
+    def test_threads_share_a_parser(self):
+        patterns = ["(a)(?P<n%d>b)\\%d|c{%d}" % (i, i % 2 + 1, i)
+                    for i in range(30)]
+        expected = [cre.Parser(0).compile(p) for p in patterns]
+        results = []
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            def __compile():
+                results.append([self.p.compile(p) for p in patterns * 3])
+            threads = [threading.Thread(target=__compile) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(len(results), 6)
+        for result in results:
+            self.assertEqual([(r.groups, r.groupindex) for r in result],
+                             [(r.groups, r.groupindex)
+                              for r in expected * 3])
+        self.assertLessEqual(len(self.p._expression_cache), 2)
+
+    def test_cached_regex_object_can_be_matched_repeatedly(self):
+        for _ in range(3):
+            m = cre.match("(?P<x>a)+b", "aab")
+            self.assertEqual(m.span(), (0, 3))
+            self.assertEqual(m.group("x"), "a")
+
+
+class TestSerialization(unittest.TestCase):
+
+    def test_pickled_patterns_match_like_the_original(self):
+        for pattern, engine, subject in (
+                ("(?P<x>[a-c]+)d", "auto", "xabcd"),
+                ("(a)b\\1", "auto", "xaba"),
+                ("a*(b|c)", "backtrack", "aac"),
+                (b"\\d+", "auto", b"ab12")):
+            r = cre.Parser().compile(pattern, engine=engine)
+            loaded = pickle.loads(pickle.dumps(r))
+            self.assertEqual((loaded.pattern, loaded.engine, loaded.groupindex),
+                             (r.pattern, r.engine, r.groupindex))
+            self.assertEqual(loaded._expression_tree, r._expression_tree)
+            self.assertEqual(loaded.search(subject).span(),
+                             r.search(subject).span())
+
+    def test_character_sets_stay_interned(self):
+        r = cre.RegexObject.loads(cre.compile("\\d").dumps())
+        self.assertIs(r._expression_tree._children[0]._set,
+                      cre.CharacterSet.get(cre.category_ranges("d")))
+
+    def test_other_versions_are_rejected(self):
+        data = cre.compile("a").dumps()
+        self.assertRaises(ValueError, cre.RegexObject.loads, b"x" + data)
+        header = cre.SERIALIZATION_MAGIC + bytes((cre.SERIALIZATION_FORMAT,))
+        self.assertRaises(ValueError, cre.RegexObject.loads,
+                          cre.SERIALIZATION_MAGIC
+                          + bytes((cre.SERIALIZATION_FORMAT - 1,))
+                          + data[len(header):])
+        self.assertRaises(ValueError, cre.RegexObject.loads,
+                          data.replace(cre.__version__.encode(), b"0.0.0"))
+
+    def test_disk_cache_is_shared_between_parsers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            r = cre.Parser(cache_dir=directory).compile("(a+)b")
+            p = cre.Parser(cache_dir=directory)
+            p._parse = Mock(side_effect=AssertionError("parsed again"))
+            loaded = p.compile("(a+)b")
+            self.assertIsNot(loaded, r)
+            self.assertEqual(loaded.match("aab").group(1), "aa")
+            self.assertRaises(AssertionError, p.compile, "(a+)b", 1)
+
+    def test_unreadable_cache_entries_are_replaced(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = cre.DiskCache(directory)
+            key = (str, "ab", 0, "auto")
+            with open(cache.path(key), "wb") as f:
+                f.write(b"garbage")
+            self.assertEqual(cache.get(key), None)
+            self.assertEqual(cre.Parser(cache_dir=directory).compile("ab")
+                             .match("ab").span(), (0, 2))
+            self.assertEqual(cache.get(key).pattern, "ab")
+
+    def test_truncated_cache_entries_are_replaced(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = cre.DiskCache(directory)
+            key = (str, "a+b", 0, "auto")
+            data = cre.Parser().compile("a+b").dumps()
+            # The header is intact, only the pickle is cut off.
+            with open(cache.path(key), "wb") as f:
+                f.write(data[:len(data) // 2])
+            self.assertEqual(cache.get(key), None)
+            self.assertEqual(cre.Parser(cache_dir=directory).compile("a+b")
+                             .match("aab").span(), (0, 3))
+            self.assertEqual(cache.get(key).pattern, "a+b")
 
 
 class TestCompleteness(unittest.TestCase):
@@ -0,0 +1,70 @@
+"""Batch matching compared with a plain loop over the subjects.
+
+Run with python -m tests.benchmark_batch. For every pattern, the best
+of repeat runs of test_many() and match_many() over a list of
+generated subjects is printed next to the same work done with
+[r.test(s) for s in subjects] and [r.match(s) for s in subjects], in
+microseconds per subject.
+
+"""
+
+import random
+import time
+import cre
+
+
+SUBJECT_COUNT = 50000
+
+
+def words(count, matching, seed=0):
+    """Return count random lowercase words; about the fraction matching
+    of them start with "ab"."""
+    rng = random.Random(seed)
+    subjects = []
+    for _ in range(count):
+        word = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz")
+                       for _ in range(rng.randint(3, 12)))
+        if rng.random() < matching:
+            word = "ab" + word
+        subjects.append(word)
+    return subjects
+
+
+# (pattern, fraction of subjects that match) pairs.
+CASES = (
+    ("ab[a-z]*", 0.1),
+    ("ab[a-z]*", 0.9),
+    ("(ab|cd)+[a-z]", 0.5),
+)
+
+
+def measure(function, repeat=5):
+    """Return the shortest of repeat calls of function, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print("%-16s %8s %10s %10s %10s %10s" % (
+        "pattern", "matching", "test_many", "test loop", "match_many",
+        "match loop"))
+    for pattern, matching in CASES:
+        r = cre.compile(pattern)
+        subjects = words(SUBJECT_COUNT, matching)
+        times = (
+            measure(lambda: r.test_many(subjects)),
+            measure(lambda: [r.test(s) for s in subjects]),
+            measure(lambda: r.match_many(subjects)),
+            measure(lambda: [r.match(s) for s in subjects]),
+        )
+        print("%-16s %8.1f %10.2f %10.2f %10.2f %10.2f" % ((
+            pattern, matching) + tuple(t / len(subjects) * 1e6
+                                       for t in times)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Compile-time benchmark over large generated patterns.
+
+Run with python -m tests.benchmark_compile. For every pattern size,
+the time Parser.parse() and Parser.compile() take is printed; both
+should grow linearly with the length of the pattern.
+
+"""
+
+import random
+import time
+import cre
+
+
+def keyword_alternation(size, seed=0):
+    """Return an alternation of random keywords, like the patterns
+    generated from word lists, that is about size characters long."""
+    rng = random.Random(seed)
+    words = []
+    length = 2
+    while length < size:
+        word = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz")
+                       for _ in range(rng.randint(3, 10)))
+        words.append(word)
+        length += len(word) + 1
+    return "(%s)" % "|".join(words)
+
+
+def mixed_pattern(size, seed=0):
+    """Return a sequence of groups, classes and repetitions that is
+    about size characters long."""
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        part = rng.choice(("(?P<g%d>[a-z_]+)" % len(parts), "\\d{2,4}",
+                           "(?:ab|cd)*", "[^\\s]?", "x{3}", "\\w+?"))
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def measure(function, pattern, repeat=3):
+    """Return the shortest of repeat runs of function(pattern), in
+    seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(pattern)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print("%-20s %8s %10s %10s %12s" % ("pattern", "length", "parse",
+                                       "compile", "us/char"))
+    for generate in (keyword_alternation, mixed_pattern):
+        for size in (1000, 10000, 50000, 100000):
+            pattern = generate(size)
+            parse = measure(cre.Parser().parse, pattern)
+            # A parser with caching disabled, so every run compiles.
+            compile = measure(cre.Parser(cache_size=0).compile, pattern)
+            print("%-20s %8d %9.3fs %9.3fs %12.2f" % (
+                generate.__name__, len(pattern), parse, compile,
+                compile / len(pattern) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
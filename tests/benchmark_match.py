@@ -0,0 +1,44 @@
+"""Per-character cost of matching with the expression tree.
+
+Run with python -m tests.benchmark_match. For every pattern, the
+parsed (not optimized) tree is matched against its subject with
+Expression.matches(), and the best of repeat runs is printed in
+nanoseconds per character of the subject.
+
+"""
+
+import time
+import cre
+
+
+# (pattern, subject) pairs; every subject is matched completely.
+CASES = (
+    ("a*", "a" * 20000),
+    ("[a-z]*", "abcxyz" * 3000),
+    ("(ab)*", "ab" * 5000),
+    ("(a*b)*c", "aab" * 3000 + "c"),
+)
+
+
+def measure(tree, subject, repeat=20):
+    """Return the shortest of repeat runs of matching tree against
+    subject, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        context = cre.EvaluationContext(subject)
+        start = time.perf_counter()
+        tree.matches(context)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print("%-10s %-18s %10s" % ("pattern", "subject", "ns/char"))
+    for pattern, subject in CASES:
+        seconds = measure(cre.Parser().parse(pattern), subject)
+        print("%-10s %-18s %10.0f" % (pattern, "%d chars" % len(subject),
+                                      seconds / len(subject) * 1e9))
+
+
+if __name__ == "__main__":
+    main()
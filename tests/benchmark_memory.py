@@ -0,0 +1,53 @@
+"""Memory that the expression tree keeps allocated after a match.
+
+Run with python -m tests.benchmark_memory. For every pattern, the
+parsed (not optimized) tree is matched against its subject with
+Expression.matches(), and the number of blocks allocated by
+cre/expression.py that are still alive afterwards is printed, as
+measured by tracemalloc snapshots taken before and after the match.
+
+"""
+
+import tracemalloc
+import cre
+
+
+# (pattern, subject) pairs; every subject is matched completely.
+CASES = (
+    ("(ab)*", "ab" * 1000),
+    ("[a-z]*", "abc" * 1000),
+    ("((a)b)*", "ab" * 1000),
+    ("((a)(b))*", "ab" * 1000),
+)
+
+
+def live_blocks(tree, subject):
+    """Return the number and size in bytes of the blocks that
+    cre/expression.py allocated while matching tree against subject
+    and that are still alive."""
+    context = cre.EvaluationContext(subject)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tree.matches(context)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    only_expressions = [tracemalloc.Filter(True, cre.expression.__file__)]
+    statistics = after.filter_traces(only_expressions).compare_to(
+        before.filter_traces(only_expressions), "filename")
+    return (sum(s.count_diff for s in statistics),
+            sum(s.size_diff for s in statistics))
+
+
+def main():
+    print("%-12s %-12s %8s %10s" % ("pattern", "subject", "blocks",
+                                    "bytes"))
+    for pattern, subject in CASES:
+        blocks, size = live_blocks(cre.Parser().parse(pattern), subject)
+        print("%-12s %-12s %8d %10d" % (pattern, "%d chars" % len(subject),
+                                        blocks, size))
+
+
+if __name__ == "__main__":
+    main()